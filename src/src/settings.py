@@ -27,14 +27,16 @@ INSTALLED_APPS = [
 REST_FRAMEWORK = {
     "PAGE_SIZE": 10,
     "EXCEPTION_HANDLER": "rest_framework_json_api.exceptions.exception_handler",
-    "DEFAULT_PAGINATION_CLASS": "rest_framework_json_api.pagination.JsonApiPageNumberPagination",
+    "DEFAULT_PAGINATION_CLASS": "transaction.pagination.EstimatedCountPagination",
     "DEFAULT_PARSER_CLASSES": (
         "rest_framework_json_api.parsers.JSONParser",
+        "transaction.renderers.MessagePackParser",
         "rest_framework.parsers.FormParser",
         "rest_framework.parsers.MultiPartParser",
     ),
     "DEFAULT_RENDERER_CLASSES": (
         "rest_framework_json_api.renderers.JSONRenderer",
+        "transaction.renderers.MessagePackRenderer",
         "rest_framework_json_api.renderers.BrowsableAPIRenderer",
     ),
     "DEFAULT_METADATA_CLASS": "rest_framework_json_api.metadata.JSONAPIMetadata",
@@ -54,6 +56,10 @@ REST_FRAMEWORK = {
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
+    # Removed from the chain on startup unless WALLET_PROFILING["ENABLED"].
+    "transaction.profiling.ProfilingMiddleware",
+    # Removed from the chain on startup unless WALLET_CAPTURE["ENABLED"].
+    "transaction.capture.CaptureMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -117,3 +123,101 @@ USE_TZ = True
 STATIC_URL = "static/"
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+
+# Balance updates of wallets in "optimistic" or "auto" concurrency mode.
+WALLET_CONCURRENCY = {
+    "MAX_RETRIES": 5,
+    "BACKOFF": 0.005,  # seconds, doubled on every retry.
+    "MAX_BACKOFF": 0.1,
+    "AUTO_CONFLICT_RATE": 0.2,  # "auto" wallets switch to row locks above it.
+    # Row locks: "block" waits for the database lock timeout, "nowait" fails
+    # right away with 409 and "timeout" waits at most LOCK_TIMEOUT seconds
+    # before failing with 503.
+    "LOCK_POLICY": "block",
+    "LOCK_TIMEOUT": 2,
+}
+
+# Server-Sent Events feed of wallet changes (`/api/wallets/{id}/events/`).
+WALLET_EVENTS = {
+    "BACKEND": "transaction.events.LocalBackend",  # in-process, one per worker.
+    "HISTORY_SIZE": 1000,  # events kept for Last-Event-ID resumes.
+    "QUEUE_SIZE": 100,  # pending events per client before it is disconnected.
+    "HEARTBEAT": 15,  # seconds between keepalive comments.
+}
+
+# Admission control of transaction writes per wallet, rejected with 429.
+WALLET_ADMISSION = {
+    # LocalCounter counts per worker, CacheCounter shares the count through
+    # the CACHE alias (configure a Redis or Memcached CACHES backend).
+    "BACKEND": "transaction.admission.LocalCounter",
+    "MAX_IN_FLIGHT": 8,  # writers per wallet waiting for or holding its lock.
+    "RETRY_AFTER": 1,  # seconds, sent as the Retry-After header.
+    "CACHE": "default",  # cache alias of CacheCounter.
+}
+
+# Holds (`/api/holds/`) reserving funds until they are captured or voided.
+WALLET_HOLDS = {
+    "TTL": 15 * 60,  # seconds, default lifetime of a hold.
+    "MAX_TTL": 7 * 24 * 60 * 60,
+}
+
+# On-demand request profiling, browsable by staff at /admin/profiles/.
+WALLET_PROFILING = {
+    "ENABLED": False,
+    # Requests with "X-Profile: <TOKEN>" are profiled, along with a
+    # SAMPLE_RATE share (0 to 1) of all requests.
+    "HEADER": "X-Profile",
+    "TOKEN": os.getenv("PROFILING_TOKEN"),
+    "SAMPLE_RATE": 0.0,
+    "DIRECTORY": "profiles",  # relative to BASE_DIR.
+    "MAX_ENTRIES": 50,  # oldest profiles are deleted beyond it.
+    "TOP_FUNCTIONS": 40,
+}
+
+# Sampled capture of API requests, replayed with the replay_traffic command.
+WALLET_CAPTURE = {
+    "ENABLED": False,
+    "SAMPLE_RATE": 0.01,  # share (0 to 1) of the requests captured.
+    "PATH_PREFIX": "/api/",
+    "FILE": "captures/traffic.ndjson",  # relative to BASE_DIR.
+    "MAX_BODY": 64 * 1024,  # larger requests are not captured.
+    "MAX_BYTES": 256 * 1024 * 1024,  # the file is rotated to "<FILE>.1" beyond it.
+    "QUEUE_SIZE": 10000,  # unwritten entries, later samples are dropped.
+}
+
+# Execution time budgets, in seconds, of each read statement of GET endpoints
+# ("<basename>.<action>"), cut off with a 400 past them. None disables one.
+WALLET_STATEMENT_BUDGETS = {
+    "DEFAULT": 5.0,
+    "ENDPOINTS": {
+        "transactions.list": 2.0,
+        "wallets.list": 2.0,
+        "holds.list": 2.0,
+        "transactions.retrieve": 0.5,
+        "wallets.retrieve": 0.5,
+        "holds.retrieve": 0.5,
+    },
+}
+
+# Cache of rendered wallet and transaction lists, invalidated on commit of
+# the writes changing them.
+WALLET_RESPONSE_CACHE = {
+    # Only enable with a Redis or Memcached CACHES backend for the CACHE
+    # alias: CacheGenerations shares the write counters of every worker and
+    # management command through it. The transaction.E001 system check
+    # refuses counters private to a process.
+    "ENABLED": False,
+    "GENERATIONS": "transaction.response_cache.CacheGenerations",
+    "CACHE": "default",
+    "MAX_ENTRIES": 1000,  # least recently used pages are evicted beyond it,
+    "MAX_BYTES": 32 * 1024 * 1024,  # or beyond this body size per worker.
+}
+
+# Wallet shards, database aliases of DATABASES. Wallets are spread by the
+# modulo hash of their id, the first alias also holds the id allocator and
+# the cross-shard transfer log. Keep a single alias when not sharding.
+WALLET_SHARDS = ["default"]
+# Alias used for id block reservations, point it at a second alias of the
+# first shard's database so reservations commit on their own.
+WALLET_ID_DATABASE = None
+DATABASE_ROUTERS = ["transaction.sharding.WalletShardRouter"]
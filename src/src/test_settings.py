@@ -6,3 +6,13 @@ DATABASES = {
         "NAME": BASE_DIR / "db.sqlite3",
     }
 }
+
+# Second wallet shard, used by the tests overriding WALLET_SHARDS.
+DATABASES["shard1"] = {
+    "ENGINE": "django.db.backends.sqlite3",
+    "NAME": BASE_DIR / "shard1.sqlite3",
+}
+
+# Writes in a TestCase never commit, the tests of the response cache enable it
+# and run the commit callbacks themselves.
+WALLET_RESPONSE_CACHE = {"ENABLED": False}
@@ -4,6 +4,8 @@ from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
 from rest_framework import permissions
 
+from transaction.profiling import profile_detail, profile_list
+
 schema_view = get_schema_view(
    openapi.Info(
       title="Snippets API",
@@ -18,6 +20,9 @@ schema_view = get_schema_view(
 )
 
 urlpatterns = [
+    # Registered before the admin site, which would catch them as app labels.
+    path('admin/profiles/', profile_list, name='profile-list'),
+    path('admin/profiles/<str:name>/', profile_detail, name='profile-detail'),
     path('admin/', admin.site.urls),
     path('api/', include('transaction.urls')),
     path('swagger/', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
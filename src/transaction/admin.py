@@ -1,3 +1,80 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 
-# Register your models here.
+from .exceptions import InsufficientFundsError
+from .models import Transaction, Wallet
+from .pagination import EstimatedCountPaginator
+
+
+class EstimatedCountAdmin(admin.ModelAdmin):
+    # Change lists of large tables without exact COUNT(*) queries.
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_paginator(
+        self, request, queryset, per_page, orphans=0, allow_empty_first_page=True
+    ):
+        unfiltered = queryset.query.where == self.get_queryset(request).query.where
+        return self.paginator(
+            queryset,
+            per_page,
+            orphans,
+            allow_empty_first_page,
+            unfiltered=unfiltered,
+        )
+
+
+@admin.register(Wallet)
+class WalletAdmin(EstimatedCountAdmin):
+    list_display = (
+        "id",
+        "label",
+        "balance",
+        "transactions_count",
+        "last_activity_at",
+        "concurrency_mode",
+    )
+    readonly_fields = (
+        "balance",
+        "held",
+        "version",
+        "transactions_count",
+        "last_activity_at",
+        "deleted_at",
+    )
+
+    # Deletes are soft like the API's, purge_wallets removes the wallets and
+    # their transactions later.
+    def delete_model(self, request, obj):
+        obj.soft_delete()
+
+    def delete_queryset(self, request, queryset):
+        queryset.soft_delete()
+
+    def get_deleted_objects(self, objs, request):
+        # Nothing cascades, the confirmation only lists the wallets.
+        objs = list(objs)
+        perms_needed = set()
+        if not self.has_delete_permission(request):
+            perms_needed.add(self.opts.verbose_name)
+        count = {self.opts.verbose_name_plural: len(objs)}
+        return [str(obj) for obj in objs], count, perms_needed, []
+
+
+@admin.register(Transaction)
+class TransactionAdmin(EstimatedCountAdmin):
+    list_display = ("id", "txid", "wallet_id", "amount")
+    raw_id_fields = ("wallet",)
+    search_fields = ("=txid",)
+
+    def get_readonly_fields(self, request, obj=None):
+        # Balances only follow amounts on creation and deletion.
+        if obj is not None:
+            return ("wallet", "amount")
+        return ()
+
+    def delete_queryset(self, request, queryset):
+        # Bulk deletes reverse the amounts like Transaction.delete does.
+        try:
+            queryset.bulk_reverse()
+        except InsufficientFundsError as error:
+            self.message_user(request, " ".join(error.detail), messages.ERROR)
@@ -0,0 +1,152 @@
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+from rest_framework.exceptions import Throttled
+
+from . import metrics
+
+DEFAULTS = {
+    "BACKEND": "transaction.admission.LocalCounter",
+    "MAX_IN_FLIGHT": 8,
+    "RETRY_AFTER": 1,
+    "CACHE": "default",
+}
+
+
+def get_setting(name):
+    return getattr(settings, "WALLET_ADMISSION", {}).get(name, DEFAULTS[name])
+
+
+class WalletBusy(Throttled):
+    default_detail = "Too many concurrent writes to this wallet."
+    default_code = "wallet_busy"
+
+
+class LocalCounter:
+    # In-process stand-in for a counter shared by every worker.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def incr(self, key):
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + 1
+            return self._counts[key]
+
+    def decr(self, key):
+        with self._lock:
+            count = self._counts.get(key, 0) - 1
+            if count > 0:
+                self._counts[key] = count
+            else:
+                self._counts.pop(key, None)
+
+    def counts(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+class CacheCounter:
+    # Counter shared through the CACHE alias (e.g. Redis or Memcached). Keys
+    # never expire, an expiring key would reset the count of writers still
+    # in flight.
+
+    def incr(self, key):
+        cache = caches[get_setting("CACHE")]
+        cache.add(key, 0, timeout=None)
+        try:
+            return cache.incr(key)
+        except ValueError:  # Evicted in between.
+            cache.add(key, 1, timeout=None)
+            return 1
+
+    def decr(self, key):
+        try:
+            caches[get_setting("CACHE")].decr(key)
+        except ValueError:
+            pass
+
+
+class AdmissionController:
+    # Rejects writes to a wallet once MAX_IN_FLIGHT writers already wait for
+    # its row lock, so a hot wallet cannot tie up every worker.
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.local = LocalCounter()
+
+    @contextmanager
+    def admit(self, wallet_ids):
+        acquired = []
+        try:
+            # Sorted, so concurrent multi-wallet writes count in one order.
+            for wallet_id in sorted(set(wallet_ids)):
+                key = f"wallet-admission:{wallet_id}"
+                depth = self.backend.incr(key)
+                acquired.append(key)
+                if depth > get_setting("MAX_IN_FLIGHT"):
+                    REJECTED.inc()
+                    raise WalletBusy(wait=get_setting("RETRY_AFTER"))
+            for key in acquired:
+                self.local.incr(key)
+            ADMITTED.inc()
+            try:
+                yield
+            finally:
+                for key in acquired:
+                    self.local.decr(key)
+        finally:
+            for key in acquired:
+                self.backend.decr(key)
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_controller():
+    global _controller
+    with _controller_lock:
+        if _controller is None:
+            _controller = AdmissionController(import_string(get_setting("BACKEND"))())
+        return _controller
+
+
+def admit(wallet_ids):
+    return get_controller().admit(wallet_ids)
+
+
+def _in_flight():
+    if _controller is None:
+        return {"total": 0, "wallets": 0, "max_depth": 0}
+    counts = _controller.local.counts()
+    return {
+        "total": sum(counts.values()),
+        "wallets": len(counts),
+        "max_depth": max(counts.values(), default=0),
+    }
+
+
+ADMITTED = metrics.counter("wallet_admission_admitted_total", "Wallet writes admitted.")
+REJECTED = metrics.counter(
+    "wallet_admission_rejected_total", "Wallet writes rejected with 429."
+)
+metrics.gauge(
+    "wallet_admission_in_flight",
+    "Admitted wallet writes in progress in this worker.",
+    lambda: _in_flight()["total"],
+)
+metrics.gauge(
+    "wallet_admission_busy_wallets",
+    "Wallets with writes in progress in this worker.",
+    lambda: _in_flight()["wallets"],
+)
+metrics.gauge(
+    "wallet_admission_max_depth",
+    "Largest number of writes in progress on one wallet in this worker.",
+    lambda: _in_flight()["max_depth"],
+)
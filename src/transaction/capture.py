@@ -0,0 +1,183 @@
+import base64
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from . import metrics
+
+DEFAULTS = {
+    "ENABLED": False,
+    "SAMPLE_RATE": 0.01,
+    "PATH_PREFIX": "/api/",
+    "FILE": "captures/traffic.ndjson",
+    "MAX_BODY": 64 * 1024,
+    "MAX_BYTES": 256 * 1024 * 1024,
+    "QUEUE_SIZE": 10000,
+}
+
+ID_SEGMENT = re.compile(r"/\d+(?=/|$)")
+
+# Sampled production requests for the replay_traffic command, one compact
+# JSON object per line:
+#   {"t": start time, "m": method, "p": path, "q": query string,
+#    "a": Accept, "c": Content-Type, "b": body or "b64": base64 body,
+#    "s": status code}
+# Only the Accept and Content-Type headers are kept, never credentials.
+
+
+def get_setting(name):
+    return getattr(settings, "WALLET_CAPTURE", {}).get(name, DEFAULTS[name])
+
+
+def get_path():
+    return Path(settings.BASE_DIR, get_setting("FILE"))
+
+
+class CaptureLog:
+    # Appends entries from a background thread, so requests never wait for
+    # the disk. Entries beyond QUEUE_SIZE are dropped instead of queued, and
+    # the file is rotated to "<file>.1" past MAX_BYTES.
+
+    def __init__(self, path, max_bytes, queue_size):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.queue = queue.Queue(queue_size)
+        self._stream = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def append(self, entry):
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            DROPPED.inc()
+        else:
+            CAPTURED.inc()
+
+    def flush(self):
+        # Waits until every queued entry is on disk.
+        self.queue.join()
+
+    def _run(self):
+        while True:
+            entry = self.queue.get()
+            try:
+                self._write(entry)
+            finally:
+                self.queue.task_done()
+
+    def _write(self, entry):
+        if self._stream is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._stream = open(self.path, "a", encoding="utf-8")
+        self._stream.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        if self.queue.empty():
+            self._stream.flush()
+        if self._stream.tell() > self.max_bytes:
+            self._stream.close()
+            self._stream = None
+            os.replace(self.path, f"{self.path}.1")
+
+
+_log = None
+_log_lock = threading.Lock()
+
+
+def get_log():
+    global _log
+    with _log_lock:
+        if _log is None or _log.path != get_path():
+            _log = CaptureLog(
+                get_path(), get_setting("MAX_BYTES"), get_setting("QUEUE_SIZE")
+            )
+        return _log
+
+
+class CaptureMiddleware:
+    # Samples SAMPLE_RATE of the requests under PATH_PREFIX into the capture
+    # log. Left out of the middleware chain unless ENABLED.
+
+    def __init__(self, get_response):
+        if not get_setting("ENABLED"):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.sample_rate = get_setting("SAMPLE_RATE")
+        self.prefix = get_setting("PATH_PREFIX")
+        self.max_body = get_setting("MAX_BODY")
+        self.log = get_log()
+
+    def __call__(self, request):
+        if not self._sampled(request):
+            return self.get_response(request)
+        started = time.time()
+        # Read before the view consumes the stream, Django keeps it for later.
+        body = request.body
+        response = self.get_response(request)
+        if response.streaming:  # Event streams cannot be replayed.
+            return response
+        entry = {
+            "t": round(started, 6),
+            "m": request.method,
+            "p": request.path,
+            "q": request.META.get("QUERY_STRING", ""),
+            "a": request.headers.get("Accept", ""),
+            "c": request.headers.get("Content-Type", ""),
+            "s": response.status_code,
+        }
+        if body:
+            try:
+                entry["b"] = body.decode()
+            except UnicodeDecodeError:
+                entry["b64"] = base64.b64encode(body).decode()
+        self.log.append(entry)
+        return response
+
+    def _sampled(self, request):
+        if not request.path.startswith(self.prefix):
+            return False
+        try:
+            length = int(request.headers.get("Content-Length") or 0)
+        except ValueError:
+            return False
+        return length <= self.max_body and random.random() < self.sample_rate
+
+
+def read_entries(path):
+    # Entries of a capture log in start time order, bodies as bytes.
+    entries = []
+    with open(path, encoding="utf-8") as stream:
+        for line in stream:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if "b64" in entry:
+                entry["body"] = base64.b64decode(entry.pop("b64"))
+            else:
+                entry["body"] = entry.pop("b", "").encode()
+            entries.append(entry)
+    entries.sort(key=lambda entry: entry["t"])
+    return entries
+
+
+def endpoint(entry):
+    # "GET /api/wallets/{id}/", so replay latencies are grouped per route.
+    return f"{entry['m']} {ID_SEGMENT.sub('/{id}', entry['p'])}"
+
+
+CAPTURED = metrics.counter("wallet_capture_requests_total", "Requests captured.")
+DROPPED = metrics.counter(
+    "wallet_capture_dropped_total", "Sampled requests dropped on a full queue."
+)
+metrics.gauge(
+    "wallet_capture_queue_depth",
+    "Captured requests waiting to be written.",
+    lambda: _log.queue.qsize() if _log is not None else 0,
+)
@@ -0,0 +1,139 @@
+import math
+import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import OperationalError, connections
+
+from .exceptions import WalletLockedError, WalletLockTimeoutError
+
+PESSIMISTIC = "pessimistic"
+OPTIMISTIC = "optimistic"
+AUTO = "auto"
+
+# Row lock acquisition policies of pessimistic balance updates.
+BLOCK = "block"
+NOWAIT = "nowait"
+TIMEOUT = "timeout"
+
+# MySQL lock wait timeout and NOWAIT errors, PostgreSQL lock_not_available.
+LOCK_ERROR_CODES = (1205, 3572, "55P03")
+
+CONCURRENCY_MODES = (
+    (PESSIMISTIC, "Pessimistic (row lock)"),
+    (OPTIMISTIC, "Optimistic (compare-and-swap on version)"),
+    (AUTO, "Automatic (by observed conflict rate)"),
+)
+
+DEFAULTS = {
+    "MAX_RETRIES": 5,
+    "BACKOFF": 0.005,
+    "MAX_BACKOFF": 0.1,
+    "AUTO_CONFLICT_RATE": 0.2,
+    "AUTO_DECAY": 0.1,
+    "TRACKED_WALLETS": 10000,
+    "LOCK_POLICY": BLOCK,
+    "LOCK_TIMEOUT": 2,
+}
+
+
+def get_setting(name):
+    return getattr(settings, "WALLET_CONCURRENCY", {}).get(name, DEFAULTS[name])
+
+
+class ConflictTracker:
+    # Exponentially decayed compare-and-swap conflict rate per wallet.
+    # Only the most recently used wallets are kept to bound memory.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rates = OrderedDict()
+        self.attempts = 0
+        self.conflicts = 0
+
+    def record(self, wallet_id, conflicted):
+        decay = get_setting("AUTO_DECAY")
+        with self._lock:
+            rate = self._rates.pop(wallet_id, 0.0)
+            self._rates[wallet_id] = rate * (1 - decay) + decay * bool(conflicted)
+            if len(self._rates) > get_setting("TRACKED_WALLETS"):
+                self._rates.popitem(last=False)
+            self.attempts += 1
+            self.conflicts += bool(conflicted)
+
+    def rate(self, wallet_id):
+        with self._lock:
+            return self._rates.get(wallet_id, 0.0)
+
+    def reset(self):
+        with self._lock:
+            self._rates.clear()
+            self.attempts = 0
+            self.conflicts = 0
+
+
+tracker = ConflictTracker()
+
+
+def resolve_mode(wallet):
+    if wallet.concurrency_mode != AUTO:
+        return wallet.concurrency_mode
+    if tracker.rate(wallet.id) > get_setting("AUTO_CONFLICT_RATE"):
+        # Pessimistic writes never conflict, so decay the rate on each of them
+        # to probe the optimistic mode again once the burst is over.
+        tracker.record(wallet.id, conflicted=False)
+        return PESSIMISTIC
+    return OPTIMISTIC
+
+
+def backoff(attempt):
+    delay = min(get_setting("MAX_BACKOFF"), get_setting("BACKOFF") * 2**attempt)
+    time.sleep(delay * random.uniform(0.5, 1))
+
+
+def lock_rows(queryset, evaluate=list):
+    # Evaluates `queryset` with SELECT ... FOR UPDATE under LOCK_POLICY, lock
+    # waits ending in an error are raised as retryable API errors.
+    policy = get_setting("LOCK_POLICY")
+    queryset = queryset.select_for_update(nowait=policy == NOWAIT)
+    try:
+        if policy == TIMEOUT:
+            with lock_timeout(queryset.db, get_setting("LOCK_TIMEOUT")):
+                return evaluate(queryset)
+        return evaluate(queryset)
+    except OperationalError as error:
+        cause = error.__cause__ or error
+        code = getattr(cause, "pgcode", None) or (cause.args or (None,))[0]
+        if code not in LOCK_ERROR_CODES:
+            raise
+        if policy == NOWAIT:
+            raise WalletLockedError() from error
+        raise WalletLockTimeoutError() from error
+
+
+@contextmanager
+def lock_timeout(using, seconds):
+    # Bounds the row lock wait of the statements run inside, on backends with
+    # a session lock timeout. SQLite locks the whole database on write and
+    # keeps its own busy timeout.
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        if connection.vendor == "mysql":
+            cursor.execute(
+                "SET SESSION innodb_lock_wait_timeout = %s", [math.ceil(seconds)]
+            )
+            try:
+                yield
+            finally:
+                cursor.execute("SET SESSION innodb_lock_wait_timeout = DEFAULT")
+        elif connection.vendor == "postgresql":
+            # SET LOCAL is undone by the rollback after a failed wait, an
+            # aborted transaction would reject the reset.
+            cursor.execute(f"SET LOCAL lock_timeout = {int(seconds * 1000)}")
+            yield
+            cursor.execute("SET LOCAL lock_timeout = DEFAULT")
+        else:
+            yield
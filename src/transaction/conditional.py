@@ -0,0 +1,74 @@
+import hashlib
+from urllib.parse import parse_qsl, urlencode
+
+from django.core.exceptions import ValidationError
+from django.http import HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags, quote_etag
+
+
+# Conditional GET helpers. ETags of single resources are derived from
+# Wallet.version, so a 304 can be decided without serializing the resource.
+# Every tag ends with the negotiated format: JSON and MessagePack bodies of
+# the same version are different representations and get different strong
+# tags, and responses vary on Accept.
+def make_etag(*parts):
+    return quote_etag("-".join(str(part) for part in parts))
+
+
+def representation(request):
+    return request.accepted_renderer.format
+
+
+def wallet_etag(request, wallet_id, version):
+    return make_etag("wallet", wallet_id, version, representation(request))
+
+
+def transaction_etag(request, transaction_id, wallet_id, version):
+    # Any change of a transaction goes through its wallet's deposit/withdraw,
+    # so the wallet version also versions the transaction.
+    return make_etag(
+        "transaction", transaction_id, wallet_id, version, representation(request)
+    )
+
+
+def normalized_query(request):
+    return urlencode(
+        sorted(parse_qsl(request.META.get("QUERY_STRING", ""), keep_blank_values=True))
+    )
+
+
+def page_etag(request, rows, *state):
+    # Lists have no version column of their own: their tag digests the id and
+    # version of every row of the page and the pagination `state` (count,
+    # next page), so a 304 is decided from an id/version query of the page.
+    versions = [(row.pk, row.version) for row in rows]
+    content = repr((normalized_query(request), versions, state))
+    digest = hashlib.md5(content.encode(), usedforsecurity=False).hexdigest()
+    return make_etag("list", digest, representation(request))
+
+
+def set_etag(response, etag):
+    response["ETag"] = etag
+    patch_vary_headers(response, ["Accept"])
+    return response
+
+
+def lookup_versions(queryset, pk, *fields):
+    # Single primary key lookup returning only the version columns.
+    try:
+        return queryset.filter(pk=pk).values_list(*fields).first()
+    except (TypeError, ValueError, ValidationError):
+        return None
+
+
+def is_not_modified(request, etag):
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return False
+    etags = parse_etags(header)
+    return "*" in etags or etag in etags
+
+
+def not_modified(etag):
+    return set_etag(HttpResponseNotModified(), etag)
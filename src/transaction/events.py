@@ -0,0 +1,186 @@
+import asyncio
+import itertools
+import json
+import threading
+from collections import deque
+from functools import partial
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+DEFAULTS = {
+    "BACKEND": "transaction.events.LocalBackend",
+    "HISTORY_SIZE": 1000,
+    "QUEUE_SIZE": 100,
+    "HEARTBEAT": 15,
+}
+
+# Sent to a subscriber whose queue overflowed, its stream is closed right after.
+OVERFLOW = object()
+
+
+def get_setting(name):
+    return getattr(settings, "WALLET_EVENTS", {}).get(name, DEFAULTS[name])
+
+
+class Event:
+    def __init__(self, event_id, event_type, wallet_id, data):
+        self.id = event_id
+        self.type = event_type
+        self.wallet_id = wallet_id
+        self.data = data
+
+    def encode(self):
+        payload = json.dumps({"wallet": self.wallet_id, **self.data})
+        return f"id: {self.id}\nevent: {self.type}\ndata: {payload}\n\n"
+
+
+class LocalBackend:
+    # In-process stand-in for a cross-process broker (e.g. Redis streams).
+    # A backend assigns increasing event ids, keeps a bounded replay history
+    # and calls every listener with each published event.
+
+    def __init__(self, history_size):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._last_id = 0
+        self._history = deque(maxlen=history_size)
+        self._listeners = []
+
+    def publish(self, event_type, wallet_id, data):
+        with self._lock:
+            event = Event(next(self._ids), event_type, wallet_id, data)
+            self._last_id = event.id
+            self._history.append(event)
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener(event)
+
+    def history(self, after_id):
+        # Returns None when events after `after_id` were already evicted, or
+        # when `after_id` was never assigned here (a restarted backend, or
+        # the id of another worker's backend).
+        with self._lock:
+            if after_id > self._last_id:
+                return None
+            if self._history and self._history[0].id > after_id + 1:
+                return None
+            return [event for event in self._history if event.id > after_id]
+
+    def add_listener(self, listener):
+        with self._lock:
+            self._listeners.append(listener)
+
+
+class Subscription:
+    def __init__(self, bus, wallet_ids, last_event_id):
+        self.bus = bus
+        self.wallet_ids = wallet_ids
+        self.last_event_id = last_event_id
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=get_setting("QUEUE_SIZE"))
+
+    def push(self, event):
+        # Called from any thread, the queue is only touched on its own loop.
+        if event.wallet_id in self.wallet_ids:
+            try:
+                self.loop.call_soon_threadsafe(self._put, event)
+            except RuntimeError:  # The client's event loop is already closed.
+                self.bus.unsubscribe(self)
+
+    def _put(self, event):
+        if self.queue.full():
+            # A slow client must not buffer events without bound, it is
+            # disconnected and resumes from its Last-Event-ID instead.
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(OVERFLOW)
+            self.bus.unsubscribe(self)
+        elif self.bus.is_subscribed(self):
+            self.queue.put_nowait(event)
+
+    async def stream(self):
+        try:
+            yield f"retry: {get_setting('HEARTBEAT') * 1000}\n\n"
+            if self.last_event_id is not None:
+                missed = self.bus.backend.history(self.last_event_id)
+                if missed is None:
+                    # Live events are no longer comparable with the client's
+                    # id, none of them must be skipped.
+                    self.last_event_id = None
+                    yield "event: reset\ndata: {}\n\n"
+                    missed = []
+                for event in missed:
+                    if event.wallet_id in self.wallet_ids:
+                        self.last_event_id = event.id
+                        yield event.encode()
+            while True:
+                try:
+                    event = await asyncio.wait_for(
+                        self.queue.get(), get_setting("HEARTBEAT")
+                    )
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if event is OVERFLOW:
+                    yield "event: overflow\ndata: {}\n\n"
+                    return
+                # Skips live events that were already replayed from history.
+                if self.last_event_id is None or event.id > self.last_event_id:
+                    self.last_event_id = event.id
+                    yield event.encode()
+        finally:
+            self.bus.unsubscribe(self)
+
+
+class EventBus:
+    def __init__(self, backend):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self._subscriptions = set()
+        backend.add_listener(self._dispatch)
+
+    def subscribe(self, wallet_ids, last_event_id=None):
+        subscription = Subscription(self, set(wallet_ids), last_event_id)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def is_subscribed(self, subscription):
+        with self._lock:
+            return subscription in self._subscriptions
+
+    def publish(self, event_type, wallet_id, data):
+        self.backend.publish(event_type, wallet_id, data)
+
+    def _dispatch(self, event):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            subscription.push(event)
+
+
+_bus = None
+_bus_lock = threading.Lock()
+
+
+def get_bus():
+    global _bus
+    with _bus_lock:
+        if _bus is None:
+            backend_class = import_string(get_setting("BACKEND"))
+            _bus = EventBus(backend_class(get_setting("HISTORY_SIZE")))
+        return _bus
+
+
+def publish_on_commit(event_type, wallet_id, using=None, **data):
+    # Events are only sent once the change is committed, rolled back
+    # balance updates are never seen by subscribers.
+    transaction.on_commit(
+        partial(get_bus().publish, event_type, wallet_id, data), using=using
+    )
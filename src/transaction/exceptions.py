@@ -1,6 +1,43 @@
-from rest_framework.exceptions import ValidationError
+from rest_framework import status
+from rest_framework.exceptions import APIException, ValidationError
 
 
 class InsufficientFundsError(ValidationError):
     pass
 
+
+class WalletLockedError(APIException):
+    # Raised in the "nowait" lock policy, `wait` is sent as Retry-After.
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = "The wallet is locked by another transaction, retry later."
+    default_code = "wallet_locked"
+    wait = 1
+
+
+class WalletLockTimeoutError(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "Timed out waiting for the wallet lock, retry later."
+    default_code = "wallet_lock_timeout"
+    wait = 1
+
+
+class TransferAbortedError(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = "The transfer was aborted, retry it with a new txid."
+    default_code = "transfer_aborted"
+
+
+class HoldNotActiveError(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = "The hold was already captured, voided or has expired."
+    default_code = "hold_not_active"
+
+
+class StatementTimeoutError(APIException):
+    # A read statement ran over its endpoint's budget, see statement_budgets.py.
+    status_code = status.HTTP_400_BAD_REQUEST
+    default_detail = (
+        "The query ran over its time budget. Narrow it down, e.g. filter on a "
+        "wallet, search for a longer term or request an earlier page."
+    )
+    default_code = "statement_timeout"
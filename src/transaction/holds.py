@@ -0,0 +1,152 @@
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from .exceptions import HoldNotActiveError, InsufficientFundsError
+from .models import Hold, Transaction, Wallet, record_event
+from .sharding import get_shards
+
+DEFAULTS = {
+    "TTL": 15 * 60,
+    "MAX_TTL": 7 * 24 * 60 * 60,
+}
+
+# Holds reserve funds in two short phases instead of keeping the wallet row
+# locked while an external system is called:
+#
+# - authorize moves the amount into Wallet.held with one guarded UPDATE
+#   ("balance - held >= amount"), so no row is read and locked beforehand;
+# - capture turns the hold into a transaction of the captured amount, void
+#   releases it and expire_holds releases the expired ones in batches.
+#
+# Each phase is its own database transaction, row locks last only for it.
+
+
+def get_setting(name):
+    return getattr(settings, "WALLET_HOLDS", {}).get(name, DEFAULTS[name])
+
+
+def authorize(wallet, amount, txid, ttl=None):
+    using = wallet._db
+    with transaction.atomic(using=using):
+        reserved = (
+            Wallet.objects.using(using)
+            .filter(id=wallet.id, balance__gte=F("held") + amount)
+            .update(held=F("held") + amount, version=F("version") + 1)
+        )
+        if not reserved:
+            raise InsufficientFundsError(
+                "Your wallet's balance is less than transaction's amount."
+            )
+        hold = Hold(
+            wallet=wallet,
+            amount=amount,
+            txid=txid,
+            expires_at=timezone.now() + timedelta(seconds=ttl or get_setting("TTL")),
+        )
+        hold.save(using=using)
+        _publish(hold, "authorized")
+    return hold
+
+
+def capture(hold, amount=None):
+    # Captures `amount` (the whole hold by default), the rest is released.
+    amount = hold.amount if amount is None else amount
+    using = hold._state.db
+    try:
+        with transaction.atomic(using=using):
+            _finish(hold, Hold.CAPTURED, captured_amount=amount)
+            Transaction(wallet=hold.wallet, txid=hold.txid, amount=-amount).save(
+                using=using
+            )
+    except IntegrityError:
+        # A transaction took the txid since the hold was authorized, the
+        # hold stays authorized. Sharded, the txid claim raises instead.
+        raise ValidationError({"txid": f"Transaction {hold.txid} exists."})
+    return hold
+
+
+def void(hold):
+    with transaction.atomic(using=hold._state.db):
+        _finish(hold, Hold.VOIDED)
+    return hold
+
+
+def expire(batch_size, using=None):
+    # Releases authorized holds past their expiry, `batch_size` at a time.
+    # Returns the number of holds expired.
+    expired = 0
+    for alias in [using] if using else get_shards():
+        while True:
+            count = _expire_batch(alias, batch_size)
+            expired += count
+            if count < batch_size:
+                break
+    return expired
+
+
+def _expire_batch(using, batch_size):
+    with transaction.atomic(using=using):
+        # Holds being captured or voided right now are skipped, not waited for.
+        batch = list(
+            Hold.objects.using(using)
+            .select_for_update(skip_locked=True)
+            .filter(state=Hold.AUTHORIZED, expires_at__lte=timezone.now())
+            .order_by("expires_at")[:batch_size]
+        )
+        if not batch:
+            return 0
+        Hold.objects.using(using).filter(id__in=[hold.id for hold in batch]).update(
+            state=Hold.EXPIRED
+        )
+        released = defaultdict(int)
+        for hold in batch:
+            released[hold.wallet_id] += hold.amount
+        # One update per wallet, in id order so concurrent sweeps cannot
+        # deadlock.
+        for wallet_id in sorted(released):
+            _release(using, wallet_id, released[wallet_id])
+        for hold in batch:
+            hold.state = Hold.EXPIRED
+            _publish(hold, "expired")
+    return len(batch)
+
+
+def _finish(hold, state, **fields):
+    # Guarded on the hold state, so a hold is captured, voided or expired once.
+    using = hold._state.db
+    finished = (
+        Hold.objects.using(using)
+        .filter(id=hold.id, state=Hold.AUTHORIZED, expires_at__gt=timezone.now())
+        .update(state=state, **fields)
+    )
+    if not finished:
+        raise HoldNotActiveError()
+    _release(using, hold.wallet_id, hold.amount)
+    hold.state = state
+    for name, value in fields.items():
+        setattr(hold, name, value)
+    _publish(hold, state)
+
+
+def _release(using, wallet_id, amount):
+    Wallet.all_objects.using(using).filter(id=wallet_id).update(
+        held=F("held") - amount, version=F("version") + 1
+    )
+
+
+def _publish(hold, action):
+    record_event(
+        hold._state.db,
+        "hold",
+        hold.wallet_id,
+        action=action,
+        id=hold.id,
+        txid=hold.txid,
+        amount=hold.amount,
+    )
@@ -0,0 +1,141 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Sum
+
+from transaction.models import Transaction, Wallet
+from transaction.utils import chunked, iter_keyset_chunks
+
+# Keeps "IN (...)" lookups below the bound-parameter limit of every backend.
+LOOKUP_BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = (
+        "Check that every wallet balance equals the sum of its transactions and "
+        "replay transactions in id order to find balances that went negative. "
+        "Rows are streamed in keyset chunks and aggregated with NumPy, point "
+        "--database at a reporting replica."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=100000)
+        parser.add_argument("--database", default="default")
+        parser.add_argument(
+            "--fail-on-errors",
+            action="store_true",
+            help="Exit with an error when any mismatch or negative balance is found.",
+        )
+
+    def handle(self, *args, **options):
+        database, chunk_size = options["database"], options["chunk_size"]
+        started = time.monotonic()
+        ids, balances = self._snapshot(database, chunk_size)
+        sums = np.zeros_like(balances)
+        # Transaction id and running balance of the first negative balance.
+        negative_at = np.zeros_like(balances)
+        negative_balance = np.zeros_like(balances)
+        rows = unknown = 0
+        queryset = Transaction.objects.using(database)
+        for chunk in iter_keyset_chunks(queryset, ["wallet_id", "amount"], chunk_size):
+            tx_ids, wallet_ids, amounts = np.array(chunk, dtype=np.int64).T
+            rows += len(tx_ids)
+            index = np.searchsorted(ids, wallet_ids)
+            # Transactions of wallets created after the snapshot are skipped.
+            known = index < len(ids)
+            known[known] = ids[index[known]] == wallet_ids[known]
+            unknown += len(known) - int(known.sum())
+            self._replay(
+                sums,
+                negative_at,
+                negative_balance,
+                tx_ids[known],
+                index[known],
+                amounts[known],
+            )
+
+        mismatched = self._recheck(database, ids[np.flatnonzero(sums != balances)])
+        for wallet_id, (balance, total) in sorted(mismatched.items()):
+            self.stdout.write(
+                f"Wallet {wallet_id}: balance {balance} != transactions sum {total}."
+            )
+        negative = np.flatnonzero(negative_at)
+        for position in negative:
+            self.stdout.write(
+                f"Wallet {ids[position]}: balance went negative "
+                f"({negative_balance[position]}) at transaction {negative_at[position]}."
+            )
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(
+            f"Audited {rows} transactions of {len(ids)} wallets in {elapsed:.2f}s "
+            f"({rows / max(elapsed, 1e-9) * 60:.0f} rows/min, {unknown} skipped): "
+            f"{len(mismatched)} mismatches, {len(negative)} negative balances."
+        )
+        if (mismatched or len(negative)) and options["fail_on_errors"]:
+            raise CommandError("The ledger does not match the wallet balances.")
+
+    def _snapshot(self, database, chunk_size):
+        # Wallet ids come in ascending order, ready for np.searchsorted.
+        chunks = [
+            np.array(chunk, dtype=np.int64).reshape(-1, 2)
+            for chunk in iter_keyset_chunks(
+                Wallet.all_objects.using(database), ["balance"], chunk_size
+            )
+        ]
+        snapshot = np.concatenate(chunks) if chunks else np.zeros((0, 2), np.int64)
+        return snapshot[:, 0].copy(), snapshot[:, 1].copy()
+
+    def _replay(self, sums, negative_at, negative_balance, tx_ids, index, amounts):
+        if not len(index):
+            return
+        # A stable sort groups the chunk by wallet and keeps the id order
+        # inside every group, so a cumulative sum restarted at each group
+        # start gives the running balance after each transaction.
+        order = np.argsort(index, kind="stable")
+        tx_ids, index, amounts = tx_ids[order], index[order], amounts[order]
+        starts = np.flatnonzero(np.r_[True, index[1:] != index[:-1]])
+        ends = np.r_[starts[1:], len(index)] - 1
+        running = np.cumsum(amounts)
+        offsets = running[starts] - amounts[starts]
+        running -= np.repeat(offsets, ends - starts + 1)
+        wallets = index[starts]
+        totals = running[ends]
+        running += np.repeat(sums[wallets], ends - starts + 1)
+        sums[wallets] += totals
+
+        negative = np.flatnonzero(running < 0)
+        if len(negative):
+            # np.unique returns the first negative row of every wallet.
+            positions, first = np.unique(index[negative], return_index=True)
+            new = negative_at[positions] == 0
+            rows = negative[first[new]]
+            negative_at[positions[new]] = tx_ids[rows]
+            negative_balance[positions[new]] = running[rows]
+
+    def _recheck(self, database, wallet_ids):
+        # Rows written while the audit ran show up as mismatches, they are
+        # recomputed in one short transaction and only real ones are kept.
+        mismatched = {}
+        for batch in chunked(wallet_ids.tolist(), LOOKUP_BATCH_SIZE):
+            with transaction.atomic(using=database):
+                balances = dict(
+                    Wallet.all_objects.using(database)
+                    .filter(id__in=batch)
+                    .values_list("id", "balance")
+                )
+                totals = dict(
+                    Transaction.objects.using(database)
+                    .filter(wallet_id__in=batch)
+                    .order_by()
+                    .values("wallet_id")
+                    .annotate(total=Sum("amount"))
+                    .values_list("wallet_id", "total")
+                )
+            for wallet_id, balance in balances.items():
+                total = totals.get(wallet_id) or 0
+                if balance != total:
+                    mismatched[wallet_id] = (int(balance), int(total))
+        return mismatched
@@ -0,0 +1,172 @@
+import json
+import os
+import re
+from itertools import combinations, product
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from transaction.views import TransactionViewSet, WalletViewSet
+
+VIEWSETS = (TransactionViewSet, WalletViewSet)
+# Filesorts reviewed and accepted per viewset, keyed by the filtered fields
+# and the ordering field. Full scans are never accepted.
+ACCEPTED_PATH = os.path.join(
+    os.path.dirname(__file__), "..", "..", "accepted_query_plans.json"
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Run EXPLAIN for every filterset_fields x ordering combination of the API "
+        "list endpoints and flag full table scans and filesorts."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--max-filters",
+            type=int,
+            default=2,
+            help="Maximum number of filters combined in one query.",
+        )
+        parser.add_argument(
+            "--skip-lookups",
+            default="icontains,iexact",
+            help="Comma separated lookups that cannot use an index and are not audited.",
+        )
+        parser.add_argument(
+            "--fail-on-flags",
+            action="store_true",
+            help="Exit with an error when any combination is flagged and not accepted.",
+        )
+        parser.add_argument(
+            "--accepted",
+            default=ACCEPTED_PATH,
+            help="JSON file of accepted filesorts, empty to accept none.",
+        )
+
+    def handle(self, *args, **options):
+        skip_lookups = set(filter(None, options["skip_lookups"].split(",")))
+        accepted = self._accepted(options["accepted"])
+        flagged = total = 0
+        for viewset in VIEWSETS:
+            queryset = viewset.queryset
+            for filters, ordering in self._combinations(
+                viewset, options["max_filters"], skip_lookups
+            ):
+                page = queryset.filter(**filters).order_by(*ordering)
+                page = page[: settings.REST_FRAMEWORK["PAGE_SIZE"]]
+                flags = self._flags(page.explain(**self._explain_options()), filters)
+                if flags == ["filesort"] and self._is_accepted(
+                    accepted.get(viewset.__name__, []), filters, ordering
+                ):
+                    flags = ["filesort (accepted)"]
+                total += 1
+                flagged += bool(flags) and not flags[0].endswith("(accepted)")
+                self.stdout.write(
+                    f"{viewset.__name__:<20} {self._describe(filters):<45} "
+                    f"{','.join(ordering) or '-':<18} {', '.join(flags) or 'ok'}"
+                )
+        self.stdout.write(f"{flagged} of {total} query plans flagged and not accepted.")
+        if flagged and options["fail_on_flags"]:
+            raise CommandError(f"{flagged} query plans use a full scan or filesort.")
+
+    def _combinations(self, viewset, max_filters, skip_lookups):
+        model = viewset.queryset.model
+        lookups = {
+            field: [lookup for lookup in field_lookups if lookup not in skip_lookups]
+            for field, field_lookups in viewset.filterset_fields.items()
+        }
+        lookups = {field: values for field, values in lookups.items() if values}
+        orderings = [()] + [
+            (f"{prefix}{field}",)
+            for field in viewset.filterset_fields
+            if model._meta.get_field(field).concrete
+            for prefix in ("", "-")
+        ]
+        filter_sets = [{}]
+        for size in range(1, max_filters + 1):
+            for fields in combinations(lookups, size):
+                for chosen in product(*(lookups[field] for field in fields)):
+                    filter_sets.append(
+                        {
+                            f"{field}__{lookup}": self._sample(model, field)
+                            for field, lookup in zip(fields, chosen)
+                        }
+                    )
+        return product(filter_sets, orderings)
+
+    def _accepted(self, path):
+        if not path:
+            return {}
+        try:
+            with open(path, encoding="utf-8") as stream:
+                return json.load(stream)
+        except (OSError, ValueError) as error:
+            raise CommandError(f"Cannot read {path}: {error}")
+
+    def _is_accepted(self, entries, filters, ordering):
+        fields = sorted(name.split("__")[0] for name in filters)
+        orderings = [field.lstrip("-") for field in ordering]
+        return any(
+            sorted(entry["filters"]) == fields
+            and all(field in entry["orderings"] for field in orderings)
+            for entry in entries
+        )
+
+    def _sample(self, model, field):
+        internal_type = model._meta.get_field(field).get_internal_type()
+        if internal_type in ("CharField", "TextField"):
+            return "a"
+        if internal_type == "DateTimeField":
+            return timezone.now()
+        return 1
+
+    def _explain_options(self):
+        if connection.vendor == "mysql":
+            return {"format": "json"}
+        return {}
+
+    def _flags(self, plan, filters):
+        flags = []
+        # An unfiltered LIMIT query may legitimately read the table in order.
+        if filters and self._full_scan(plan):
+            flags.append("full scan")
+        if self._filesort(plan):
+            flags.append("filesort")
+        return flags
+
+    def _full_scan(self, plan):
+        if connection.vendor == "mysql":
+            return any(
+                table.get("access_type") == "ALL" for table in _mysql_tables(plan)
+            )
+        if connection.vendor == "postgresql":
+            return "Seq Scan" in plan
+        # SQLite reports "SCAN table" without "USING INDEX" for full scans.
+        return bool(re.search(r"SCAN \w+(?! USING)( |$)", plan, re.MULTILINE))
+
+    def _filesort(self, plan):
+        if connection.vendor == "mysql":
+            return '"using_filesort": true' in plan
+        if connection.vendor == "postgresql":
+            return bool(re.search(r"^\s*(->\s*)?Sort ", plan, re.MULTILINE))
+        return "USE TEMP B-TREE FOR ORDER BY" in plan
+
+    def _describe(self, filters):
+        return "&".join(f"{name}=" for name in filters) or "-"
+
+
+def _mysql_tables(plan):
+    # Walks the EXPLAIN FORMAT=JSON document yielding every "table" node.
+    stack = [json.loads(plan)]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            if isinstance(node.get("table"), dict):
+                yield node["table"]
+            stack.extend(node.values())
+        elif isinstance(node, list):
+            stack.extend(node)
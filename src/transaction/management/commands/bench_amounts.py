@@ -0,0 +1,148 @@
+import contextlib
+import random
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from rest_framework import serializers
+from rest_framework.test import APIClient
+
+from transaction.models import OutboxEvent, Transaction, Wallet
+from transaction.serializers import (
+    MinorUnitsField,
+    TransactionCreateSerializer,
+    TransactionSerializer,
+)
+
+
+class DecimalAmountField(serializers.DecimalField):
+    # Serializer field of the former DECIMAL columns. Its output was replaced
+    # with int(), like the Decimal amounts put in outbox events.
+    def to_internal_value(self, data):
+        return int(super().to_internal_value(data))
+
+    def to_representation(self, value):
+        super().to_representation(value)
+        return int(value)
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure CPU time per create and list request and per amount value on "
+        "the former Decimal conversion path and on the integer one."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=200)
+        parser.add_argument("--values", type=int, default=100000)
+        parser.add_argument("--page-size", type=int, default=100)
+
+    def handle(self, *args, **options):
+        self._requests(options["requests"], options["page_size"])
+        self._values(options["values"])
+
+    def _requests(self, requests, page_size):
+        timings = {}
+        for name, path in (
+            ("decimal", self._decimal_amounts),
+            ("integer", contextlib.nullcontext),
+        ):
+            wallet = Wallet.objects.create(label=f"bench amounts {name}")
+            try:
+                with path():
+                    timings[name] = self._time_requests(wallet, requests, page_size)
+            finally:
+                # The creations recorded outbox events, consumers must not see
+                # them.
+                Transaction.objects.filter(wallet_id=wallet.id).delete()
+                OutboxEvent.objects.filter(wallet_id=wallet.id).delete()
+                Wallet.all_objects.filter(id=wallet.id).delete()
+            create, listing = timings[name]
+            self.stdout.write(
+                f"{name:<8} CPU per request: create {create * 1e3:.2f}ms, "
+                f"list of {min(page_size, requests)} {listing * 1e3:.2f}ms"
+            )
+        for number, request in enumerate(("create", "list")):
+            ratio = timings["integer"][number] / timings["decimal"][number]
+            self.stdout.write(
+                f"integer {request} requests take {ratio:.2f}x the CPU of decimal ones"
+            )
+
+    @contextlib.contextmanager
+    def _decimal_amounts(self):
+        # The former request path: amounts read from the database as Decimal,
+        # parsed by a DecimalField and rendered through int().
+        field = Transaction._meta.get_field("amount")
+        serializer_classes = (TransactionSerializer, TransactionCreateSerializer)
+        declared = [cls._declared_fields["amount"] for cls in serializer_classes]
+        field.from_db_value = lambda value, expression, connection: (
+            None if value is None else Decimal(value)
+        )
+        for cls in serializer_classes:
+            cls._declared_fields["amount"] = DecimalAmountField(
+                max_digits=18, decimal_places=0
+            )
+        try:
+            yield
+        finally:
+            del field.from_db_value
+            for cls, amount in zip(serializer_classes, declared):
+                cls._declared_fields["amount"] = amount
+
+    def _time_requests(self, wallet, requests, page_size):
+        client = APIClient()
+        body = {"data": {"type": "Transaction", "attributes": {}}}
+
+        started = time.process_time()
+        for number in range(requests):
+            body["data"]["attributes"] = {
+                "wallet": wallet.id,
+                "txid": f"bench-amounts-{wallet.id}-{number}",
+                "amount": 100,
+            }
+            response = client.post("/api/transactions/", body, format="vnd.api+json")
+            assert response.status_code == 201, response.content
+        create = (time.process_time() - started) / requests
+
+        started = time.process_time()
+        for _ in range(requests):
+            response = client.get(
+                f"/api/transactions/?wallet={wallet.id}&page[size]={page_size}"
+            )
+            assert response.status_code == 200, response.content
+        listing = (time.process_time() - started) / requests
+        return create, listing
+
+    def _values(self, count):
+        rng = random.Random(0)
+        values = [rng.randrange(-(10**12), 10**12) for _ in range(count)]
+        decimal_field = serializers.DecimalField(max_digits=18, decimal_places=0)
+        integer_field = MinorUnitsField()
+
+        def decimal_path():
+            # Adapter Decimal, serializer output replaced by int(), and the
+            # request payload parsed and added to a Decimal balance.
+            balance = Decimal(0)
+            for value in values:
+                amount = Decimal(value)
+                decimal_field.to_representation(amount)
+                int(amount)
+                balance += decimal_field.to_internal_value(str(value))
+            return balance
+
+        def integer_path():
+            balance = 0
+            for value in values:
+                integer_field.to_representation(value)
+                balance += integer_field.to_internal_value(value)
+            return balance
+
+        timings = {}
+        for name, path in (("decimal", decimal_path), ("integer", integer_path)):
+            started = time.process_time()
+            path()
+            timings[name] = (time.process_time() - started) / count
+            self.stdout.write(f"{name:<8} {timings[name] * 1e9:>8.0f}ns per amount")
+        self.stdout.write(
+            f"integer path is {timings['decimal'] / timings['integer']:.1f}x cheaper"
+        )
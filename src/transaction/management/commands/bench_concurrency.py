@@ -0,0 +1,72 @@
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection
+
+from transaction.concurrency import OPTIMISTIC, PESSIMISTIC, tracker
+from transaction.models import OutboxEvent, Transaction, Wallet
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark pessimistic vs optimistic balance updates. Contention is "
+        "controlled by the number of wallets shared by the workers."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=8)
+        parser.add_argument("--operations", type=int, default=200)
+        parser.add_argument(
+            "--wallets",
+            default="1,4,32",
+            help="Comma separated wallet counts, fewer wallets means more contention.",
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f"{'mode':<12}{'wallets':>8}{'ops/s':>10}{'conflicts':>11}{'errors':>8}"
+        )
+        for wallets in [int(count) for count in options["wallets"].split(",")]:
+            for mode in (PESSIMISTIC, OPTIMISTIC):
+                self._run(mode, wallets, options["workers"], options["operations"])
+
+    def _run(self, mode, wallets, workers, operations):
+        ids = [
+            Wallet.objects.create(label=f"bench {mode}", concurrency_mode=mode).id
+            for _ in range(wallets)
+        ]
+        try:
+            self._measure(mode, ids, workers, operations)
+        finally:
+            # The deposits recorded outbox events, consumers must not see them.
+            Transaction.objects.filter(wallet_id__in=ids).delete()
+            OutboxEvent.objects.filter(wallet_id__in=ids).delete()
+            Wallet.all_objects.filter(id__in=ids).delete()
+
+    def _measure(self, mode, ids, workers, operations):
+        tracker.reset()
+
+        def work(seed):
+            rng = random.Random(seed)
+            errors = 0
+            try:
+                for _ in range(operations):
+                    try:
+                        Wallet(id=rng.choice(ids), concurrency_mode=mode).deposit(1)
+                    except DatabaseError:
+                        errors += 1
+            finally:
+                connection.close()
+            return errors
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            errors = sum(executor.map(work, range(workers)))
+        elapsed = time.perf_counter() - started
+
+        self.stdout.write(
+            f"{mode:<12}{len(ids):>8}{workers * operations / elapsed:>10.0f}"
+            f"{tracker.conflicts:>11}{errors:>8}"
+        )
@@ -0,0 +1,73 @@
+import json
+import time
+
+import msgpack
+from django.core.management.base import BaseCommand
+from rest_framework.test import APIClient
+from rest_framework_json_api.renderers import JSONRenderer
+
+from transaction.models import Transaction, Wallet
+from transaction.renderers import MEDIA_TYPE, MessagePackRenderer
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare payload size and encode/decode CPU time of a transaction list "
+        "page rendered as JSON:API JSON and as MessagePack."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--page-size", type=int, default=100)
+        parser.add_argument("--repeat", type=int, default=200)
+
+    def handle(self, *args, **options):
+        page_size, repeat = options["page_size"], options["repeat"]
+        wallet = Wallet.objects.create(label="bench msgpack")
+        Transaction.objects.bulk_create(
+            Transaction(wallet=wallet, txid=f"bench-msgpack-{wallet.id}-{n}", amount=n)
+            for n in range(page_size)
+        )
+        try:
+            client = APIClient()
+            url = f"/api/transactions/?wallet={wallet.id}&page[size]={page_size}"
+            for name, renderer, media_type, dump, load in (
+                (
+                    "json",
+                    JSONRenderer(),
+                    "application/vnd.api+json",
+                    json.dumps,
+                    json.loads,
+                ),
+                (
+                    "msgpack",
+                    MessagePackRenderer(),
+                    MEDIA_TYPE,
+                    msgpack.packb,
+                    lambda body: msgpack.unpackb(body, raw=False),
+                ),
+            ):
+                response = client.get(url, HTTP_ACCEPT=media_type)
+                assert response.status_code == 200, response.content
+                self._measure(name, renderer, media_type, dump, load, response, repeat)
+        finally:
+            Wallet.all_objects.filter(id=wallet.id).delete()
+
+    def _measure(self, name, renderer, media_type, dump, load, response, repeat):
+        # The page's data and context are rendered again, so the queries are
+        # not timed. "render" includes building the JSON:API document,
+        # "dump" only encodes the built document.
+        def timed(function, *args):
+            started = time.process_time()
+            for _ in range(repeat):
+                result = function(*args)
+            return result, (time.process_time() - started) / repeat
+
+        body, render = timed(
+            renderer.render, response.data, media_type, response.renderer_context
+        )
+        document, decode = timed(load, body)
+        _, encode = timed(dump, document)
+        self.stdout.write(
+            f"{name:<8} {len(body):>8} bytes, render {render * 1e3:.3f}ms, "
+            f"dump {encode * 1e3:.3f}ms, decode {decode * 1e3:.3f}ms"
+        )
@@ -0,0 +1,78 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from transaction.models import OutboxEvent, Transaction, Wallet
+from transaction.netting import Batch, settle
+from transaction.utils import make_transaction
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark netting settlement of a batch of offsetting legs against "
+        "applying the same legs one by one through make_transaction."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--legs", type=int, default=100000)
+        parser.add_argument("--wallets", type=int, default=1000)
+        parser.add_argument(
+            "--gross-legs",
+            type=int,
+            default=2000,
+            help="Legs applied one by one for the comparison, extrapolated.",
+        )
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        wallets = Wallet.objects.bulk_create(
+            Wallet(label=f"bench netting {i}", balance=10**9)
+            for i in range(options["wallets"])
+        )
+        if wallets[0].pk is None:  # Backends not returning bulk insert ids.
+            wallets = list(Wallet.objects.filter(label__startswith="bench netting "))
+        ids = [wallet.id for wallet in wallets]
+        prefix = f"bench-netting-{time.time_ns()}"
+        try:
+            legs = [rng.sample(ids, 2) for _ in range(options["legs"])]
+            batch = Batch(
+                [source for source, _ in legs],
+                [target for _, target in legs],
+                [rng.randint(1, 1000) for _ in legs],
+                [f"{prefix}-{number}" for number in range(len(legs))],
+            )
+
+            started = time.perf_counter()
+            batch.net_positions()
+            aggregate = time.perf_counter() - started
+
+            started = time.perf_counter()
+            summary = settle(batch)
+            netted = time.perf_counter() - started
+
+            count = min(options["gross_legs"], len(legs))
+            started = time.perf_counter()
+            for number, (source, target) in enumerate(legs[:count]):
+                amount = int(batch.amounts[number])
+                with transaction.atomic():
+                    make_transaction(Wallet(id=source), -amount, transactions=1)
+                    make_transaction(Wallet(id=target), amount, transactions=1)
+            gross = (time.perf_counter() - started) / max(count, 1) * len(legs)
+        finally:
+            Transaction.objects.filter(wallet_id__in=ids).delete()
+            OutboxEvent.objects.filter(wallet_id__in=ids).delete()
+            Wallet.all_objects.filter(id__in=ids).delete()
+
+        self.stdout.write(
+            f"{summary['legs']} legs, {summary['wallets']} wallets, "
+            f"gross {summary['gross']}, net {summary['net']}"
+        )
+        self.stdout.write(f"{'net positions (NumPy)':<28}{aggregate:>9.3f}s")
+        self.stdout.write(
+            f"{'netted settlement':<28}{netted:>9.3f}s{len(legs) / netted:>12.0f} legs/s"
+        )
+        self.stdout.write(
+            f"{'leg by leg (extrapolated)':<28}{gross:>9.3f}s{len(legs) / gross:>12.0f} legs/s"
+        )
@@ -0,0 +1,75 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from transaction.models import OutboxEvent
+
+
+class Command(BaseCommand):
+    help = (
+        "Deliver outbox events in id order and delete them once delivered. "
+        "Several drainers can run in parallel, each claims its own batch with "
+        "SELECT ... FOR UPDATE SKIP LOCKED. Delivery is at-least-once, consumers "
+        "deduplicate by event id."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument(
+            "--database",
+            default="default",
+            help="Outbox to drain, run one drainer per wallet shard.",
+        )
+        parser.add_argument(
+            "--sink",
+            help="Dotted path of a callable receiving each batch of events, "
+            "events are written to stdout as NDJSON by default.",
+        )
+        parser.add_argument(
+            "--loop",
+            type=float,
+            default=None,
+            help="Keep draining, sleeping this many seconds whenever the outbox is empty.",
+        )
+
+    def handle(self, *args, **options):
+        sink = import_string(options["sink"]) if options["sink"] else self._write
+        delivered = 0
+        while True:
+            count = self._drain_batch(sink, options["database"], options["batch_size"])
+            delivered += count
+            if count < options["batch_size"]:
+                if options["loop"] is None:
+                    break
+                time.sleep(options["loop"])
+        self.stderr.write(f"Delivered {delivered} outbox events.")
+
+    def _drain_batch(self, sink, database, batch_size):
+        # Rows stay locked until the batch is delivered and deleted. A drainer
+        # failing in between rolls back and the batch is delivered again.
+        events = OutboxEvent.objects.using(database)
+        with transaction.atomic(using=database):
+            batch = list(
+                events.select_for_update(skip_locked=True).order_by("id")[:batch_size]
+            )
+            if batch:
+                sink(batch)
+                events.filter(id__in=[event.id for event in batch]).delete()
+        return len(batch)
+
+    def _write(self, batch):
+        for event in batch:
+            self.stdout.write(
+                json.dumps(
+                    {
+                        "id": event.id,
+                        "topic": event.topic,
+                        "wallet": event.wallet_id,
+                        "created_at": event.created_at.isoformat(),
+                        **event.payload,
+                    }
+                )
+            )
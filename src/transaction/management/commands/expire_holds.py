@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from transaction.holds import expire
+
+
+class Command(BaseCommand):
+    help = (
+        "Release authorized holds past their expiry in batches, each batch in "
+        "its own short transaction. Holds locked by a capture or void are "
+        "skipped and picked up by the next run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument(
+            "--database",
+            default=None,
+            help="Sweep a single wallet shard, every shard by default.",
+        )
+        parser.add_argument(
+            "--loop",
+            type=float,
+            default=None,
+            help="Keep running, sweeping every N seconds.",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            expired = expire(options["batch_size"], options["database"])
+            self.stdout.write(f"Expired {expired} holds.")
+            if options["loop"] is None:
+                return
+            time.sleep(options["loop"])
@@ -0,0 +1,179 @@
+import json
+import os
+import time
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from transaction.models import OutboxEvent, Transaction, Wallet, record_events
+from transaction.sharding import is_sharded
+from transaction.utils import chunked, read_records
+
+# Keeps "IN (...)" lookups below the bound-parameter limit of every backend.
+LOOKUP_BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = (
+        "Bulk import wallets and their opening transactions from a CSV or NDJSON "
+        "file with `wallet`, `label`, `txid` and `amount` columns."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument("--format", choices=("csv", "ndjson"), default=None)
+        parser.add_argument("--chunk-size", type=int, default=10000)
+        parser.add_argument(
+            "--checkpoint",
+            help="File recording the number of imported rows, used to resume.",
+        )
+
+    def handle(self, *args, **options):
+        if is_sharded():
+            # Wallets are created with the ids of the file, not ids allocated
+            # for their shard, and txids are only checked on one database.
+            raise CommandError("import_ledger cannot run with several WALLET_SHARDS.")
+        path = options["path"]
+        checkpoint = options["checkpoint"]
+        offset = self._read_checkpoint(checkpoint, path)
+        records = read_records(path, options["format"])
+
+        imported = skipped = 0
+        started = time.monotonic()
+        for index, chunk in enumerate(chunked(records, options["chunk_size"])):
+            # Chunks before the checkpoint were committed by a previous run.
+            if (index + 1) * options["chunk_size"] <= offset:
+                continue
+            rows = [self._parse(row) for row in chunk]
+            created = self._import_chunk(rows)
+            imported += created
+            skipped += len(rows) - created
+            offset = index * options["chunk_size"] + len(chunk)
+            self._write_checkpoint(checkpoint, path, offset)
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(
+            f"Imported {imported} transactions, skipped {skipped} existing txids "
+            f"in {elapsed:.2f}s."
+        )
+
+    def _parse(self, row):
+        try:
+            return {
+                "wallet": int(row["wallet"]),
+                "label": row.get("label") or "",
+                "txid": str(row["txid"]),
+                "amount": int(row["amount"]),
+            }
+        except (KeyError, TypeError, ValueError) as error:
+            raise CommandError(f"Invalid row {row!r}: {error}")
+
+    @transaction.atomic()
+    def _import_chunk(self, rows):
+        # Existing txids are skipped, so re-running a chunk that was committed
+        # right before a crash does not apply its amounts twice.
+        existing = self._existing_txids({row["txid"] for row in rows})
+        new_rows = []
+        for row in rows:
+            if row["txid"] not in existing:
+                existing.add(row["txid"])
+                new_rows.append(row)
+
+        deltas = defaultdict(int)
+        counts = defaultdict(int)
+        labels = {}
+        for row in new_rows:
+            deltas[row["wallet"]] += row["amount"]
+            counts[row["wallet"]] += 1
+            labels.setdefault(row["wallet"], row["label"])
+
+        wallets = {}
+        for ids in chunked(deltas, LOOKUP_BATCH_SIZE):
+            for wallet in Wallet.all_objects.select_for_update().filter(id__in=ids):
+                if wallet.deleted_at is not None:
+                    raise CommandError(f"Wallet {wallet.id} is deleted.")
+                wallets[wallet.id] = wallet
+
+        new_wallets = []
+        now = timezone.now()
+        for wallet_id, delta in deltas.items():
+            wallet = wallets.get(wallet_id)
+            if wallet is None:
+                wallet = Wallet(id=wallet_id, label=labels[wallet_id] or str(wallet_id))
+                new_wallets.append(wallet)
+            wallet.balance += delta
+            wallet.version += 1
+            wallet.transactions_count += counts[wallet_id]
+            wallet.last_activity_at = now
+            if wallet.balance < wallet.held:
+                raise CommandError(
+                    f"Wallet {wallet_id} balance would become lower than its holds: "
+                    f"{wallet.balance}."
+                )
+
+        Wallet.objects.bulk_create(new_wallets)
+        Wallet.objects.bulk_update(
+            wallets.values(),
+            ["balance", "version", "transactions_count", "last_activity_at"],
+        )
+        transactions = Transaction.objects.bulk_create(
+            Transaction(wallet_id=row["wallet"], txid=row["txid"], amount=row["amount"])
+            for row in new_rows
+        )
+        self._record_events(list(wallets.values()) + new_wallets, deltas, transactions)
+        return len(new_rows)
+
+    def _record_events(self, wallets, deltas, transactions):
+        # Imported changes reach the outbox like any other, in the same
+        # transaction. Transaction ids are None on backends that do not
+        # return them from bulk inserts, txid identifies the row instead.
+        events = [
+            OutboxEvent(
+                topic="balance",
+                wallet_id=wallet.id,
+                payload=Wallet._balance_event(
+                    wallet.balance, wallet.version, deltas[wallet.id]
+                ),
+            )
+            for wallet in wallets
+        ]
+        events.extend(
+            OutboxEvent(
+                topic="transaction",
+                wallet_id=tx.wallet_id,
+                payload=Transaction._event("created", tx.pk, tx.txid, tx.amount),
+            )
+            for tx in transactions
+        )
+        record_events("default", events)
+
+    def _existing_txids(self, txids):
+        existing = set()
+        for batch in chunked(txids, LOOKUP_BATCH_SIZE):
+            existing.update(
+                Transaction.objects.filter(txid__in=batch).values_list(
+                    "txid", flat=True
+                )
+            )
+        return existing
+
+    def _read_checkpoint(self, checkpoint, path):
+        if not checkpoint or not os.path.exists(checkpoint):
+            return 0
+        with open(checkpoint, encoding="utf-8") as stream:
+            state = json.load(stream)
+        if state.get("path") != os.path.abspath(path):
+            raise CommandError(
+                f"Checkpoint {checkpoint} belongs to {state.get('path')}."
+            )
+        return state["rows"]
+
+    def _write_checkpoint(self, checkpoint, path, rows):
+        if not checkpoint:
+            return
+        tmp_path = f"{checkpoint}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as stream:
+            json.dump({"path": os.path.abspath(path), "rows": rows}, stream)
+        os.replace(tmp_path, checkpoint)
@@ -0,0 +1,105 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from transaction.models import OutboxEvent, Transaction, Wallet, record_events
+from transaction.sharding import get_shards
+
+
+class Command(BaseCommand):
+    help = (
+        "Remove soft-deleted wallets, deleting their transactions in bounded "
+        "batches so memory and lock time do not depend on the history size."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=0,
+            help="Pause between batches in seconds, to leave room for other writers.",
+        )
+        parser.add_argument(
+            "--database",
+            default=None,
+            help="Purge a single wallet shard, every shard by default.",
+        )
+        parser.add_argument(
+            "--loop",
+            type=float,
+            default=None,
+            help="Keep running, polling for deleted wallets every N seconds.",
+        )
+
+    def handle(self, *args, **options):
+        databases = [options["database"]] if options["database"] else get_shards()
+        while True:
+            purged = 0
+            for self.using in databases:
+                purged += self._purge_database(options["batch_size"], options["sleep"])
+            self.stdout.write(f"Purged {purged} wallets.")
+            if options["loop"] is None:
+                return
+            time.sleep(options["loop"])
+
+    def _purge_database(self, batch_size, pause):
+        purged = 0
+        deleted = Wallet.all_objects.using(self.using).filter(deleted_at__isnull=False)
+        while wallet_ids := list(deleted.values_list("id", flat=True)[:100]):
+            for wallet_id in wallet_ids:
+                self._purge(wallet_id, batch_size, pause)
+            purged += len(wallet_ids)
+        return purged
+
+    def _purge(self, wallet_id, batch_size, pause):
+        # Every batch runs in its own short transaction, together with the
+        # outbox events of the rows it removes.
+        while self._delete_batch(wallet_id, batch_size) == batch_size:
+            if pause:
+                time.sleep(pause)
+        with transaction.atomic(using=self.using):
+            deleted = (
+                Wallet.all_objects.using(self.using)
+                .filter(id=wallet_id, deleted_at__isnull=False)
+                .delete()[0]
+            )
+            if deleted:
+                record_events(
+                    self.using,
+                    [
+                        OutboxEvent(
+                            topic="wallet",
+                            wallet_id=wallet_id,
+                            payload={"action": "purged"},
+                        )
+                    ],
+                )
+
+    def _delete_batch(self, wallet_id, batch_size):
+        # Ids are read through the wallet index first, so the delete only
+        # touches the rows it reports events for.
+        with transaction.atomic(using=self.using):
+            rows = list(
+                Transaction.objects.using(self.using)
+                .filter(wallet_id=wallet_id)
+                .values_list("id", "txid", "amount")[:batch_size]
+            )
+            if not rows:
+                return 0
+            Transaction.objects.using(self.using).filter(
+                id__in=[pk for pk, _, _ in rows]
+            ).delete()
+            record_events(
+                self.using,
+                [
+                    OutboxEvent(
+                        topic="transaction",
+                        wallet_id=wallet_id,
+                        payload=Transaction._event("purged", pk, txid, amount),
+                    )
+                    for pk, txid, amount in rows
+                ],
+            )
+        return len(rows)
@@ -0,0 +1,67 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F
+
+from transaction.concurrency import lock_rows
+from transaction.models import Transaction, Wallet
+from transaction.response_cache import invalidate_on_commit
+from transaction.sharding import get_shards
+from transaction.utils import iter_keyset_chunks
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute Wallet.transactions_count from the transaction table in "
+        "chunks of wallets. last_activity_at cannot be derived from transactions "
+        "and is left as is."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument(
+            "--database",
+            default=None,
+            help="Rebuild a single wallet shard, every shard by default.",
+        )
+
+    def handle(self, *args, **options):
+        databases = [options["database"]] if options["database"] else get_shards()
+        fixed = total = 0
+        for using in databases:
+            for chunk in iter_keyset_chunks(
+                Wallet.all_objects.using(using), [], options["chunk_size"]
+            ):
+                ids = [row[0] for row in chunk]
+                with transaction.atomic(using=using):
+                    fixed += self._rebuild_chunk(using, ids[0], ids[-1])
+                total += len(ids)
+        self.stdout.write(f"Rebuilt counters of {total} wallets, {fixed} fixed.")
+
+    def _rebuild_chunk(self, using, first_id, last_id):
+        # The wallets are locked while counting, so no concurrent transaction
+        # write can slip in between the count and the update.
+        wallets = Wallet.all_objects.using(using).filter(
+            id__gte=first_id, id__lte=last_id
+        )
+        current = dict(
+            lock_rows(wallets.order_by("id").values_list("id", "transactions_count"))
+        )
+        counts = dict(
+            Transaction.objects.using(using)
+            .filter(wallet_id__gte=first_id, wallet_id__lte=last_id)
+            .order_by()
+            .values("wallet_id")
+            .annotate(count=Count("id"))
+            .values_list("wallet_id", "count")
+        )
+        fixed = 0
+        for wallet_id, count in current.items():
+            if counts.get(wallet_id, 0) != count:
+                # Version is bumped as the count is part of the wallet ETag.
+                Wallet.all_objects.using(using).filter(id=wallet_id).update(
+                    transactions_count=counts.get(wallet_id, 0),
+                    version=F("version") + 1,
+                )
+                invalidate_on_commit([wallet_id], using=using)
+                fixed += 1
+        return fixed
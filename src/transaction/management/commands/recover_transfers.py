@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from transaction.transfers import recover
+
+
+class Command(BaseCommand):
+    help = (
+        "Finish cross-shard transfers interrupted after their commit or abort "
+        "decision, and abort those stuck in the prepare phase."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--older-than",
+            type=int,
+            default=60,
+            help="Seconds after which a transfer still preparing is aborted.",
+        )
+
+    def handle(self, *args, **options):
+        count = recover(options["older_than"])
+        self.stdout.write(f"Finished {count} transfers.")
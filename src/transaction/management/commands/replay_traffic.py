@@ -0,0 +1,134 @@
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from transaction.capture import endpoint, read_entries
+
+TXID = re.compile(rb'("txid"\s*:\s*"[^"]*)"')
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay a capture log (WALLET_CAPTURE) against a running instance with "
+        "the original timing, scaled by --speed, from concurrent workers. "
+        "Reports latency percentiles per endpoint and requests whose status "
+        "differs from the captured one. Replay against a database restored "
+        "from the start of the capture for matching results."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("log")
+        parser.add_argument("--base-url", default="http://localhost:8000")
+        parser.add_argument(
+            "--speed",
+            type=float,
+            default=1.0,
+            help="Timing multiplier, 2 replays twice as fast, 0 without pauses.",
+        )
+        parser.add_argument("--workers", type=int, default=8)
+        parser.add_argument("--limit", type=int, default=None)
+        parser.add_argument("--timeout", type=float, default=30)
+        parser.add_argument(
+            "--txid-suffix",
+            default="",
+            help="Appended to txids of request bodies, so writes can be replayed "
+            "again on the same database.",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            entries = read_entries(options["log"])[: options["limit"]]
+        except (OSError, ValueError) as error:
+            raise CommandError(f"Cannot read {options['log']}: {error}")
+        if not entries:
+            raise CommandError("The capture log is empty.")
+        self.options = options
+        self.latencies = defaultdict(list)
+        self.differences = []
+        self.lock = threading.Lock()
+
+        started = time.monotonic()
+        lag = self._dispatch(entries)
+        elapsed = time.monotonic() - started
+        self._report(len(entries), elapsed, lag)
+
+    def _dispatch(self, entries):
+        # Requests are submitted in capture order at their scaled offset.
+        # Returns the largest delay of a submission behind its schedule.
+        speed = self.options["speed"]
+        first = entries[0]["t"]
+        started = time.monotonic()
+        lag = 0.0
+        with ThreadPoolExecutor(self.options["workers"]) as pool:
+            for entry in entries:
+                if speed > 0:
+                    due = started + (entry["t"] - first) / speed
+                    delay = due - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    else:
+                        lag = max(lag, -delay)
+                pool.submit(self._replay, entry)
+        return lag
+
+    def _replay(self, entry):
+        url = f"{self.options['base_url'].rstrip('/')}{entry['p']}"
+        if entry["q"]:
+            url = f"{url}?{entry['q']}"
+        body = entry["body"]
+        if body and self.options["txid_suffix"]:
+            suffix = self.options["txid_suffix"].encode()
+            body = TXID.sub(lambda match: match.group(1) + suffix + b'"', body)
+        request = urllib.request.Request(url, data=body or None, method=entry["m"])
+        for header, key in (("Accept", "a"), ("Content-Type", "c")):
+            if entry.get(key):
+                request.add_header(header, entry[key])
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(
+                request, timeout=self.options["timeout"]
+            ) as response:
+                response.read()
+                status = response.status
+        except urllib.error.HTTPError as error:
+            status = error.code
+        except (urllib.error.URLError, OSError) as error:
+            status = f"error: {getattr(error, 'reason', error)}"
+        latency = time.perf_counter() - started
+        with self.lock:
+            self.latencies[endpoint(entry)].append(latency)
+            if status != entry["s"]:
+                self.differences.append((entry, status))
+
+    def _report(self, count, elapsed, lag):
+        self.stdout.write(
+            f"Replayed {count} requests in {elapsed:.2f}s "
+            f"({count / elapsed:.1f}/s), max schedule lag {lag * 1e3:.0f}ms"
+        )
+        self.stdout.write(
+            f"{'endpoint':<40} {'count':>6} {'p50':>8} {'p90':>8} "
+            f"{'p99':>8} {'max':>8}"
+        )
+        for name in sorted(self.latencies):
+            values = np.array(self.latencies[name]) * 1e3
+            p50, p90, p99 = np.percentile(values, [50, 90, 99])
+            self.stdout.write(
+                f"{name:<40} {len(values):>6} {p50:>6.1f}ms {p90:>6.1f}ms "
+                f"{p99:>6.1f}ms {values.max():>6.1f}ms"
+            )
+        if not self.differences:
+            self.stdout.write("No status differences.")
+            return
+        self.stdout.write(f"{len(self.differences)} status differences:")
+        changes = Counter(
+            (endpoint(entry), entry["s"], status) for entry, status in self.differences
+        )
+        for (name, recorded, replayed), number in changes.most_common():
+            self.stdout.write(f"  {name}: {recorded} -> {replayed} ({number} requests)")
@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.exceptions import ValidationError
+
+from transaction.netting import Batch, settle
+from transaction.utils import read_records
+
+
+class Command(BaseCommand):
+    help = (
+        "Settle a batch of transfers from a CSV or NDJSON file with `source`, "
+        "`target`, `amount` and `txid` columns. Balances move by each wallet's "
+        "net position, every leg is still recorded as a debit and a credit "
+        "transaction. The batch is applied atomically or not at all."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument("--format", choices=("csv", "ndjson"), default=None)
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        try:
+            batch = Batch.from_records(read_records(options["path"], options["format"]))
+            summary = settle(batch)
+        except ValidationError as error:
+            raise CommandError(error.detail)
+        self.stdout.write(
+            f"Settled {summary['legs']} legs between {summary['wallets']} wallets "
+            f"in {time.monotonic() - started:.2f}s: gross {summary['gross']}, "
+            f"net {summary['net']}."
+        )
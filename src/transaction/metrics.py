@@ -0,0 +1,87 @@
+import threading
+from collections import defaultdict
+
+from django.http import HttpResponse
+
+# Minimal Prometheus text exposition of in-process counters and gauges,
+# scraped per worker from /api/metrics/.
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_registry = {}
+_lock = threading.Lock()
+
+
+class Metric:
+    def __init__(self, name, documentation, kind, callback=None):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        # Gauges with a callback are computed at scrape time, the callback
+        # returns a value or a {labels tuple: value} dict.
+        self.callback = callback
+        self._lock = threading.Lock()
+        self._values = defaultdict(float)
+
+    def inc(self, amount=1, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] += amount
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def samples(self):
+        if self.callback is not None:
+            values = self.callback()
+            if not isinstance(values, dict):
+                values = {(): values}
+            return values.items()
+        with self._lock:
+            return list(self._values.items())
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for labels, value in sorted(self.samples()):
+            label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+            label_text = f"{{{label_text}}}" if label_text else ""
+            lines.append(f"{self.name}{label_text} {format_value(value)}")
+        return "\n".join(lines)
+
+
+def format_value(value):
+    # Exact, counters past a million must not lose digits to exponents.
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _register(name, documentation, kind, callback=None):
+    with _lock:
+        if name not in _registry:
+            _registry[name] = Metric(name, documentation, kind, callback)
+        return _registry[name]
+
+
+def counter(name, documentation):
+    return _register(name, documentation, "counter")
+
+
+def gauge(name, documentation, callback=None):
+    return _register(name, documentation, "gauge", callback)
+
+
+def render():
+    with _lock:
+        metrics = list(_registry.values())
+    return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+def metrics_view(request):
+    return HttpResponse(render(), content_type=CONTENT_TYPE)
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.14 on 2026-10-19 17:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("transaction", "0003_alter_transaction_txid_alter_wallet_balance_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="wallet",
+            name="version",
+            field=models.PositiveBigIntegerField(default=0, verbose_name="version"),
+        ),
+    ]
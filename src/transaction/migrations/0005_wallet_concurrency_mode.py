@@ -0,0 +1,27 @@
+# Generated by Django 4.2.14 on 2026-10-19 17:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("transaction", "0004_wallet_version"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="wallet",
+            name="concurrency_mode",
+            field=models.CharField(
+                choices=[
+                    ("pessimistic", "Pessimistic (row lock)"),
+                    ("optimistic", "Optimistic (compare-and-swap on version)"),
+                    ("auto", "Automatic (by observed conflict rate)"),
+                ],
+                default="pessimistic",
+                max_length=16,
+                verbose_name="concurrency mode",
+            ),
+        ),
+    ]
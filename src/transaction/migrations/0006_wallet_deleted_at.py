@@ -0,0 +1,20 @@
+# Generated by Django 4.2.14 on 2026-10-19 17:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("transaction", "0005_wallet_concurrency_mode"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="wallet",
+            name="deleted_at",
+            field=models.DateTimeField(
+                blank=True, db_index=True, null=True, verbose_name="deleted at"
+            ),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 4.2.14 on 2026-10-19 17:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("transaction", "0006_wallet_deleted_at"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="transaction",
+            index=models.Index(
+                fields=["wallet", "amount", "id"], name="transaction_wallet_amount_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="transaction",
+            index=models.Index(
+                fields=["amount", "id"], name="transaction_amount_id_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="wallet",
+            index=models.Index(
+                fields=["deleted_at", "balance", "id"], name="wallet_balance_id_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="wallet",
+            index=models.Index(
+                fields=["deleted_at", "label", "id"], name="wallet_label_id_idx"
+            ),
+        ),
+        # The single column indexes are covered by the composite ones above and
+        # are dropped only once those exist.
+        migrations.AlterField(
+            model_name="wallet",
+            name="deleted_at",
+            field=models.DateTimeField(
+                blank=True, null=True, verbose_name="deleted at"
+            ),
+        ),
+        migrations.AlterField(
+            model_name="wallet",
+            name="label",
+            field=models.CharField(max_length=255, verbose_name="label"),
+        ),
+    ]
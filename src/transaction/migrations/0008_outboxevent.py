@@ -0,0 +1,38 @@
+# Generated by Django 4.2.14 on 2026-10-19 17:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("transaction", "0007_composite_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="OutboxEvent",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("topic", models.CharField(max_length=32, verbose_name="topic")),
+                ("wallet_id", models.BigIntegerField(verbose_name="wallet id")),
+                ("payload", models.JSONField(verbose_name="payload")),
+                (
+                    "created_at",
+                    models.DateTimeField(auto_now_add=True, verbose_name="created at"),
+                ),
+            ],
+            options={
+                "verbose_name": "Outbox event",
+                "verbose_name_plural": "Outbox events",
+            },
+        ),
+    ]
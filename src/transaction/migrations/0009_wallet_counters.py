@@ -0,0 +1,43 @@
+# Generated by Django 4.2.14 on 2026-10-19 17:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("transaction", "0008_outboxevent"),
+    ]
+
+    # Existing wallets start from 0, backfill them in chunks with
+    # `manage.py rebuild_wallet_counters` after migrating.
+    operations = [
+        migrations.AddField(
+            model_name="wallet",
+            name="last_activity_at",
+            field=models.DateTimeField(
+                blank=True, null=True, verbose_name="last activity at"
+            ),
+        ),
+        migrations.AddField(
+            model_name="wallet",
+            name="transactions_count",
+            field=models.PositiveBigIntegerField(
+                default=0, verbose_name="transactions count"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="wallet",
+            index=models.Index(
+                fields=["deleted_at", "transactions_count", "id"],
+                name="wallet_tx_count_id_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="wallet",
+            index=models.Index(
+                fields=["deleted_at", "last_activity_at", "id"],
+                name="wallet_activity_id_idx",
+            ),
+        ),
+    ]
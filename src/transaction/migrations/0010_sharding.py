@@ -0,0 +1,129 @@
+# Generated by Django 4.2.14 on 2026-10-19 17:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("transaction", "0009_wallet_counters"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="IdSequence",
+            fields=[
+                (
+                    "name",
+                    models.CharField(
+                        max_length=64,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="name",
+                    ),
+                ),
+                (
+                    "next_value",
+                    models.BigIntegerField(default=1, verbose_name="next value"),
+                ),
+            ],
+            options={
+                "verbose_name": "Id sequence",
+                "verbose_name_plural": "Id sequences",
+            },
+        ),
+        migrations.CreateModel(
+            name="PreparedTransfer",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("intent_id", models.BigIntegerField(verbose_name="intent id")),
+                ("wallet_id", models.BigIntegerField(verbose_name="wallet id")),
+                (
+                    "role",
+                    models.CharField(
+                        choices=[("debit", "Debit"), ("credit", "Credit")],
+                        max_length=8,
+                        verbose_name="role",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Prepared transfer",
+                "verbose_name_plural": "Prepared transfers",
+            },
+        ),
+        migrations.CreateModel(
+            name="TransferIntent",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "source_wallet_id",
+                    models.BigIntegerField(verbose_name="source wallet id"),
+                ),
+                (
+                    "target_wallet_id",
+                    models.BigIntegerField(verbose_name="target wallet id"),
+                ),
+                (
+                    "amount",
+                    models.DecimalField(
+                        decimal_places=0, max_digits=18, verbose_name="amount"
+                    ),
+                ),
+                (
+                    "txid",
+                    models.CharField(max_length=255, unique=True, verbose_name="txid"),
+                ),
+                (
+                    "state",
+                    models.CharField(
+                        choices=[
+                            ("preparing", "Preparing"),
+                            ("committed", "Committed"),
+                            ("aborted", "Aborted"),
+                            ("done", "Done"),
+                            ("rolled_back", "Rolled back"),
+                        ],
+                        default="preparing",
+                        max_length=16,
+                        verbose_name="state",
+                    ),
+                ),
+                (
+                    "created_at",
+                    models.DateTimeField(auto_now_add=True, verbose_name="created at"),
+                ),
+            ],
+            options={
+                "verbose_name": "Transfer intent",
+                "verbose_name_plural": "Transfer intents",
+                "indexes": [
+                    models.Index(
+                        fields=["state", "created_at"], name="transferintent_state_idx"
+                    )
+                ],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="preparedtransfer",
+            constraint=models.UniqueConstraint(
+                fields=("intent_id", "role"), name="prepared_transfer_intent_role"
+            ),
+        ),
+    ]
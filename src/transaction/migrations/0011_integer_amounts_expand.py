@@ -0,0 +1,76 @@
+# Generated by Django 4.2.14 on 2026-10-19 18:40
+
+from django.db import migrations, models
+
+from transaction.utils import copy_column
+
+BATCH_SIZE = 10000
+
+# Until the contract migration of a later release, MySQL copies the decimal
+# columns written by the previous release into the integer ones. The current
+# release writes both columns itself, so the triggers only act when the
+# decimal column changed.
+TRIGGERS = (
+    ("transaction_wallet", "balance", "balance_minor"),
+    ("transaction_transaction", "amount", "amount_minor"),
+)
+
+
+def create_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor != "mysql":
+        return
+    for table, source, target in TRIGGERS:
+        schema_editor.execute(
+            f"CREATE TRIGGER {table}_{target}_insert BEFORE INSERT ON {table} "
+            f"FOR EACH ROW SET NEW.{target} = COALESCE(NEW.{target}, NEW.{source})"
+        )
+        schema_editor.execute(
+            f"CREATE TRIGGER {table}_{target}_update BEFORE UPDATE ON {table} "
+            f"FOR EACH ROW SET NEW.{target} = "
+            f"IF(NEW.{source} <=> OLD.{source}, NEW.{target}, NEW.{source})"
+        )
+
+
+def drop_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor != "mysql":
+        return
+    for table, _, target in TRIGGERS:
+        for event in ("insert", "update"):
+            schema_editor.execute(f"DROP TRIGGER IF EXISTS {table}_{target}_{event}")
+
+
+def backfill(apps, schema_editor):
+    using = schema_editor.connection.alias
+    for model_name, source, target in (
+        ("Wallet", "balance", "balance_minor"),
+        ("Transaction", "amount", "amount_minor"),
+    ):
+        queryset = apps.get_model("transaction", model_name)._base_manager.using(using)
+        copy_column(queryset, source, target, BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+    # First step of the switch to integer amounts: the new columns are added
+    # and backfilled while the previous release keeps running. Batches commit
+    # one by one, rows the previous release changes meanwhile are copied by
+    # the triggers on MySQL and again by 0012 elsewhere.
+    atomic = False
+
+    dependencies = [
+        ("transaction", "0010_sharding"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="wallet",
+            name="balance_minor",
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name="transaction",
+            name="amount_minor",
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.RunPython(create_triggers, drop_triggers),
+        migrations.RunPython(backfill, migrations.RunPython.noop, elidable=True),
+    ]
@@ -0,0 +1,196 @@
+# Generated by Django 4.2.14 on 2026-10-19 18:40
+
+import django.core.validators
+from django.db import migrations, models
+
+from transaction.utils import copy_column
+
+BATCH_SIZE = 10000
+
+
+def sync(apps, schema_editor):
+    # Catches up with rows written since 0011 on backends without the
+    # triggers of 0011, only those are updated.
+    using = schema_editor.connection.alias
+    for model_name, source, target in (
+        ("Wallet", "balance", "balance_minor"),
+        ("Transaction", "amount", "amount_minor"),
+    ):
+        queryset = apps.get_model("transaction", model_name)._base_manager.using(using)
+        copy_column(queryset, source, target, BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+    # Second step, applied together with the release reading the integer
+    # columns: the model fields move to the integer columns, which keep their
+    # names, and the decimal columns stay as legacy fields the release keeps
+    # writing for instances of the previous release. No column is dropped or
+    # renamed, a later release drops the decimal ones once none writes them.
+
+    dependencies = [
+        ("transaction", "0011_integer_amounts_expand"),
+    ]
+
+    operations = [
+        migrations.RunPython(sync, migrations.RunPython.noop, elidable=True),
+        migrations.RenameIndex(
+            model_name="wallet",
+            new_name="wallet_legacy_balance_idx",
+            old_name="wallet_balance_id_idx",
+        ),
+        migrations.RenameIndex(
+            model_name="transaction",
+            new_name="transaction_wallet_legacy_idx",
+            old_name="transaction_wallet_amount_idx",
+        ),
+        migrations.RenameIndex(
+            model_name="transaction",
+            new_name="transaction_legacy_amount_idx",
+            old_name="transaction_amount_id_idx",
+        ),
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.RemoveIndex(
+                    model_name="wallet",
+                    name="wallet_legacy_balance_idx",
+                ),
+                migrations.RemoveIndex(
+                    model_name="transaction",
+                    name="transaction_wallet_legacy_idx",
+                ),
+                migrations.RemoveIndex(
+                    model_name="transaction",
+                    name="transaction_legacy_amount_idx",
+                ),
+                migrations.RenameField(
+                    model_name="wallet",
+                    old_name="balance",
+                    new_name="legacy_balance",
+                ),
+                migrations.AlterField(
+                    model_name="wallet",
+                    name="legacy_balance",
+                    field=models.DecimalField(
+                        db_column="balance", decimal_places=0, max_digits=18
+                    ),
+                ),
+                migrations.RenameField(
+                    model_name="wallet",
+                    old_name="balance_minor",
+                    new_name="balance",
+                ),
+                migrations.AlterField(
+                    model_name="wallet",
+                    name="balance",
+                    field=models.BigIntegerField(db_column="balance_minor", null=True),
+                ),
+                migrations.RenameField(
+                    model_name="transaction",
+                    old_name="amount",
+                    new_name="legacy_amount",
+                ),
+                migrations.AlterField(
+                    model_name="transaction",
+                    name="legacy_amount",
+                    field=models.DecimalField(
+                        db_column="amount", decimal_places=0, max_digits=18
+                    ),
+                ),
+                migrations.RenameField(
+                    model_name="transaction",
+                    old_name="amount_minor",
+                    new_name="amount",
+                ),
+                migrations.AlterField(
+                    model_name="transaction",
+                    name="amount",
+                    field=models.BigIntegerField(db_column="amount_minor", null=True),
+                ),
+                migrations.AddIndex(
+                    model_name="wallet",
+                    index=models.Index(
+                        fields=["deleted_at", "legacy_balance", "id"],
+                        name="wallet_legacy_balance_idx",
+                    ),
+                ),
+                migrations.AddIndex(
+                    model_name="transaction",
+                    index=models.Index(
+                        fields=["wallet", "legacy_amount", "id"],
+                        name="transaction_wallet_legacy_idx",
+                    ),
+                ),
+                migrations.AddIndex(
+                    model_name="transaction",
+                    index=models.Index(
+                        fields=["legacy_amount", "id"],
+                        name="transaction_legacy_amount_idx",
+                    ),
+                ),
+            ],
+        ),
+        # A later release stops writing the decimal columns before dropping
+        # them, so they must accept rows without a value.
+        migrations.AlterField(
+            model_name="wallet",
+            name="legacy_balance",
+            field=models.DecimalField(
+                db_column="balance",
+                decimal_places=0,
+                editable=False,
+                max_digits=18,
+                null=True,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="transaction",
+            name="legacy_amount",
+            field=models.DecimalField(
+                db_column="amount",
+                decimal_places=0,
+                editable=False,
+                max_digits=18,
+                null=True,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="wallet",
+            name="balance",
+            field=models.BigIntegerField(
+                db_column="balance_minor",
+                default=0,
+                validators=[django.core.validators.MinValueValidator(0)],
+                verbose_name="balance",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="transaction",
+            name="amount",
+            field=models.BigIntegerField(
+                db_column="amount_minor", verbose_name="transaction's amount"
+            ),
+        ),
+        migrations.AlterField(
+            model_name="transferintent",
+            name="amount",
+            field=models.BigIntegerField(verbose_name="amount"),
+        ),
+        migrations.AddIndex(
+            model_name="wallet",
+            index=models.Index(
+                fields=["deleted_at", "balance", "id"], name="wallet_balance_id_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="transaction",
+            index=models.Index(
+                fields=["wallet", "amount", "id"], name="transaction_wallet_amount_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="transaction",
+            index=models.Index(
+                fields=["amount", "id"], name="transaction_amount_id_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,86 @@
+# Generated by Django 4.2.14 on 2026-10-19 18:08
+
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("transaction", "0012_integer_amounts_switch"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="wallet",
+            name="held",
+            field=models.BigIntegerField(
+                default=0,
+                validators=[django.core.validators.MinValueValidator(0)],
+                verbose_name="held balance",
+            ),
+        ),
+        migrations.CreateModel(
+            name="Hold",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("amount", models.BigIntegerField(verbose_name="amount")),
+                (
+                    "txid",
+                    models.CharField(max_length=255, unique=True, verbose_name="txid"),
+                ),
+                (
+                    "state",
+                    models.CharField(
+                        choices=[
+                            ("authorized", "Authorized"),
+                            ("captured", "Captured"),
+                            ("voided", "Voided"),
+                            ("expired", "Expired"),
+                        ],
+                        default="authorized",
+                        max_length=16,
+                        verbose_name="state",
+                    ),
+                ),
+                (
+                    "captured_amount",
+                    models.BigIntegerField(
+                        blank=True, null=True, verbose_name="captured amount"
+                    ),
+                ),
+                (
+                    "created_at",
+                    models.DateTimeField(auto_now_add=True, verbose_name="created at"),
+                ),
+                ("expires_at", models.DateTimeField(verbose_name="expires at")),
+                (
+                    "wallet",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="holds",
+                        to="transaction.wallet",
+                        verbose_name="wallet",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Hold",
+                "verbose_name_plural": "Holds",
+                "indexes": [
+                    models.Index(
+                        fields=["state", "expires_at"], name="hold_state_expires_idx"
+                    )
+                ],
+            },
+        ),
+    ]
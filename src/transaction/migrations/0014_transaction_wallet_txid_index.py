@@ -0,0 +1,19 @@
+# Generated by Django 4.2.14 on 2026-10-19 18:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("transaction", "0013_holds"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="transaction",
+            index=models.Index(
+                fields=["wallet", "txid"], name="transaction_wallet_txid_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.14 on 2026-10-19 18:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("transaction", "0014_transaction_wallet_txid_index"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TxidClaim",
+            fields=[
+                (
+                    "txid",
+                    models.CharField(
+                        max_length=255,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="txid",
+                    ),
+                ),
+                ("wallet_id", models.BigIntegerField(verbose_name="wallet id")),
+                ("claimed_at", models.DateTimeField(verbose_name="claimed at")),
+            ],
+            options={
+                "verbose_name": "Txid claim",
+                "verbose_name_plural": "Txid claims",
+            },
+        ),
+    ]
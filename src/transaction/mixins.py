@@ -0,0 +1,121 @@
+from django.http import Http404
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+from rest_framework_json_api.utils import get_resource_type_from_model
+
+from . import response_cache, statement_budgets
+from .exceptions import StatementTimeoutError
+from .sharding import decode_cursor, fan_out, is_sharded, shard_for
+
+
+class SparseFieldsetsQuerysetMixin:
+    # Pushes JSON:API sparse fieldsets (`fields[Wallet]=balance`) down to the
+    # queryset, so only the requested columns are selected on reads.
+    # `loaded_fields` are selected either way.
+    loaded_fields = ()
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action not in ("list", "retrieve"):
+            return queryset
+        model = queryset.model
+        requested = self.request.query_params.get(
+            f"fields[{get_resource_type_from_model(model)}]"
+        )
+        if requested is None:
+            return queryset
+        columns = set(self.loaded_fields)
+        for field in model._meta.concrete_fields:
+            # Foreign keys are always loaded, the renderer reads them for
+            # relationships even when they are not requested.
+            if field.name in requested.split(",") or field.is_relation:
+                columns.add(field.name)
+        return queryset.only(*columns)
+
+
+class ShardedViewSetMixin:
+    # With several WALLET_SHARDS, detail routes read the shard of their pk
+    # and lists fan out to every shard with keyset (cursor) pagination, as
+    # page numbers cannot be merged across shards.
+    cursor_query_param = "page[cursor]"
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        pk = self.kwargs.get("pk")
+        if pk is None or not is_sharded():
+            return queryset
+        try:
+            return queryset.using(shard_for(pk))
+        except ValueError:
+            raise Http404
+
+    def paginate_queryset(self, queryset):
+        if not is_sharded():
+            return super().paginate_queryset(queryset)
+        ordering = [
+            name.replace("pk", "id") if name.lstrip("-") == "pk" else name
+            for name in queryset.query.order_by
+        ]
+        if not {"id", "-id"} & set(ordering):
+            ordering.append("id")
+        cursor = self.request.query_params.get(self.cursor_query_param)
+        rows, self._next_cursor = fan_out(
+            queryset,
+            ordering,
+            self.paginator.get_page_size(self.request),
+            decode_cursor(cursor) if cursor else None,
+        )
+        return rows
+
+    def get_paginated_response(self, data):
+        if not is_sharded():
+            return super().get_paginated_response(data)
+        next_link = None
+        if self._next_cursor is not None:
+            next_link = replace_query_param(
+                self.request.build_absolute_uri(),
+                self.cursor_query_param,
+                self._next_cursor,
+            )
+        return Response({"results": data, "links": {"next": next_link}})
+
+
+class ResponseCacheMixin:
+    # list() helpers for the response cache. The key, and so the generations,
+    # are read before the list is queried: a write committed in between leaves
+    # the page cached under generations that are already outdated.
+    # Lists filtered on `cache_wallet_filter` only depend on that wallet.
+    cache_wallet_filter = None
+
+    def get_cached_list(self, request):
+        wallet_id = None
+        if self.cache_wallet_filter:
+            values = set(request.query_params.getlist(self.cache_wallet_filter))
+            if len(values) == 1 and next(iter(values)).isdigit():
+                wallet_id = int(values.pop())
+        self._response_cache_key = response_cache.make_key(request, wallet_id)
+        return response_cache.lookup(request, self._response_cache_key)
+
+    def cache_list(self, response):
+        return response_cache.store(self._response_cache_key, response)
+
+
+class StatementBudgetMixin:
+    # Runs GET actions under the budget of "<basename>.<action>" and answers
+    # statements cut off by it with a 400 suggesting a narrower request.
+
+    def dispatch(self, request, *args, **kwargs):
+        self.statement_budget = None
+        if request.method == "GET":
+            action = self.action_map.get("get")
+            self.statement_budget = statement_budgets.get_budget(
+                f"{self.basename}.{action}"
+            )
+        with statement_budgets.statement_budget(self.statement_budget):
+            return super().dispatch(request, *args, **kwargs)
+
+    def handle_exception(self, exc):
+        if self.statement_budget is not None and statement_budgets.is_timeout(exc):
+            statement_budgets.CUT_OFF.inc(endpoint=f"{self.basename}.{self.action}")
+            exc = StatementTimeoutError()
+        return super().handle_exception(exc)
@@ -1,54 +1,341 @@
-from decimal import Decimal
-from django.db import models, transaction
+from django.db import models, router, transaction
 from django.core.validators import MinValueValidator
+from django.utils import timezone
 
+from .concurrency import (
+    CONCURRENCY_MODES,
+    OPTIMISTIC,
+    PESSIMISTIC,
+    backoff,
+    get_setting,
+    lock_rows,
+    resolve_mode,
+    tracker,
+)
+from .events import publish_on_commit
 from .exceptions import InsufficientFundsError
+from .response_cache import invalidate_on_commit
+from .sharding import allocator, claim_txids, is_sharded
 from .utils import make_transaction, reverse_transaction
 
 
-class Wallet(models.Model):
-    label = models.CharField(max_length=255, verbose_name="label", db_index=True)
-    balance = models.DecimalField(
-        max_digits=18,
-        decimal_places=0,
+def record_event(using, topic, wallet_id, **data):
+    # The outbox row commits or rolls back together with the change itself,
+    # subscribers of the live feed are only notified after the commit.
+    OutboxEvent.objects.using(using).create(
+        topic=topic, wallet_id=wallet_id, payload=data
+    )
+    publish_on_commit(topic, wallet_id, using=using, **data)
+    invalidate_on_commit([wallet_id], using=using)
+
+
+def record_events(using, events, batch_size=None):
+    # Bulk counterpart of record_event for the bulk writers: one insert of
+    # the outbox rows, published and invalidated once they commit.
+    events = list(events)
+    OutboxEvent.objects.using(using).bulk_create(events, batch_size=batch_size)
+    for event in events:
+        publish_on_commit(event.topic, event.wallet_id, using=using, **event.payload)
+    invalidate_on_commit({event.wallet_id for event in events}, using=using)
+
+
+class DualWriteQuerySet(models.QuerySet):
+    # Until the contract release, every write of an amount also fills the
+    # decimal column the previous release reads, see the model's
+    # legacy_fields.
+    # bulk_update goes through update.
+
+    def update(self, **kwargs):
+        # The legacy assignments come first: MySQL evaluates SET left to
+        # right, so expressions still see the old integer value.
+        legacy = {
+            self.model.legacy_fields[name]: value
+            for name, value in kwargs.items()
+            if name in self.model.legacy_fields
+        }
+        return super().update(**{**legacy, **kwargs})
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for obj in objs:
+            obj._mirror_legacy()
+        return super().bulk_create(objs, *args, **kwargs)
+
+
+class LegacyAmountMixin:
+    # Model side of DualWriteQuerySet.
+    legacy_fields = {}
+
+    @classmethod
+    def _legacy_update_fields(cls, fields):
+        return [cls.legacy_fields[name] for name in fields if name in cls.legacy_fields]
+
+    def _mirror_legacy(self, kwargs=None):
+        for name, legacy in self.legacy_fields.items():
+            setattr(self, legacy, getattr(self, name))
+        if kwargs and kwargs.get("update_fields") is not None:
+            fields = list(kwargs["update_fields"])
+            kwargs["update_fields"] = fields + self._legacy_update_fields(fields)
+
+
+class WalletQuerySet(DualWriteQuerySet):
+    def soft_delete(self):
+        # Hides the wallets until purge_wallets removes them and their
+        # transactions in bounded batches, instead of one cascading delete.
+        ids = list(self.values_list("id", flat=True))
+        return self.model.all_objects.using(self.db)._soft_delete(ids)
+
+    def _soft_delete(self, ids):
+        updated = self.filter(id__in=ids, deleted_at__isnull=True).update(
+            deleted_at=timezone.now(), version=models.F("version") + 1
+        )
+        invalidate_on_commit(ids, using=self.db)
+        return updated
+
+
+class WalletManager(models.Manager.from_queryset(WalletQuerySet)):
+    # Hides soft-deleted wallets until purge_wallets removes them.
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at__isnull=True)
+
+
+class Wallet(LegacyAmountMixin, models.Model):
+    label = models.CharField(max_length=255, verbose_name="label")
+    # Amounts are whole minor units stored as 64-bit integers.
+    balance = models.BigIntegerField(
         verbose_name="balance",
         default=0,
-        validators=[MinValueValidator(Decimal("0"))],
+        validators=[MinValueValidator(0)],
+        db_column="balance_minor",
     )  # default=0 for the wallet creation.
+    # Decimal column read by the release before integer amounts, written
+    # alongside balance until the contract release drops it.
+    legacy_balance = models.DecimalField(
+        max_digits=18,
+        decimal_places=0,
+        null=True,
+        editable=False,
+        db_column="balance",
+    )
+    # Bumped on every balance or label change, used for ETags.
+    version = models.PositiveBigIntegerField(verbose_name="version", default=0)
+    concurrency_mode = models.CharField(
+        max_length=16,
+        choices=CONCURRENCY_MODES,
+        default=PESSIMISTIC,
+        verbose_name="concurrency mode",
+    )
+    deleted_at = models.DateTimeField(null=True, blank=True, verbose_name="deleted at")
+    # Kept up to date by every balance change, so wallet lists need no
+    # COUNT over transactions. Rebuilt by the rebuild_wallet_counters command.
+    transactions_count = models.PositiveBigIntegerField(
+        default=0, verbose_name="transactions count"
+    )
+    last_activity_at = models.DateTimeField(
+        null=True, blank=True, verbose_name="last activity at"
+    )
+    # Part of the balance reserved by authorized holds, see holds.py.
+    # Withdrawals can only spend balance - held.
+    held = models.BigIntegerField(
+        default=0, validators=[MinValueValidator(0)], verbose_name="held balance"
+    )
+
+    objects = WalletManager()
+    all_objects = models.Manager.from_queryset(WalletQuerySet)()
+
+    legacy_fields = {"balance": "legacy_balance"}
 
     class Meta:
         verbose_name = "Wallet"
         verbose_name_plural = "Wallets"
+        # Composite indexes for the filter/ordering combinations of WalletViewSet,
+        # checked by the audit_query_plans command. They lead with deleted_at
+        # because WalletManager adds "deleted_at IS NULL" to every query.
+        indexes = [
+            models.Index(
+                fields=["deleted_at", "balance", "id"], name="wallet_balance_id_idx"
+            ),
+            models.Index(
+                fields=["deleted_at", "label", "id"], name="wallet_label_id_idx"
+            ),
+            models.Index(
+                fields=["deleted_at", "transactions_count", "id"],
+                name="wallet_tx_count_id_idx",
+            ),
+            models.Index(
+                fields=["deleted_at", "last_activity_at", "id"],
+                name="wallet_activity_id_idx",
+            ),
+            # Serves the previous release's orderings until the contract.
+            models.Index(
+                fields=["deleted_at", "legacy_balance", "id"],
+                name="wallet_legacy_balance_idx",
+            ),
+        ]
 
     def __str__(self):
         return f"{self.label}: {self.balance}"
 
+    def save(self, *args, **kwargs):
+        if is_sharded():
+            if self.pk is None:
+                self.pk = allocator.wallet_id()
+                kwargs["force_insert"] = True
+            # The id decides the shard, whatever manager created the wallet.
+            kwargs["using"] = self._db
+        self._mirror_legacy(kwargs)
+        super().save(*args, **kwargs)
+        # Creations and label edits do not go through record_event.
+        invalidate_on_commit([self.pk], using=kwargs.get("using") or self._db)
+
+    @property
+    def _db(self):
+        # The wallet's shard, or the only database when not sharded.
+        return router.db_for_write(self.__class__, instance=self)
+
     def _get_object(self):
-        return self.__class__.objects.filter(id=self.id).select_for_update().get()
+        return lock_rows(
+            self.__class__.objects.using(self._db).filter(id=self.id),
+            models.QuerySet.get,
+        )
 
-    @transaction.atomic()
-    def deposit(self, amount):
-        obj = self._get_object()
-        obj.balance += amount
-        obj.save()
+    def soft_delete(self):
+        return Wallet.all_objects.using(self._state.db)._soft_delete([self.pk])
+
+    def deposit(self, amount, transactions=0):
+        with transaction.atomic(using=self._db):
+            self._change_balance(amount, transactions=transactions)
 
-    @transaction.atomic()
-    def withdraw(self, amount):
+    def withdraw(self, amount, transactions=0):
         # Checks if wallet's balance is higher than transaction amount.
         # If negative returns 400 http status code.
-        obj = self._get_object()
         if amount > 0:
             amount = -amount
-        if obj.balance + amount < 0:
+        with transaction.atomic(using=self._db):
+            self._change_balance(amount, check_funds=True, transactions=transactions)
+
+    def _change_balance(self, amount, check_funds=False, transactions=0):
+        if resolve_mode(self) == OPTIMISTIC and self._compare_and_swap(
+            amount, check_funds, transactions
+        ):
+            return
+        obj = self._get_object()
+        if check_funds:
+            self._check_funds(obj.balance - obj.held, amount)
+        obj.balance += amount
+        obj.version += 1
+        obj.transactions_count += transactions
+        obj.last_activity_at = timezone.now()
+        obj.save(
+            update_fields=[
+                "balance",
+                "version",
+                "transactions_count",
+                "last_activity_at",
+            ]
+        )
+        self._balance_changed(obj.balance, obj.version, amount)
+
+    def _compare_and_swap(self, amount, check_funds, transactions):
+        # Django runs MySQL in READ COMMITTED, so every attempt re-reads the
+        # latest committed row even inside an outer transaction.
+        # Returns False once retries are exhausted, falling back to the row lock.
+        queryset = self.__class__.objects.using(self._db).filter(id=self.id)
+        for attempt in range(get_setting("MAX_RETRIES")):
+            balance, held, version = queryset.values_list(
+                "balance", "held", "version"
+            ).get()
+            if check_funds:
+                self._check_funds(balance - held, amount)
+            updated = queryset.filter(version=version).update(
+                balance=balance + amount,
+                version=version + 1,
+                transactions_count=models.F("transactions_count") + transactions,
+                last_activity_at=timezone.now(),
+            )
+            tracker.record(self.id, conflicted=not updated)
+            if updated:
+                self._balance_changed(balance + amount, version + 1, amount)
+                return True
+            backoff(attempt)
+        return False
+
+    def _balance_changed(self, balance, version, amount):
+        record_event(
+            self._db,
+            "balance",
+            self.id,
+            **self._balance_event(balance, version, amount),
+        )
+
+    @staticmethod
+    def _balance_event(balance, version, amount):
+        return {"balance": balance, "version": version, "amount": amount}
+
+    @staticmethod
+    def _check_funds(available, amount):
+        if available + amount < 0:
             raise InsufficientFundsError(
                 "Your wallet's balance is less than transaction's amount."
             )
-        obj = self._get_object()
-        obj.balance += amount
-        obj.save()
 
 
-class Transaction(models.Model):
+class TransactionQuerySet(DualWriteQuerySet):
+    def bulk_reverse(self):
+        # Reverses every matching transaction with one locked balance update
+        # per wallet instead of one per row. Returns
+        # {wallet_id: (net amount, transactions reversed)}.
+        with transaction.atomic(using=self.db):
+            return self._bulk_reverse()
+
+    def _bulk_reverse(self):
+        wallets = lock_rows(
+            Wallet.objects.using(self.db)
+            .filter(id__in=self.values("wallet_id"))
+            .order_by("id")
+        )
+        wallets = {wallet.id: wallet for wallet in wallets}
+        # Only rows of locked wallets are touched, anything matching the
+        # filters after the lock was taken is left alone.
+        queryset = self.filter(wallet_id__in=list(wallets))
+        totals = {}
+        now = timezone.now()
+        for wallet_id, total, count in (
+            queryset.order_by()
+            .values("wallet_id")
+            .annotate(total=models.Sum("amount"), count=models.Count("id"))
+            .values_list("wallet_id", "total", "count")
+        ):
+            wallet = wallets[wallet_id]
+            wallet._check_funds(wallet.balance - wallet.held, -total)
+            wallet.balance -= total
+            wallet.version += 1
+            wallet.transactions_count -= count
+            wallet.last_activity_at = now
+            wallet._balance_changed(wallet.balance, wallet.version, -total)
+            totals[wallet_id] = (total, count)
+        Wallet.objects.using(self.db).bulk_update(
+            [wallets[wallet_id] for wallet_id in totals],
+            ["balance", "version", "transactions_count", "last_activity_at"],
+        )
+        record_events(
+            self.db,
+            [
+                OutboxEvent(
+                    topic="transaction",
+                    wallet_id=wallet_id,
+                    payload=Transaction._event("deleted", pk, txid, amount),
+                )
+                for pk, wallet_id, txid, amount in queryset.values_list(
+                    "id", "wallet_id", "txid", "amount"
+                ).iterator()
+            ],
+        )
+        queryset.delete()
+        return totals
+
+
+class Transaction(LegacyAmountMixin, models.Model):
     wallet = models.ForeignKey(
         Wallet,
         on_delete=models.CASCADE,
@@ -58,22 +345,238 @@ class Transaction(models.Model):
     txid = models.CharField(
         max_length=255, unique=True, verbose_name="txid", db_index=True
     )
-    amount = models.DecimalField(
-        max_digits=18, decimal_places=0, verbose_name="transaction's amount"
+    amount = models.BigIntegerField(
+        verbose_name="transaction's amount", db_column="amount_minor"
     )
+    # Written alongside amount until the contract, see Wallet.legacy_balance.
+    legacy_amount = models.DecimalField(
+        max_digits=18,
+        decimal_places=0,
+        null=True,
+        editable=False,
+        db_column="amount",
+    )
+
+    objects = TransactionQuerySet.as_manager()
+
+    legacy_fields = {"amount": "legacy_amount"}
 
     class Meta:
         verbose_name = "Transaction"
         verbose_name_plural = "Transactions"
+        # Composite indexes for the filter/ordering combinations of
+        # TransactionViewSet, checked by the audit_query_plans command.
+        indexes = [
+            models.Index(
+                fields=["wallet", "amount", "id"], name="transaction_wallet_amount_idx"
+            ),
+            models.Index(fields=["amount", "id"], name="transaction_amount_id_idx"),
+            models.Index(fields=["wallet", "txid"], name="transaction_wallet_txid_idx"),
+            # Serve the previous release's orderings until the contract.
+            models.Index(
+                fields=["wallet", "legacy_amount", "id"],
+                name="transaction_wallet_legacy_idx",
+            ),
+            models.Index(
+                fields=["legacy_amount", "id"], name="transaction_legacy_amount_idx"
+            ),
+        ]
 
     def __str__(self):
         return self.txid
 
     def save(self, *args, **kwargs):
-        if not self.pk:  # only for database INSERT.
-            make_transaction(wallet=self.wallet, amount=self.amount)
-        super(Transaction, self).save(*args, **kwargs)
+        created = not self.pk
+        if is_sharded():
+            if created:
+                # Allocated before the transaction, see IdAllocator._reserve.
+                self.pk = allocator.transaction_id(self.wallet_id)
+                kwargs["force_insert"] = True
+                claim_txids({self.txid: self.wallet_id})
+            elif not self._txid_saved():
+                # A new txid is claimed like on insert, the old claim is taken
+                # over once the txid is gone from its shard.
+                claim_txids({self.txid: self.wallet_id})
+            kwargs["using"] = self._db
+        self._mirror_legacy(kwargs)
+        with transaction.atomic(using=kwargs.get("using") or self._db):
+            if created:  # only for database INSERT.
+                make_transaction(wallet=self.wallet, amount=self.amount, transactions=1)
+            super(Transaction, self).save(*args, **kwargs)
+            self._publish("created" if created else "updated")
 
     def delete(self, *args, **kwargs):
-        reverse_transaction(wallet=self.wallet, amount=self.amount)
-        super(Transaction, self).save(*args, **kwargs)
+        with transaction.atomic(using=kwargs.get("using") or self._db):
+            reverse_transaction(wallet=self.wallet, amount=self.amount)
+            self._publish("deleted")
+            return super(Transaction, self).delete(*args, **kwargs)
+
+    @property
+    def _db(self):
+        return router.db_for_write(self.__class__, instance=self)
+
+    def _txid_saved(self):
+        return (
+            Transaction.objects.using(self._db)
+            .filter(pk=self.pk, txid=self.txid)
+            .exists()
+        )
+
+    def _publish(self, action):
+        record_event(
+            self._db,
+            "transaction",
+            self.wallet_id,
+            **self._event(action, self.pk, self.txid, self.amount),
+        )
+
+    @staticmethod
+    def _event(action, pk, txid, amount):
+        return {"action": action, "id": pk, "txid": txid, "amount": amount}
+
+
+class OutboxEvent(models.Model):
+    # Transactional outbox of wallet and transaction changes, delivered to
+    # downstream consumers by the drain_outbox command.
+    topic = models.CharField(max_length=32, verbose_name="topic")
+    # Not a foreign key, events outlive wallets removed by purge_wallets.
+    wallet_id = models.BigIntegerField(verbose_name="wallet id")
+    payload = models.JSONField(verbose_name="payload")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="created at")
+
+    class Meta:
+        verbose_name = "Outbox event"
+        verbose_name_plural = "Outbox events"
+
+    def __str__(self):
+        return f"{self.topic} #{self.id}"
+
+
+class IdSequence(models.Model):
+    # Global id sequences of the sharded setup, kept on the coordinator.
+    name = models.CharField(max_length=64, primary_key=True, verbose_name="name")
+    next_value = models.BigIntegerField(default=1, verbose_name="next value")
+
+    class Meta:
+        verbose_name = "Id sequence"
+        verbose_name_plural = "Id sequences"
+
+
+class TxidClaim(models.Model):
+    # Txids of the sharded setup, kept on the coordinator: the unique index of
+    # a shard only covers its own transactions. See sharding.claim_txids.
+    txid = models.CharField(max_length=255, primary_key=True, verbose_name="txid")
+    wallet_id = models.BigIntegerField(verbose_name="wallet id")
+    claimed_at = models.DateTimeField(verbose_name="claimed at")
+
+    class Meta:
+        verbose_name = "Txid claim"
+        verbose_name_plural = "Txid claims"
+
+
+class TransferIntent(models.Model):
+    # Coordinator log of a transfer between wallets on different shards.
+    PREPARING = "preparing"
+    COMMITTED = "committed"
+    ABORTED = "aborted"
+    DONE = "done"
+    ROLLED_BACK = "rolled_back"
+    STATES = (
+        (PREPARING, "Preparing"),
+        (COMMITTED, "Committed"),
+        (ABORTED, "Aborted"),
+        (DONE, "Done"),
+        (ROLLED_BACK, "Rolled back"),
+    )
+
+    source_wallet_id = models.BigIntegerField(verbose_name="source wallet id")
+    target_wallet_id = models.BigIntegerField(verbose_name="target wallet id")
+    amount = models.BigIntegerField(verbose_name="amount")
+    txid = models.CharField(max_length=255, unique=True, verbose_name="txid")
+    state = models.CharField(
+        max_length=16, choices=STATES, default=PREPARING, verbose_name="state"
+    )
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="created at")
+
+    class Meta:
+        verbose_name = "Transfer intent"
+        verbose_name_plural = "Transfer intents"
+        indexes = [
+            models.Index(
+                fields=["state", "created_at"], name="transferintent_state_idx"
+            ),
+        ]
+
+
+class PreparedTransfer(models.Model):
+    # Participant side of a cross-shard transfer, written in the same
+    # shard transaction as the prepared change and deleted when it is
+    # committed or rolled back.
+    DEBIT = "debit"
+    CREDIT = "credit"
+    ROLES = ((DEBIT, "Debit"), (CREDIT, "Credit"))
+
+    intent_id = models.BigIntegerField(verbose_name="intent id")
+    wallet_id = models.BigIntegerField(verbose_name="wallet id")
+    role = models.CharField(max_length=8, choices=ROLES, verbose_name="role")
+
+    class Meta:
+        verbose_name = "Prepared transfer"
+        verbose_name_plural = "Prepared transfers"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["intent_id", "role"], name="prepared_transfer_intent_role"
+            ),
+        ]
+
+
+class Hold(models.Model):
+    # Funds reserved on a wallet by an authorization, captured into a
+    # transaction or released by a void or once expired.
+    AUTHORIZED = "authorized"
+    CAPTURED = "captured"
+    VOIDED = "voided"
+    EXPIRED = "expired"
+    STATES = (
+        (AUTHORIZED, "Authorized"),
+        (CAPTURED, "Captured"),
+        (VOIDED, "Voided"),
+        (EXPIRED, "Expired"),
+    )
+
+    wallet = models.ForeignKey(
+        Wallet,
+        on_delete=models.CASCADE,
+        related_name="holds",
+        verbose_name="wallet",
+    )
+    amount = models.BigIntegerField(verbose_name="amount")
+    # Also the txid of the transaction created by the capture.
+    txid = models.CharField(max_length=255, unique=True, verbose_name="txid")
+    state = models.CharField(
+        max_length=16, choices=STATES, default=AUTHORIZED, verbose_name="state"
+    )
+    captured_amount = models.BigIntegerField(
+        null=True, blank=True, verbose_name="captured amount"
+    )
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="created at")
+    expires_at = models.DateTimeField(verbose_name="expires at")
+
+    class Meta:
+        verbose_name = "Hold"
+        verbose_name_plural = "Holds"
+        indexes = [
+            # Sweep of expired holds by the expire_holds command.
+            models.Index(fields=["state", "expires_at"], name="hold_state_expires_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.txid}: {self.amount} {self.state}"
+
+    def save(self, *args, **kwargs):
+        if is_sharded():
+            if self.pk is None:
+                self.pk = allocator.transaction_id(self.wallet_id, "hold")
+                kwargs["force_insert"] = True
+            kwargs["using"] = router.db_for_write(self.__class__, instance=self)
+        super().save(*args, **kwargs)
@@ -0,0 +1,201 @@
+from decimal import Decimal, InvalidOperation
+
+import numpy as np
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from .concurrency import lock_rows
+from .exceptions import InsufficientFundsError
+from .models import OutboxEvent, Transaction, Wallet, record_events
+from .sharding import allocator, claim_txids, is_sharded, shard_for
+from .utils import chunked
+
+# Keeps "IN (...)" lookups below the bound-parameter limit of every backend.
+LOOKUP_BATCH_SIZE = 500
+INSERT_BATCH_SIZE = 5000
+
+# Multilateral netting of a settlement batch. Every leg moves `amount` from
+# `source` to `target` and is still recorded as a "<txid>:debit" and a
+# "<txid>:credit" transaction, like a transfer, but balances only move by each
+# wallet's net position: one locked update per wallet instead of two per leg.
+
+
+class Batch:
+    # Legs as parallel int64 arrays, plus their txids.
+
+    def __init__(self, sources, targets, amounts, txids):
+        self.sources = np.asarray(sources, dtype=np.int64)
+        self.targets = np.asarray(targets, dtype=np.int64)
+        self.amounts = np.asarray(amounts, dtype=np.int64)
+        self.txids = list(txids)
+
+    @classmethod
+    def from_records(cls, records):
+        # `records` are dicts with source, target, amount and txid keys.
+        columns = ([], [], [], [])
+        for record in records:
+            try:
+                for column, key in zip(columns, ("source", "target", "amount")):
+                    column.append(_whole(record[key]))
+                columns[3].append(str(record["txid"]))
+            except (KeyError, TypeError, ValueError) as error:
+                raise ValidationError(f"Invalid leg {record!r}: {error}")
+        return cls(*columns)
+
+    def __len__(self):
+        return len(self.amounts)
+
+    def validate(self):
+        if not len(self):
+            raise ValidationError("The batch has no legs.")
+        if (self.amounts <= 0).any():
+            raise ValidationError("Leg amounts must be positive.")
+        if (self.sources == self.targets).any():
+            raise ValidationError("Legs must move funds between two wallets.")
+        if len(set(self.txids)) != len(self.txids):
+            raise ValidationError("Leg txids must be unique in the batch.")
+
+    def net_positions(self):
+        # Returns the sorted wallet ids, their net amount and the number of
+        # legs they take part in. np.add.at keeps int64 exact, unlike the
+        # float weights of np.bincount.
+        wallet_ids, index = np.unique(
+            np.concatenate([self.sources, self.targets]), return_inverse=True
+        )
+        net = np.zeros(len(wallet_ids), dtype=np.int64)
+        np.add.at(net, index, np.concatenate([-self.amounts, self.amounts]))
+        legs = np.bincount(index, minlength=len(wallet_ids))
+        return wallet_ids, net, legs
+
+
+def settle(batch):
+    # Applies the whole batch in one database transaction and returns
+    # {"legs", "wallets", "gross", "net"}.
+    batch.validate()
+    wallet_ids, net, legs = batch.net_positions()
+    using = _shard(wallet_ids)
+    claim_txids(
+        {
+            f"{txid}:{side}": wallet_id
+            for txid, source, target in zip(
+                batch.txids, batch.sources.tolist(), batch.targets.tolist()
+            )
+            for side, wallet_id in (("debit", source), ("credit", target))
+        }
+    )
+    with transaction.atomic(using=using):
+        _check_txids(using, batch.txids)
+        wallets = _lock(using, wallet_ids.tolist())
+        now = timezone.now()
+        insolvent = []
+        for wallet, amount, count in zip(wallets, net.tolist(), legs.tolist()):
+            if wallet.balance - wallet.held + amount < 0:
+                insolvent.append(wallet.id)
+            wallet.balance += amount
+            wallet.version += 1
+            wallet.transactions_count += count
+            wallet.last_activity_at = now
+        if insolvent:
+            raise InsufficientFundsError(
+                f"Wallets {insolvent[:20]} cannot cover their net position."
+            )
+        Wallet.objects.using(using).bulk_update(
+            wallets,
+            ["balance", "version", "transactions_count", "last_activity_at"],
+            batch_size=LOOKUP_BATCH_SIZE,
+        )
+        record_events(
+            using,
+            (
+                OutboxEvent(
+                    topic="balance",
+                    wallet_id=wallet.id,
+                    payload=Wallet._balance_event(
+                        wallet.balance, wallet.version, amount
+                    ),
+                )
+                for wallet, amount in zip(wallets, net.tolist())
+            ),
+            batch_size=INSERT_BATCH_SIZE,
+        )
+        for chunk in chunked(_legs(batch), INSERT_BATCH_SIZE):
+            transactions = Transaction.objects.using(using).bulk_create(chunk)
+            record_events(
+                using,
+                (
+                    OutboxEvent(
+                        topic="transaction",
+                        wallet_id=tx.wallet_id,
+                        payload=Transaction._event(
+                            "created", tx.pk, tx.txid, tx.amount
+                        ),
+                    )
+                    for tx in transactions
+                ),
+            )
+    return {
+        "legs": len(batch),
+        "wallets": len(wallets),
+        "gross": int(batch.amounts.sum()),
+        "net": int(net[net > 0].sum()),
+    }
+
+
+def _whole(value):
+    # int() would truncate 1.5, fractions are rejected instead. "100.00" and
+    # 100.0 still pass, like MinorUnitsField.
+    try:
+        number = Decimal(str(value).strip())
+    except InvalidOperation:
+        raise ValueError(f"{value!r} is not a number")
+    if not number.is_finite() or number != number.to_integral_value():
+        raise ValueError(f"{value!r} is not a whole number")
+    return int(number)
+
+
+def _shard(wallet_ids):
+    shards = {shard_for(wallet_id) for wallet_id in wallet_ids.tolist()}
+    if len(shards) > 1:
+        raise ValidationError("A netting batch must stay within one shard.")
+    return shards.pop()
+
+
+def _check_txids(using, txids):
+    txids = [f"{txid}:{side}" for txid in txids for side in ("debit", "credit")]
+    for chunk in chunked(txids, LOOKUP_BATCH_SIZE):
+        existing = Transaction.objects.using(using).filter(txid__in=chunk)
+        if existing.exists():
+            raise ValidationError(
+                f"Transaction {existing.values_list('txid', flat=True)[0]} exists."
+            )
+
+
+def _lock(using, wallet_ids):
+    # Locked in id order, the order of every multi-wallet lock.
+    wallets = []
+    for chunk in chunked(wallet_ids, LOOKUP_BATCH_SIZE):
+        wallets.extend(
+            lock_rows(Wallet.objects.using(using).filter(id__in=chunk).order_by("id"))
+        )
+    missing = set(wallet_ids) - {wallet.id for wallet in wallets}
+    if missing:
+        raise ValidationError(f"Wallets {sorted(missing)[:20]} do not exist.")
+    return wallets
+
+
+def _legs(batch):
+    # Every credit of the batch comes before its debits, so replaying the
+    # transactions in id order (audit_ledger) takes no wallet below the
+    # balance it settles at.
+    sharded = is_sharded()
+    sides = (
+        ("credit", batch.targets.tolist(), batch.amounts.tolist()),
+        ("debit", batch.sources.tolist(), (-batch.amounts).tolist()),
+    )
+    for side, wallet_ids, amounts in sides:
+        for wallet_id, amount, txid in zip(wallet_ids, amounts, batch.txids):
+            tx = Transaction(wallet_id=wallet_id, txid=f"{txid}:{side}", amount=amount)
+            if sharded:
+                tx.pk = allocator.transaction_id(wallet_id)
+            yield tx
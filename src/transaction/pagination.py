@@ -0,0 +1,116 @@
+from django.core.paginator import EmptyPage, Page, PageNotAnInteger, Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _
+from rest_framework_json_api.pagination import JsonApiPageNumberPagination
+
+
+def estimate_count(queryset):
+    # Row count of the whole table from the planner statistics, None when
+    # the backend has none (SQLite) or the table was never analyzed.
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == "mysql":
+            cursor.execute(
+                "SELECT TABLE_ROWS FROM information_schema.TABLES "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+                [table],
+            )
+        elif connection.vendor == "postgresql":
+            cursor.execute(
+                "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+                [connection.ops.quote_name(table)],
+            )
+        else:
+            return None
+        row = cursor.fetchone()
+    if row is None or row[0] is None or row[0] < 0:
+        return None
+    return int(row[0])
+
+
+class EstimatedPage(Page):
+    # Page of an inexact count, whether a next page exists was read from
+    # the rows themselves.
+    def __init__(self, object_list, number, paginator, more):
+        super().__init__(object_list, number, paginator)
+        self.more = more
+
+    def has_next(self):
+        return self.more
+
+
+class EstimatedCountPaginator(Paginator):
+    # Avoids an exact COUNT(*) over large tables. Unfiltered lists use the
+    # table statistics, filtered ones count at most `count_cap` rows.
+    # `exact` tells whether the count is exact. An inexact count is only
+    # reported, pages are then found by reading one row past them.
+    count_cap = 10000
+
+    def __init__(self, *args, unfiltered=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.unfiltered = unfiltered
+        self.exact = True
+
+    @cached_property
+    def count(self):
+        if self.unfiltered:
+            estimate = estimate_count(self.object_list)
+            # Statistics of small tables are too rough, those are counted.
+            if estimate is not None and estimate >= self.count_cap:
+                self.exact = False
+                return estimate
+        capped = self.object_list.order_by().values("pk")[: self.count_cap + 1]
+        count = capped.count()
+        if count > self.count_cap:
+            self.exact = False
+            return self.count_cap
+        return count
+
+    def page(self, number):
+        self.count  # Decides `exact`.
+        if self.exact:
+            return super().page(number)
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        rows = list(self.object_list[bottom : bottom + self.per_page + 1])
+        if not rows and number > 1:
+            raise EmptyPage(_("That page contains no results"))
+        return EstimatedPage(
+            rows[: self.per_page], number, self, len(rows) > self.per_page
+        )
+
+    def validate_number(self, number):
+        if self.exact:
+            return super().validate_number(number)
+        # Only the lower bound, the estimate does not bound the pages.
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger(_("That page number is not an integer"))
+        if number < 1:
+            raise EmptyPage(_("That page number is less than 1"))
+        return number
+
+
+class EstimatedCountPagination(JsonApiPageNumberPagination):
+    def paginate_queryset(self, queryset, request, view=None):
+        # The list is unfiltered when the filter backends added no condition
+        # to the view's own queryset.
+        self.unfiltered = (
+            view is not None and queryset.query.where == view.get_queryset().query.where
+        )
+        return super().paginate_queryset(queryset, request, view)
+
+    def django_paginator_class(self, queryset, page_size):
+        return EstimatedCountPaginator(queryset, page_size, unfiltered=self.unfiltered)
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        exact = self.page.paginator.exact
+        response.data["meta"]["pagination"]["exact"] = exact
+        if not exact:
+            # The last page of an estimate is not known.
+            response.data["links"]["last"] = None
+        return response
@@ -0,0 +1,240 @@
+import cProfile
+import hmac
+import io
+import json
+import pstats
+import random
+import time
+import uuid
+from contextlib import ExitStack
+from datetime import datetime
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.http import FileResponse, Http404, HttpResponse
+from django.urls import reverse
+from django.utils.html import format_html, format_html_join
+
+DEFAULTS = {
+    "ENABLED": False,
+    "HEADER": "X-Profile",
+    "TOKEN": None,
+    "SAMPLE_RATE": 0.0,
+    "DIRECTORY": "profiles",
+    "MAX_ENTRIES": 50,
+    "TOP_FUNCTIONS": 40,
+}
+
+
+def get_setting(name):
+    return getattr(settings, "WALLET_PROFILING", {}).get(name, DEFAULTS[name])
+
+
+def get_directory():
+    return Path(settings.BASE_DIR, get_setting("DIRECTORY"))
+
+
+class QueryRecorder:
+    # execute_wrapper collecting the SQL, parameters and duration of every
+    # query, on every database alias.
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append(
+                {
+                    "database": context["connection"].alias,
+                    "sql": sql,
+                    "params": repr(params)[:500],
+                    "many": many,
+                    "time": round(time.perf_counter() - started, 6),
+                }
+            )
+
+
+class ProfilingMiddleware:
+    # Runs cProfile over requests carrying the HEADER with the TOKEN, and over
+    # a SAMPLE_RATE share of all requests. Left out of the middleware chain
+    # unless ENABLED, so it costs nothing when off.
+
+    def __init__(self, get_response):
+        if not get_setting("ENABLED"):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.header = "HTTP_" + get_setting("HEADER").upper().replace("-", "_")
+        self.token = get_setting("TOKEN")
+        self.sample_rate = get_setting("SAMPLE_RATE")
+        self.store = ProfileStore(get_directory(), get_setting("MAX_ENTRIES"))
+
+    def __call__(self, request):
+        if not self._requested(request):
+            return self.get_response(request)
+        recorder = QueryRecorder()
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            profiler.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                profiler.disable()
+        elapsed = time.perf_counter() - started
+        response["X-Profile-Id"] = self.store.save(
+            {
+                "method": request.method,
+                "path": request.path,
+                "query_string": request.META.get("QUERY_STRING", ""),
+                "status": response.status_code,
+                "time": round(elapsed, 6),
+                "sql_time": round(sum(query["time"] for query in recorder.queries), 6),
+                "queries": recorder.queries,
+            },
+            profiler,
+        )
+        return response
+
+    def _requested(self, request):
+        value = request.META.get(self.header)
+        if value is not None and self.token:
+            return hmac.compare_digest(value, self.token)
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+
+class ProfileStore:
+    # Ring buffer of the last MAX_ENTRIES profiles on disk, a "<name>.json"
+    # summary and a "<name>.prof" pstats dump each. Names sort by capture time.
+
+    def __init__(self, directory, max_entries):
+        self.directory = directory
+        self.max_entries = max_entries
+
+    def save(self, summary, profiler):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        name = f"{datetime.now():%Y%m%dT%H%M%S%f}-{uuid.uuid4().hex[:6]}"
+        profiler.dump_stats(self.directory / f"{name}.prof")
+        summary["name"] = name
+        summary["top"] = self._top(profiler)
+        (self.directory / f"{name}.json").write_text(json.dumps(summary, indent=2))
+        for old in self.names()[self.max_entries :]:
+            for suffix in (".json", ".prof"):
+                (self.directory / f"{old}{suffix}").unlink(missing_ok=True)
+        return name
+
+    def names(self):
+        # Newest first.
+        if not self.directory.is_dir():
+            return []
+        return sorted(
+            (path.stem for path in self.directory.glob("*.json")), reverse=True
+        )
+
+    def load(self, name):
+        path = self.directory / f"{Path(name).name}.json"
+        if not path.is_file():
+            raise Http404("Profile not found.")
+        return json.loads(path.read_text())
+
+    def _top(self, profiler):
+        stream = io.StringIO()
+        stats = pstats.Stats(profiler, stream=stream)
+        stats.sort_stats("cumulative").print_stats(get_setting("TOP_FUNCTIONS"))
+        return stream.getvalue()
+
+
+def _milliseconds(seconds):
+    return f"{seconds * 1000:.2f}"
+
+
+def get_store():
+    return ProfileStore(get_directory(), get_setting("MAX_ENTRIES"))
+
+
+@staff_member_required
+def profile_list(request):
+    store = get_store()
+    profiles = [store.load(name) for name in store.names()]
+    rows = format_html_join(
+        "",
+        '<tr><td><a href="{}">{}</a></td><td>{} {}?{}</td><td>{}</td>'
+        "<td>{}ms</td><td>{}</td><td>{}ms</td></tr>",
+        (
+            (
+                reverse("profile-detail", args=[profile["name"]]),
+                profile["name"],
+                profile["method"],
+                profile["path"],
+                profile["query_string"],
+                profile["status"],
+                _milliseconds(profile["time"]),
+                len(profile["queries"]),
+                _milliseconds(profile["sql_time"]),
+            )
+            for profile in profiles
+        ),
+    )
+    return HttpResponse(
+        format_html(
+            "<h1>Request profiles</h1><table><tr><th>Profile</th><th>Request</th>"
+            "<th>Status</th><th>Time</th><th>Queries</th><th>SQL time</th></tr>"
+            "{}</table>",
+            rows,
+        )
+    )
+
+
+@staff_member_required
+def profile_detail(request, name):
+    store = get_store()
+    profile = store.load(name)
+    if request.GET.get("download") == "prof":
+        return FileResponse(
+            open(store.directory / f"{profile['name']}.prof", "rb"),
+            as_attachment=True,
+            filename=f"{profile['name']}.prof",
+        )
+    if request.GET.get("download") == "json":
+        return FileResponse(
+            open(store.directory / f"{profile['name']}.json", "rb"),
+            as_attachment=True,
+            filename=f"{profile['name']}.json",
+        )
+    queries = format_html_join(
+        "",
+        "<li>{}ms [{}] <code>{}</code> {}</li>",
+        (
+            (
+                _milliseconds(query["time"]),
+                query["database"],
+                query["sql"],
+                query["params"],
+            )
+            for query in profile["queries"]
+        ),
+    )
+    return HttpResponse(
+        format_html(
+            "<h1>{} {}?{}</h1><p>{} in {}ms, {} queries in {}ms. "
+            '<a href="?download=prof">Download .prof</a> '
+            '<a href="?download=json">Download .json</a></p>'
+            "<h2>Queries</h2><ol>{}</ol><h2>Functions</h2><pre>{}</pre>",
+            profile["method"],
+            profile["path"],
+            profile["query_string"],
+            profile["status"],
+            _milliseconds(profile["time"]),
+            len(profile["queries"]),
+            _milliseconds(profile["sql_time"]),
+            queries,
+            profile["top"],
+        )
+    )
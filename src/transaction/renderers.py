@@ -0,0 +1,42 @@
+import msgpack
+from rest_framework import renderers
+from rest_framework.exceptions import ParseError
+from rest_framework_json_api.parsers import JSONParser
+from rest_framework_json_api.renderers import JSONRenderer
+
+# MessagePack encodings of the JSON:API documents, for service clients that
+# send `Accept` / `Content-Type: application/vnd.api+msgpack`. The document
+# structure is the one of the JSON renderer and parser, only the final
+# encoding differs.
+MEDIA_TYPE = "application/vnd.api+msgpack"
+
+
+class _MessagePackEncoder(renderers.JSONRenderer):
+    # Sits after the JSON:API renderer in the MRO, so the document it builds
+    # (and error documents) is packed instead of dumped as JSON.
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        # The JSON encoder's fallback covers datetimes, decimals and lazy
+        # strings the same way as for JSON responses.
+        return msgpack.packb(data, default=self.encoder_class().default)
+
+
+class MessagePackRenderer(JSONRenderer, _MessagePackEncoder):
+    media_type = MEDIA_TYPE
+    format = "msgpack"
+    charset = None
+    render_style = "binary"
+
+
+class MessagePackParser(JSONParser):
+    media_type = MEDIA_TYPE
+    renderer_class = MessagePackRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            result = msgpack.unpackb(stream.read(), raw=False)
+        except (ValueError, msgpack.UnpackException) as error:
+            raise ParseError(f"MessagePack parse error - {error}")
+        return self.parse_data(result, parser_context)
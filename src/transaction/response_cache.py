@@ -0,0 +1,274 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.core import checks
+from django.core.cache import caches
+from django.db import transaction
+from django.http import HttpResponse
+from django.utils.module_loading import import_string
+
+from . import metrics
+from .conditional import (
+    is_not_modified,
+    make_etag,
+    normalized_query,
+    not_modified,
+    representation,
+    set_etag,
+)
+
+DEFAULTS = {
+    "ENABLED": False,
+    "GENERATIONS": "transaction.response_cache.CacheGenerations",
+    "CACHE": "default",
+    "MAX_ENTRIES": 1000,
+    "MAX_BYTES": 32 * 1024 * 1024,
+}
+
+# Rendered list pages are cached under the normalized query string plus
+# generation counters of the data they show: the counter of the wallet for
+# lists filtered on a single wallet, a global counter for every other list.
+# Any write to a wallet bumps its counter and the global one once it commits,
+# so a page is never served after its data changed and needs no TTL.
+ALL_KEY = "response-cache:all"
+
+CachedResponse = namedtuple("CachedResponse", ["content", "content_type", "etag"])
+
+
+def get_setting(name):
+    return getattr(settings, "WALLET_RESPONSE_CACHE", {}).get(name, DEFAULTS[name])
+
+
+def wallet_key(wallet_id):
+    return f"response-cache:wallet:{wallet_id}"
+
+
+class LocalGenerations:
+    # In-process counters, for tests only: writes of other workers and of
+    # management commands never bump them.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def get_many(self, keys):
+        with self._lock:
+            return [self._values.get(key, 0) for key in keys]
+
+    def bump(self, keys):
+        with self._lock:
+            for key in keys:
+                self._values[key] = self._values.get(key, 0) + 1
+
+
+class CacheGenerations:
+    # Counters shared by every worker through the CACHE alias (Redis or
+    # Memcached). A counter evicted from the cache restarts from the current
+    # time in nanoseconds, never from a value it already had.
+
+    def get_many(self, keys):
+        cache = caches[get_setting("CACHE")]
+        values = cache.get_many(keys)
+        for key in keys:
+            if key not in values:
+                cache.add(key, time.time_ns(), timeout=None)
+                values[key] = cache.get(key)
+        return [values[key] for key in keys]
+
+    def bump(self, keys):
+        cache = caches[get_setting("CACHE")]
+        for key in keys:
+            try:
+                cache.incr(key)
+            except ValueError:  # Evicted, any new value invalidates.
+                cache.add(key, time.time_ns(), timeout=None)
+
+
+class LRUStore:
+    # Rendered responses of this worker, bounded by MAX_ENTRIES and by the
+    # MAX_BYTES of their bodies. The least recently used ones go first,
+    # entries of outdated generations are never hit again and age out.
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        if len(entry.content) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous.content)
+            self._entries[key] = entry
+            self.size += len(entry.content)
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted.content)
+                EVICTIONS.inc()
+
+
+_store = None
+_generations = None
+_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    with _lock:
+        if _store is None:
+            _store = LRUStore(get_setting("MAX_ENTRIES"), get_setting("MAX_BYTES"))
+        return _store
+
+
+def get_generations():
+    global _generations
+    with _lock:
+        if _generations is None:
+            _generations = import_string(get_setting("GENERATIONS"))()
+        return _generations
+
+
+def reset():
+    # Drops the store and counters, e.g. after the settings changed.
+    global _store, _generations
+    with _lock:
+        _store = _generations = None
+
+
+# Cache backends private to a process, their counters are not shared either.
+LOCAL_BACKENDS = (
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+)
+
+
+@checks.register()
+def check_generations(app_configs, **kwargs):
+    # Refuses counters other processes cannot bump while the cache is on.
+    if not get_setting("ENABLED"):
+        return []
+    generations = get_setting("GENERATIONS")
+    backend_class = import_string(generations)
+    if issubclass(backend_class, CacheGenerations):
+        cache = settings.CACHES.get(get_setting("CACHE"), {})
+        shared = cache.get("BACKEND") not in LOCAL_BACKENDS
+    else:
+        shared = backend_class is not LocalGenerations
+    if shared:
+        return []
+    return [
+        checks.Error(
+            f"WALLET_RESPONSE_CACHE is enabled with {generations} counters that "
+            "other worker processes and management commands cannot bump.",
+            hint="Use CacheGenerations on a shared Redis or Memcached cache, "
+            "or disable the response cache.",
+            id="transaction.E001",
+        )
+    ]
+
+
+def invalidate_on_commit(wallet_ids, using=None):
+    # Called by every write path with the wallets it changed.
+    if not get_setting("ENABLED"):
+        return
+    keys = [ALL_KEY, *(wallet_key(wallet_id) for wallet_id in set(wallet_ids))]
+    transaction.on_commit(lambda: get_generations().bump(keys), using=using)
+
+
+def make_key(request, wallet_id=None):
+    # None when the response must not be cached. The browsable API renders
+    # per user forms, only API formats are cached.
+    if not get_setting("ENABLED") or request.accepted_renderer.format == "api":
+        return None
+    generation = wallet_key(wallet_id) if wallet_id is not None else ALL_KEY
+    return (
+        request.build_absolute_uri(request.path),
+        request.accepted_media_type,
+        normalized_query(request),
+        *get_generations().get_many([generation]),
+    )
+
+
+def list_etag(request):
+    # ETag of a list from the global counter, no query needed to answer an
+    # If-None-Match. None while the cache, and so the counters, are disabled.
+    if not get_setting("ENABLED"):
+        return None
+    (generation,) = get_generations().get_many([ALL_KEY])
+    digest = hashlib.md5(
+        normalized_query(request).encode(), usedforsecurity=False
+    ).hexdigest()
+    return make_etag("list", generation, digest, representation(request))
+
+
+def lookup(request, key):
+    if key is None:
+        return None
+    entry = get_store().get(key)
+    if entry is None:
+        MISSES.inc()
+        return None
+    HITS.inc()
+    if entry.etag and is_not_modified(request, entry.etag):
+        return not_modified(entry.etag)
+    response = HttpResponse(entry.content, content_type=entry.content_type)
+    if entry.etag:
+        set_etag(response, entry.etag)
+    response["X-Response-Cache"] = "hit"
+    return response
+
+
+def store(key, response):
+    # The body is only known once DRF rendered the response.
+    if key is None or response.status_code != 200:
+        return response
+
+    def save(rendered):
+        get_store().set(
+            key,
+            CachedResponse(
+                rendered.content, rendered["Content-Type"], rendered.get("ETag")
+            ),
+        )
+
+    response["X-Response-Cache"] = "miss"
+    response.add_post_render_callback(save)
+    return response
+
+
+HITS = metrics.counter(
+    "wallet_response_cache_hits_total", "List responses served from the cache."
+)
+MISSES = metrics.counter(
+    "wallet_response_cache_misses_total", "List responses rendered and cached."
+)
+EVICTIONS = metrics.counter(
+    "wallet_response_cache_evictions_total", "List responses evicted from the LRU."
+)
+metrics.gauge(
+    "wallet_response_cache_entries",
+    "List responses cached in this worker.",
+    lambda: len(_store) if _store is not None else 0,
+)
+metrics.gauge(
+    "wallet_response_cache_bytes",
+    "Body size of the list responses cached in this worker.",
+    lambda: _store.size if _store is not None else 0,
+)
@@ -1,21 +1,62 @@
+from decimal import Decimal, InvalidOperation
+
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
 from rest_framework import serializers
+from rest_framework_json_api.serializers import SparseFieldsetsMixin
 from drf_yasg.utils import swagger_serializer_method
 
-from .models import Transaction, Wallet
+from .holds import get_setting as get_hold_setting
+from .models import Hold, Transaction, TransferIntent, Wallet
+from .sharding import shard_for, shard_querysets
 from .utils import make_transaction, reverse_transaction
 
 
-class TransactionSerializer(serializers.ModelSerializer):
+class WalletRelatedField(serializers.PrimaryKeyRelatedField):
+    # Looks the wallet up on its shard.
+    def to_internal_value(self, data):
+        try:
+            return self.get_queryset().using(shard_for(data)).get(pk=data)
+        except ObjectDoesNotExist:
+            self.fail("does_not_exist", pk_value=data)
+        except (TypeError, ValueError):
+            self.fail("incorrect_type", data_type=type(data).__name__)
+
+
+class MinorUnitsField(serializers.IntegerField):
+    # Amounts are whole minor units in a signed 64-bit column. Integers pass
+    # straight through; strings and decimals such as "100.00", accepted when
+    # the columns were DECIMAL, are still taken when they have no fraction.
+    default_error_messages = {"fraction": "Amounts are whole minor units."}
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault("min_value", -(2**63))
+        kwargs.setdefault("max_value", 2**63 - 1)
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        if type(data) is int:
+            return data
+        if isinstance(data, (str, float, Decimal)):
+            try:
+                value = Decimal(str(data).strip())
+            except InvalidOperation:
+                self.fail("invalid")
+            if not value.is_finite():
+                self.fail("invalid")
+            if value != value.to_integral_value():
+                self.fail("fraction")
+            return int(value)
+        return super().to_internal_value(data)
+
+
+class TransactionSerializer(SparseFieldsetsMixin, serializers.ModelSerializer):
     class Meta:
-        fields = "__all__"
+        exclude = ("legacy_amount",)
         model = Transaction
 
-    wallet = serializers.PrimaryKeyRelatedField(queryset=Wallet.objects.all())
-
-    def to_representation(self, instance: Transaction):
-        representation = super().to_representation(instance)
-        representation["amount"] = int(instance.amount)
-        return representation
+    wallet = WalletRelatedField(queryset=Wallet.objects.all())
+    amount = MinorUnitsField()
 
 
 class TransactionCreateSerializer(serializers.ModelSerializer):
@@ -23,52 +64,138 @@ class TransactionCreateSerializer(serializers.ModelSerializer):
         fields = ("wallet", "txid", "amount")
         model = Transaction
 
+    wallet = WalletRelatedField(queryset=Wallet.objects.all())
+    amount = MinorUnitsField()
+
     def update(self, obj: Transaction, validated_data):
         # UPDATE database case.
         amount = validated_data.get("amount")
         new_wallet = validated_data.get("wallet")
-        if not new_wallet or obj.wallet == new_wallet:
-            amount_difference = amount - obj.amount
-            make_transaction(wallet=obj.wallet, amount=amount_difference)
-        else:
-            reverse_transaction(wallet=obj.wallet, amount=obj.amount)
-            make_transaction(wallet=new_wallet, amount=amount)
-        return super().update(obj, validated_data)
+        if new_wallet and new_wallet._state.db != obj._state.db:
+            raise serializers.ValidationError(
+                {"wallet": "The wallet is on another shard, use a transfer."}
+            )
+        with transaction.atomic(using=obj._state.db):
+            if not new_wallet or obj.wallet == new_wallet:
+                amount_difference = amount - obj.amount
+                make_transaction(wallet=obj.wallet, amount=amount_difference)
+            else:
+                reverse_transaction(wallet=obj.wallet, amount=obj.amount)
+                make_transaction(wallet=new_wallet, amount=amount, transactions=1)
+            return super().update(obj, validated_data)
+
+
+class TransferSerializer(serializers.Serializer):
+    to = serializers.IntegerField()
+    amount = MinorUnitsField(min_value=1)
+    txid = serializers.CharField(max_length=200)
+
+    class Meta:
+        resource_name = "Transfer"
+
+    def validate_txid(self, value):
+        # The transfer writes "<txid>:debit" and "<txid>:credit", plus a
+        # TransferIntent with the txid across shards.
+        txids = [f"{value}:debit", f"{value}:credit"]
+        if TransferIntent.objects.filter(txid=value).exists() or any(
+            queryset.filter(txid__in=txids).exists()
+            for queryset in shard_querysets(Transaction.objects.all())
+        ):
+            raise serializers.ValidationError(f"Transfer {value} exists.")
+        return value
+
+
+class HoldSerializer(SparseFieldsetsMixin, serializers.ModelSerializer):
+    class Meta:
+        fields = (
+            "wallet",
+            "amount",
+            "txid",
+            "state",
+            "captured_amount",
+            "created_at",
+            "expires_at",
+        )
+        model = Hold
+
+    amount = MinorUnitsField(read_only=True)
+
+
+class HoldCreateSerializer(serializers.ModelSerializer):
+    class Meta:
+        fields = ("wallet", "amount", "txid", "ttl")
+        model = Hold
+
+    wallet = WalletRelatedField(queryset=Wallet.objects.all())
+    amount = MinorUnitsField(min_value=1)
+    ttl = serializers.IntegerField(
+        min_value=1,
+        required=False,
+        write_only=True,
+        help_text="Seconds before the hold expires.",
+    )
+
+    def validate_ttl(self, value):
+        if value > get_hold_setting("MAX_TTL"):
+            raise serializers.ValidationError(
+                f"Holds last at most {get_hold_setting('MAX_TTL')} seconds."
+            )
+        return value
+
+    def validate_txid(self, value):
+        # The capture creates a transaction with the same txid, on any shard.
+        if any(
+            queryset.filter(txid=value).exists()
+            for queryset in shard_querysets(Transaction.objects.all())
+        ):
+            raise serializers.ValidationError(
+                "transaction with this txid already exists."
+            )
+        return value
+
+
+class HoldCaptureSerializer(serializers.Serializer):
+    amount = MinorUnitsField(
+        min_value=1, required=False, help_text="Defaults to the held amount."
+    )
+
+    class Meta:
+        resource_name = "Hold"
 
 
 class WalletCreateSerializer(serializers.ModelSerializer):
     # Serializer for creating wallet.
     class Meta:
-        fields = ("label",)
+        fields = ("label", "concurrency_mode")
         model = Wallet
 
 
-class WalletListSerializer(serializers.ModelSerializer):
+class WalletListSerializer(SparseFieldsetsMixin, serializers.ModelSerializer):
     class Meta:
         fields = (
             "label",
             "balance",
+            "held",
+            "transactions_count",
+            "last_activity_at",
         )
         model = Wallet
 
-    def to_representation(self, instance: Wallet):
-        representation = super().to_representation(instance)
-        representation["balance"] = int(instance.balance)
-        return representation
-
 
-class WalletRetrieveSerializer(serializers.ModelSerializer):
+class WalletRetrieveSerializer(SparseFieldsetsMixin, serializers.ModelSerializer):
     class Meta:
-        fields = ("label", "balance", "transactions")
+        fields = (
+            "label",
+            "balance",
+            "held",
+            "transactions_count",
+            "last_activity_at",
+            "transactions",
+        )
         model = Wallet
 
     transactions = serializers.SerializerMethodField()
 
-    def to_representation(self, instance: Wallet):
-        representation = super().to_representation(instance)
-        representation["balance"] = int(instance.balance)
-        return representation
-
     @swagger_serializer_method(serializer_or_field=TransactionSerializer(many=True))
     def get_transactions(self, obj: Wallet):
         return TransactionSerializer(obj.transactions.all(), many=True).data
@@ -0,0 +1,244 @@
+import base64
+import heapq
+import itertools
+import json
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from .utils import chunked
+
+# Wallets are spread over the WALLET_SHARDS database aliases by the modulo
+# hash of their id. Ids are handed out by a global allocator in the residue
+# class of the target shard, and a transaction takes the residue of its
+# wallet, so any wallet or transaction id alone tells its shard.
+# Cross-shard state (allocator, transfer intents) lives on the first shard.
+ID_BLOCK_SIZE = 100
+COORDINATOR_MODELS = ("idsequence", "transferintent", "txidclaim")
+# Seconds after which the claim of a txid missing from its shard is taken
+# over by a write to another shard, see claim_txids.
+TXID_CLAIM_TIMEOUT = 60
+# Keeps "IN (...)" lookups below the bound-parameter limit of every backend.
+LOOKUP_BATCH_SIZE = 500
+
+
+def get_shards():
+    return getattr(settings, "WALLET_SHARDS", [DEFAULT_DB_ALIAS])
+
+
+def is_sharded():
+    return len(get_shards()) > 1
+
+
+def coordinator():
+    return get_shards()[0]
+
+
+def shard_for(object_id):
+    shards = get_shards()
+    return shards[int(object_id) % len(shards)]
+
+
+def shard_querysets(queryset):
+    # One queryset per shard, or the queryset itself when not sharded.
+    if not is_sharded():
+        return [queryset]
+    return [queryset.using(alias) for alias in get_shards()]
+
+
+class WalletShardRouter:
+    # Routes wallets and every row keyed by a wallet by the instance hint,
+    # which Django passes on saves, deletes and related object access.
+    # Queries without an instance pick their shard with .using().
+
+    def _db_for_model(self, model, instance):
+        if not is_sharded() or model._meta.app_label != "transaction":
+            return None
+        if model._meta.model_name in COORDINATOR_MODELS:
+            return coordinator()
+        if instance is None:
+            return None
+        # The instance is the row a related object is fetched for, e.g. the
+        # transaction whose wallet is loaded.
+        if instance._meta.model_name == "wallet":
+            wallet_id = instance.pk
+        else:
+            wallet_id = getattr(instance, "wallet_id", None)
+        return None if wallet_id is None else shard_for(wallet_id)
+
+    def db_for_read(self, model, **hints):
+        return self._db_for_model(model, hints.get("instance"))
+
+    def db_for_write(self, model, **hints):
+        return self._db_for_model(model, hints.get("instance"))
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if not is_sharded():
+            return None
+        return obj1._state.db == obj2._state.db
+
+
+class IdAllocator:
+    # Reserves blocks of a global sequence on the coordinator, so allocating
+    # an id rarely needs a round trip.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._blocks = {}
+
+    def next_value(self, name):
+        with self._lock:
+            block = self._blocks.get(name)
+            if block is None or block[0] >= block[1]:
+                start = self._reserve(name, ID_BLOCK_SIZE)
+                block = [start, start + ID_BLOCK_SIZE]
+                self._blocks[name] = block
+            value = block[0]
+            block[0] += 1
+            return value
+
+    def reset(self):
+        with self._lock:
+            self._blocks.clear()
+
+    def _reserve(self, name, size):
+        # A reservation rolled back with the caller's transaction could be
+        # handed out twice, WALLET_ID_DATABASE should be a separate alias of
+        # the coordinator database so it always commits on its own.
+        from .models import IdSequence
+
+        using = getattr(settings, "WALLET_ID_DATABASE", None) or coordinator()
+        with transaction.atomic(using=using):
+            sequences = IdSequence.objects.using(using)
+            sequences.get_or_create(name=name)
+            sequence = sequences.select_for_update().get(name=name)
+            sequences.filter(name=name).update(next_value=F("next_value") + size)
+        return sequence.next_value
+
+    def wallet_id(self):
+        # New wallets go round-robin over the shards.
+        count = len(get_shards())
+        value = self.next_value("wallet")
+        return value * count + value % count
+
+    def transaction_id(self, wallet_id, sequence="transaction"):
+        # Also used for other rows stored with their wallet, e.g. holds.
+        shards = get_shards()
+        shard = shards.index(shard_for(wallet_id))
+        return self.next_value(sequence) * len(shards) + shard
+
+
+allocator = IdAllocator()
+
+
+def claim_txids(claims):
+    # Registers the {txid: wallet_id} of new transactions on the coordinator
+    # when sharded. Claims commit on their own like id reservations, so one
+    # left behind by a write that rolled back is taken over once its txid is
+    # not on the claimed shard: right away by a write to the same shard,
+    # whose unique index catches a write still in flight, and after
+    # TXID_CLAIM_TIMEOUT by a write to another shard.
+    from .models import Transaction, TxidClaim
+
+    if not is_sharded() or not claims:
+        return
+    using = getattr(settings, "WALLET_ID_DATABASE", None) or coordinator()
+    now = timezone.now()
+    try:
+        with transaction.atomic(using=using):
+            for batch in chunked(claims, LOOKUP_BATCH_SIZE):
+                existing = TxidClaim.objects.using(using).select_for_update()
+                for claim in existing.filter(txid__in=batch):
+                    shard = shard_for(claim.wallet_id)
+                    in_use = (
+                        Transaction.objects.using(shard)
+                        .filter(txid=claim.txid)
+                        .exists()
+                    )
+                    pending = shard != shard_for(claims[claim.txid]) and (
+                        claim.claimed_at > now - timedelta(seconds=TXID_CLAIM_TIMEOUT)
+                    )
+                    if in_use or pending:
+                        raise ValidationError(
+                            {"txid": f"Transaction {claim.txid} exists."}
+                        )
+                    claim.delete()
+            TxidClaim.objects.using(using).bulk_create(
+                TxidClaim(txid=txid, wallet_id=wallet_id, claimed_at=now)
+                for txid, wallet_id in claims.items()
+            )
+    except IntegrityError:
+        # Claimed concurrently.
+        raise ValidationError({"txid": "Transaction txid exists."})
+
+
+class Descending:
+    # Reverses the comparison of a sort key part for descending orderings.
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def fan_out(queryset, ordering, size, cursor=None):
+    # Runs the keyset-ordered page query on every shard and merges the
+    # results, returning at most `size` rows and the cursor of the next page.
+    fields = [(name.lstrip("-"), name.startswith("-")) for name in ordering]
+    model = queryset.model
+    for name, _ in fields:
+        if model._meta.get_field(name).null:
+            raise ValidationError(f"Sharded lists cannot be sorted by {name}.")
+    if cursor is not None:
+        queryset = queryset.filter(_after(fields, cursor))
+    queryset = queryset.order_by(*ordering)
+    names, defer = queryset.query.deferred_loading
+    if names and not defer:
+        # Sparse fieldsets must still load the sort columns for the merge.
+        queryset = queryset.only(*names, *(name for name, _ in fields))
+
+    def sort_key(row):
+        return tuple(
+            Descending(getattr(row, name)) if descending else getattr(row, name)
+            for name, descending in fields
+        )
+
+    pages = [list(shard[: size + 1]) for shard in shard_querysets(queryset)]
+    rows = list(itertools.islice(heapq.merge(*pages, key=sort_key), size + 1))
+    if len(rows) <= size:
+        return rows, None
+    rows = rows[:size]
+    last = [getattr(rows[-1], name) for name, _ in fields]
+    return rows, encode_cursor(last)
+
+
+def _after(fields, values):
+    # (a > x) OR (a = x AND b > y) ... with < for descending fields.
+    condition = Q()
+    for index, (name, descending) in enumerate(fields):
+        step = Q(**{f"{name}__{'lt' if descending else 'gt'}": values[index]})
+        for (previous, _), value in zip(fields[:index], values):
+            step &= Q(**{previous: value})
+        condition |= step
+    return condition
+
+
+def encode_cursor(values):
+    payload = json.dumps(values, cls=DjangoJSONEncoder).encode()
+    return base64.urlsafe_b64encode(payload).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise ValidationError("Invalid page cursor.")
@@ -0,0 +1,160 @@
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from .models import Transaction, Wallet
+from .utils import iter_keyset_chunks
+
+# Columnar ledger snapshots for offline analytics. Every column is a raw
+# little-endian file of fixed-width values, "<table>/<column>.bin", that
+# the reader memory-maps as a NumPy array, so scans read the page cache
+# directly instead of the database. manifest.json records the row count of
+# each table, columns past it (from an interrupted append) are ignored.
+#
+# Transactions are append-only: later snapshots only export ids above the
+# last exported one. Rows updated or deleted afterwards, or committed late
+# with a lower id, are only picked up by a full snapshot. Wallets are small
+# and rewritten every time.
+MANIFEST = "manifest.json"
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+TABLES = {
+    "transactions": {"id": "<i8", "wallet_id": "<i8", "amount": "<i8"},
+    "wallets": {
+        "id": "<i8",
+        "balance": "<i8",
+        "held": "<i8",
+        "last_activity_at": "<M8[us]",
+    },
+}
+
+
+def _microseconds(value):
+    if value is None:
+        return np.datetime64("NaT")
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+class Snapshot:
+    # Read side: snapshot.table("transactions")["amount"] is a read-only
+    # memmap of the column.
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, MANIFEST)) as stream:
+            self.manifest = json.load(stream)
+
+    def rows(self, table):
+        return self.manifest["tables"][table]["rows"]
+
+    def table(self, table):
+        rows = self.rows(table)
+        columns = {}
+        for column, dtype in TABLES[table].items():
+            if not rows:  # Empty files cannot be mapped.
+                columns[column] = np.zeros(0, dtype=dtype)
+                continue
+            columns[column] = np.memmap(
+                os.path.join(self.directory, table, f"{column}.bin"),
+                dtype=dtype,
+                mode="r",
+                shape=(rows,),
+            )
+        return columns
+
+    @property
+    def transactions(self):
+        return self.table("transactions")
+
+    @property
+    def wallets(self):
+        return self.table("wallets")
+
+
+class SnapshotWriter:
+    def __init__(self, directory, using="default", chunk_size=100000):
+        self.directory = directory
+        self.using = using
+        self.chunk_size = chunk_size
+
+    def write(self, full=False):
+        # Returns the number of transactions and wallets exported.
+        manifest = self._manifest()
+        if full or manifest.get("database") != self.using:
+            manifest = {"database": self.using, "tables": {}}
+        transactions = self._append_transactions(manifest)
+        wallets = self._write_wallets(manifest)
+        manifest["created_at"] = datetime.now(timezone.utc).isoformat()
+        self._save(manifest)
+        return transactions, wallets
+
+    def _append_transactions(self, manifest):
+        state = manifest["tables"].get("transactions", {"rows": 0, "last_id": 0})
+        streams = self._open("transactions", state["rows"])
+        queryset = Transaction.objects.using(self.using).filter(pk__gt=state["last_id"])
+        appended = 0
+        try:
+            for chunk in iter_keyset_chunks(
+                queryset, ["wallet_id", "amount"], self.chunk_size
+            ):
+                self._write_chunk(streams, chunk, TABLES["transactions"])
+                appended += len(chunk)
+                state["last_id"] = chunk[-1][0]
+        finally:
+            for stream in streams.values():
+                stream.close()
+        state["rows"] += appended
+        manifest["tables"]["transactions"] = state
+        return appended
+
+    def _write_wallets(self, manifest):
+        # Written next to the current files and swapped in, so readers of
+        # the previous snapshot keep consistent columns.
+        streams = self._open("wallets", 0, suffix=".new")
+        rows = 0
+        try:
+            for chunk in iter_keyset_chunks(
+                Wallet.all_objects.using(self.using),
+                ["balance", "held", "last_activity_at"],
+                self.chunk_size,
+            ):
+                chunk = [row[:3] + (_microseconds(row[3]),) for row in chunk]
+                self._write_chunk(streams, chunk, TABLES["wallets"])
+                rows += len(chunk)
+        finally:
+            for stream in streams.values():
+                stream.close()
+        for column in TABLES["wallets"]:
+            path = os.path.join(self.directory, "wallets", f"{column}.bin")
+            os.replace(f"{path}.new", path)
+        manifest["tables"]["wallets"] = {"rows": rows}
+        return rows
+
+    def _open(self, table, rows, suffix=""):
+        # Column files opened for appending after `rows` values, anything
+        # written past the manifest by an interrupted run is cut off.
+        os.makedirs(os.path.join(self.directory, table), exist_ok=True)
+        streams = {}
+        for column, dtype in TABLES[table].items():
+            path = os.path.join(self.directory, table, f"{column}.bin{suffix}")
+            stream = open(path, "ab")
+            stream.truncate(rows * np.dtype(dtype).itemsize)
+            streams[column] = stream
+        return streams
+
+    def _write_chunk(self, streams, chunk, columns):
+        for values, (column, dtype) in zip(zip(*chunk), columns.items()):
+            streams[column].write(np.array(values, dtype=dtype).tobytes())
+
+    def _manifest(self):
+        try:
+            return Snapshot(self.directory).manifest
+        except FileNotFoundError:
+            return {}
+
+    def _save(self, manifest):
+        path = os.path.join(self.directory, MANIFEST)
+        with open(f"{path}.new", "w") as stream:
+            json.dump(manifest, stream, indent=2)
+        os.replace(f"{path}.new", path)
@@ -0,0 +1,92 @@
+import re
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import OperationalError, connections
+
+from . import metrics
+from .sharding import get_shards
+
+DEFAULTS = {
+    "DEFAULT": 5.0,
+    "ENDPOINTS": {},
+}
+
+# Execution time budgets of the read statements of GET endpoints, enforced by
+# the database so a runaway filter cannot tie up a worker and the database:
+#
+# - MySQL gets a MAX_EXECUTION_TIME optimizer hint on every SELECT;
+# - SQLite gets a progress handler interrupting statements past the budget,
+#   which also covers rows fetched after the statement started.
+#
+# Other backends run without a budget.
+MYSQL_TIMEOUT = 3024  # ER_QUERY_TIMEOUT
+SQLITE_PROGRESS_STEPS = 1000  # virtual machine instructions between checks.
+SELECT = re.compile(r"^\s*SELECT\b", re.IGNORECASE)
+
+
+def get_setting(name):
+    return getattr(settings, "WALLET_STATEMENT_BUDGETS", {}).get(name, DEFAULTS[name])
+
+
+def get_budget(endpoint):
+    # Seconds per statement of `endpoint` ("<basename>.<action>"), or None.
+    return get_setting("ENDPOINTS").get(endpoint, get_setting("DEFAULT"))
+
+
+def with_max_execution_time(sql, milliseconds):
+    return SELECT.sub(f"SELECT /*+ MAX_EXECUTION_TIME({milliseconds}) */", sql, count=1)
+
+
+class StatementBudget:
+    # execute_wrapper giving every SELECT `seconds` to run.
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.deadline = float("inf")
+
+    def __call__(self, execute, sql, params, many, context):
+        if not SELECT.match(sql):
+            self.deadline = float("inf")
+            return execute(sql, params, many, context)
+        if context["connection"].vendor == "mysql":
+            sql = with_max_execution_time(sql, max(1, int(self.seconds * 1000)))
+        self.deadline = time.monotonic() + self.seconds
+        return execute(sql, params, many, context)
+
+    def expired(self):
+        # SQLite progress handler, a true result interrupts the statement.
+        return time.monotonic() > self.deadline
+
+
+@contextmanager
+def statement_budget(seconds):
+    # Applies the budget to the statements run inside on every shard.
+    if seconds is None:
+        yield
+        return
+    with ExitStack() as stack:
+        for alias in get_shards():
+            connection = connections[alias]
+            budget = StatementBudget(seconds)
+            stack.enter_context(connection.execute_wrapper(budget))
+            if connection.vendor == "sqlite":
+                connection.ensure_connection()
+                raw = connection.connection
+                raw.set_progress_handler(budget.expired, SQLITE_PROGRESS_STEPS)
+                stack.callback(raw.set_progress_handler, None, 0)
+        yield
+
+
+def is_timeout(error):
+    if not isinstance(error, OperationalError):
+        return False
+    code = (error.args or (None,))[0]
+    return code == MYSQL_TIMEOUT or code == "interrupted"
+
+
+CUT_OFF = metrics.counter(
+    "wallet_statement_timeouts_total",
+    "Read statements cut off by their endpoint's time budget.",
+)
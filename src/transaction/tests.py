@@ -1,8 +1,60 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest.mock import patch
+
+import msgpack
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.cache import caches
+from django.core.exceptions import MiddlewareNotUsed
 from django.core.validators import MinValueValidator
+from django.db import OperationalError, connection
+from django.db.models import F
+from django.test import Client, LiveServerTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from rest_framework import status
-from rest_framework.test import APITestCase
-
-from .models import Transaction, Wallet
+from rest_framework.exceptions import ValidationError
+from rest_framework.test import APIClient, APITestCase
+
+from . import metrics, response_cache
+from .admission import CacheCounter, WalletBusy, get_controller
+from .capture import CaptureMiddleware, endpoint, get_log, read_entries
+from .concurrency import AUTO, OPTIMISTIC, PESSIMISTIC, resolve_mode, tracker
+from .events import EventBus, LocalBackend
+from .exceptions import (
+    HoldNotActiveError,
+    InsufficientFundsError,
+    WalletLockTimeoutError,
+)
+from .holds import authorize, capture
+from .models import (
+    Hold,
+    OutboxEvent,
+    PreparedTransfer,
+    Transaction,
+    TransferIntent,
+    Wallet,
+)
+from .netting import Batch, settle
+from .profiling import ProfilingMiddleware, get_store
+from .renderers import MEDIA_TYPE as MESSAGEPACK_MEDIA_TYPE
+from .serializers import MinorUnitsField
+from .sharding import allocator, shard_for
+from .snapshots import Snapshot
+from .statement_budgets import CUT_OFF as STATEMENT_TIMEOUTS, with_max_execution_time
+from .transfers import transfer
+from .urls import router
 
 TRANSACTION_BASE_API_URL = "/api/transactions"
 WALLET_BASE_API_URL = "/api/wallets"
@@ -65,7 +117,7 @@ class TransactionModelTest(APITestCase):
         self.assertEqual(id_field.get_internal_type(), "BigAutoField")
         self.assertEqual(id_field.unique, True)
         self.assertEqual(id_field.null, False)
-        self.assertEqual(amount_field.get_internal_type(), "DecimalField")
+        self.assertEqual(amount_field.get_internal_type(), "BigIntegerField")
         wallet = Transaction.objects.create(
             wallet=Wallet.objects.create(
                 label="Test Wallet for transaction", balance=100
@@ -96,7 +148,7 @@ class WalletModelTest(APITestCase):
         self.assertEqual(id_field.get_internal_type(), "BigAutoField")
         self.assertEqual(id_field.unique, True)
         self.assertEqual(id_field.null, False)
-        self.assertEqual(balance_field.get_internal_type(), "DecimalField")
+        self.assertEqual(balance_field.get_internal_type(), "BigIntegerField")
         self.assertIsNotNone(min_value_validator)
         wallet = Wallet.objects.create(label="Test Wallet", balance=100)
         self.assertEqual(str(wallet), "Test Wallet: 100")
@@ -638,3 +690,2118 @@ class WalletViewTest(BaseTestCase):
         data = {"data": {"type": "Wallet", "attributes": {"label": "string"}}}
         response = self.client.post("/api/wallets/", data=data)
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+
+class ImportLedgerCommandTest(APITestCase):
+    """import_ledger management command unit tests."""
+
+    def _write(self, name, content):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, name)
+        with open(path, "w", encoding="utf-8") as stream:
+            stream.write(content)
+        return path
+
+    def test_import_csv(self):
+        wallet = Wallet.objects.create(label="existing wallet", balance=10)
+        path = self._write(
+            "ledger.csv",
+            "wallet,label,txid,amount\n"
+            f"{wallet.id},,import 1,5\n"
+            "500,partner wallet,import 2,7\n"
+            "500,,import 3,-2\n",
+        )
+        call_command("import_ledger", path, chunk_size=2, stdout=StringIO())
+        self.assertEqual(Wallet.objects.get(id=wallet.id).balance, 15)
+        new_wallet = Wallet.objects.get(id=500)
+        self.assertEqual(new_wallet.label, "partner wallet")
+        self.assertEqual(new_wallet.balance, 5)
+        self.assertEqual(Transaction.objects.count(), 3)
+
+    def test_import_publishes_events_on_commit(self):
+        bus = EventBus(LocalBackend(history_size=10))
+        patcher = patch("transaction.events._bus", bus)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        path = self._write("ledger.csv", "wallet,label,txid,amount\n600,a,pub,4\n")
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("import_ledger", path, stdout=StringIO())
+        self.assertEqual(
+            [(event.type, event.wallet_id) for event in bus.backend.history(0)],
+            [("balance", 600), ("transaction", 600)],
+        )
+
+    def test_import_ndjson_skips_existing_txids(self):
+        path = self._write(
+            "ledger.ndjson",
+            '{"wallet": 700, "label": "a", "txid": "dup", "amount": 3}\n'
+            '{"wallet": 700, "label": "a", "txid": "dup", "amount": 3}\n',
+        )
+        call_command("import_ledger", path, stdout=StringIO())
+        call_command("import_ledger", path, stdout=StringIO())
+        self.assertEqual(Wallet.objects.get(id=700).balance, 3)
+        self.assertEqual(Transaction.objects.filter(txid="dup").count(), 1)
+
+    def test_import_negative_balance(self):
+        path = self._write("ledger.csv", "wallet,label,txid,amount\n800,a,neg,-1\n")
+        with self.assertRaises(CommandError):
+            call_command("import_ledger", path, stdout=StringIO())
+        self.assertFalse(Wallet.objects.filter(id=800).exists())
+
+    def test_import_resumes_from_checkpoint(self):
+        path = self._write(
+            "ledger.csv",
+            "wallet,label,txid,amount\n900,a,first,1\n900,a,second,2\n",
+        )
+        checkpoint = f"{path}.checkpoint"
+        with open(checkpoint, "w", encoding="utf-8") as stream:
+            json.dump({"path": os.path.abspath(path), "rows": 1}, stream)
+        call_command(
+            "import_ledger",
+            path,
+            chunk_size=1,
+            checkpoint=checkpoint,
+            stdout=StringIO(),
+        )
+        self.assertEqual(Wallet.objects.get(id=900).balance, 2)
+        with open(checkpoint, encoding="utf-8") as stream:
+            self.assertEqual(json.load(stream)["rows"], 2)
+
+
+class ConditionalGetTest(BaseTestCase):
+    """ETag / If-None-Match unit tests."""
+
+    def test_wallet_retrieve_not_modified(self):
+        response = self.client.get(f"{WALLET_BASE_API_URL}/{self.test_wallet.id}/")
+        etag = response["ETag"]
+        response = self.client.get(
+            f"{WALLET_BASE_API_URL}/{self.test_wallet.id}/", HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response["ETag"], etag)
+
+    def test_wallet_etag_changes_on_deposit_and_label_edit(self):
+        url = f"{WALLET_BASE_API_URL}/{self.test_wallet.id}/"
+        first_etag = self.client.get(url)["ETag"]
+        self.test_wallet.deposit(10)
+        second_etag = self.client.get(url)["ETag"]
+        self.assertNotEqual(first_etag, second_etag)
+        data = {
+            "data": {
+                "type": "Wallet",
+                "id": self.test_wallet.id,
+                "attributes": {"label": "relabeled"},
+            }
+        }
+        self.client.patch(url, data=data)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=second_etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response["ETag"], second_etag)
+
+    def test_wallet_list_not_modified(self):
+        url = f"{WALLET_BASE_API_URL}/?balance=0"
+        etag = self.client.get(url)["ETag"]
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        Wallet.objects.create(label="new wallet")
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_wallet_list_not_modified_reads_only_versions(self):
+        url = f"{WALLET_BASE_API_URL}/"
+        response = self.client.get(url)
+        etag = response["ETag"]
+        listed = Wallet.objects.get(id=response.json()["data"][0]["id"])
+        # The capped count and the page's id/version pairs, nothing rendered.
+        with self.assertNumQueries(2) as queries:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertNotIn('"label"', queries.captured_queries[-1]["sql"])
+        listed.deposit(1)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_transaction_retrieve_not_modified(self):
+        transaction = self.transactions[0]
+        url = f"{TRANSACTION_BASE_API_URL}/{transaction.id}/"
+        etag = self.client.get(url)["ETag"]
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.test_wallet.deposit(1)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class OptimisticConcurrencyTest(APITestCase):
+    """Optimistic balance update unit tests."""
+
+    def setUp(self):
+        tracker.reset()
+        self.wallet = Wallet.objects.create(
+            label="optimistic", balance=100, concurrency_mode=OPTIMISTIC
+        )
+
+    def test_optimistic_deposit_and_withdraw(self):
+        self.wallet.deposit(10)
+        self.wallet.withdraw(30)
+        wallet = Wallet.objects.get(id=self.wallet.id)
+        self.assertEqual(wallet.balance, 80)
+        self.assertEqual(wallet.version, 2)
+        self.assertEqual(tracker.conflicts, 0)
+
+    def test_optimistic_insufficient_funds(self):
+        with self.assertRaises(InsufficientFundsError):
+            self.wallet.withdraw(1000)
+        self.assertEqual(Wallet.objects.get(id=self.wallet.id).balance, 100)
+
+    def test_optimistic_conflict_is_retried(self):
+        check_funds = Wallet._check_funds
+
+        def concurrent_writer(balance, amount):
+            # Simulates another writer committing between the read and the CAS.
+            if tracker.attempts == 0:
+                Wallet.objects.filter(id=self.wallet.id).update(
+                    balance=F("balance") + 5, version=F("version") + 1
+                )
+            check_funds(balance, amount)
+
+        with patch.object(Wallet, "_check_funds", side_effect=concurrent_writer):
+            self.wallet.withdraw(10)
+        wallet = Wallet.objects.get(id=self.wallet.id)
+        self.assertEqual(wallet.balance, 95)
+        self.assertEqual(wallet.version, 2)
+        self.assertEqual(tracker.conflicts, 1)
+
+    def test_auto_mode_switches_to_pessimistic(self):
+        self.wallet.concurrency_mode = AUTO
+        self.assertEqual(resolve_mode(self.wallet), OPTIMISTIC)
+        for _ in range(10):
+            tracker.record(self.wallet.id, conflicted=True)
+        self.assertEqual(resolve_mode(self.wallet), PESSIMISTIC)
+
+    def test_wallet_create_with_concurrency_mode(self):
+        data = {
+            "data": {
+                "type": "Wallet",
+                "attributes": {"label": "string", "concurrency_mode": OPTIMISTIC},
+            }
+        }
+        response = self.client.post(f"{WALLET_BASE_API_URL}/", data=data)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(
+            Wallet.objects.get(label="string").concurrency_mode, OPTIMISTIC
+        )
+
+
+class WalletSoftDeleteTest(BaseTestCase):
+    """Soft delete and purge_wallets unit tests."""
+
+    def test_wallet_delete_is_soft(self):
+        response = self.client.delete(f"{WALLET_BASE_API_URL}/{self.test_wallet.id}/")
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(Wallet.objects.filter(id=self.test_wallet.id).exists())
+        self.assertTrue(Wallet.all_objects.filter(id=self.test_wallet.id).exists())
+        response = self.client.get(f"{WALLET_BASE_API_URL}/{self.test_wallet.id}/")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get(
+            f"{TRANSACTION_BASE_API_URL}/?wallet={self.test_wallet_2.id}"
+        )
+        self.assertEqual(len(response.data.get("results")), 5)
+        response = self.client.get(f"{TRANSACTION_BASE_API_URL}/")
+        self.assertEqual(response.data["meta"]["pagination"]["count"], 5)
+
+    def test_purge_wallets(self):
+        self.client.delete(f"{WALLET_BASE_API_URL}/{self.test_wallet.id}/")
+        call_command("purge_wallets", batch_size=2, stdout=StringIO())
+        self.assertFalse(Wallet.all_objects.filter(id=self.test_wallet.id).exists())
+        self.assertFalse(
+            Transaction.objects.filter(wallet_id=self.test_wallet.id).exists()
+        )
+        self.assertEqual(
+            Transaction.objects.filter(wallet_id=self.test_wallet_2.id).count(), 5
+        )
+
+    def test_purge_wallets_records_events(self):
+        self.client.delete(f"{WALLET_BASE_API_URL}/{self.test_wallet.id}/")
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            call_command("purge_wallets", batch_size=2, stdout=StringIO())
+        events = OutboxEvent.objects.filter(wallet_id=self.test_wallet.id)
+        self.assertEqual(
+            events.filter(topic="transaction", payload__action="purged").count(),
+            6,
+        )
+        self.assertTrue(events.filter(topic="wallet").exists())
+        self.assertTrue(callbacks)
+
+
+class TransactionBulkReverseTest(BaseTestCase):
+    """Bulk transaction reversal unit tests."""
+
+    def test_bulk_reverse(self):
+        wallet_balance = Wallet.objects.get(id=self.test_wallet.id).balance
+        wallet_2_balance = Wallet.objects.get(id=self.test_wallet_2.id).balance
+        response = self.client.post(f"{TRANSACTION_BASE_API_URL}/reverse/?amount__gt=6")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            sorted(response.data["wallets"], key=lambda item: item["wallet"]),
+            [
+                {"wallet": self.test_wallet.id, "amount": -18, "reversed": 2},
+                {"wallet": self.test_wallet_2.id, "amount": -16, "reversed": 2},
+            ],
+        )
+        self.assertEqual(response.data["reversed"], 4)
+        self.assertFalse(Transaction.objects.filter(amount__gt=6).exists())
+        self.assertEqual(
+            Wallet.objects.get(id=self.test_wallet.id).balance, wallet_balance - 18
+        )
+        self.assertEqual(
+            Wallet.objects.get(id=self.test_wallet_2.id).balance,
+            wallet_2_balance - 16,
+        )
+
+    def test_bulk_reverse_insufficient_funds(self):
+        Transaction.objects.create(
+            wallet=self.test_wallet, txid="bulk negative", amount=-30
+        )
+        response = self.client.post(
+            f"{TRANSACTION_BASE_API_URL}/reverse/?wallet={self.test_wallet.id}"
+            "&amount__gt=0"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Transaction.objects.filter(wallet=self.test_wallet).count(), 7)
+
+    def test_bulk_reverse_requires_filter(self):
+        response = self.client.post(f"{TRANSACTION_BASE_API_URL}/reverse/")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Transaction.objects.count(), 11)
+
+    def test_transaction_delete_removes_row(self):
+        transaction = Transaction.objects.create(
+            wallet=self.test_wallet, txid="delete me", amount=-4
+        )
+        balance = Wallet.objects.get(id=self.test_wallet.id).balance
+        response = self.client.delete(f"{TRANSACTION_BASE_API_URL}/{transaction.id}/")
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(Transaction.objects.filter(id=transaction.id).exists())
+        self.assertEqual(
+            Wallet.objects.get(id=self.test_wallet.id).balance, balance + 4
+        )
+
+
+class AuditQueryPlansCommandTest(APITestCase):
+    """audit_query_plans management command unit tests."""
+
+    def test_audit_query_plans(self):
+        out = StringIO()
+        call_command("audit_query_plans", stdout=out)
+        plans = {
+            tuple(line.split()[:3]): line.split()[3:]
+            for line in out.getvalue().splitlines()[:-1]
+        }
+        self.assertEqual(
+            plans[("TransactionViewSet", "amount__gt=&wallet__exact=", "-amount")],
+            ["ok"],
+        )
+        self.assertEqual(plans[("TransactionViewSet", "-", "-amount")], ["ok"])
+        self.assertEqual(plans[("WalletViewSet", "balance__gt=", "balance")], ["ok"])
+        self.assertEqual(plans[("WalletViewSet", "-", "label")], ["ok"])
+        self.assertEqual(
+            plans[("TransactionViewSet", "wallet__exact=", "txid")], ["ok"]
+        )
+
+    def test_audit_query_plans_gate_passes(self):
+        out = StringIO()
+        call_command("audit_query_plans", fail_on_flags=True, stdout=out)
+        self.assertIn("0 of", out.getvalue().splitlines()[-1])
+        self.assertIn(
+            "filesort (accepted)",
+            next(
+                line
+                for line in out.getvalue().splitlines()
+                if "balance__lt=" in line and " label " in line
+            ),
+        )
+
+    def test_audit_query_plans_fail_without_accepted_plans(self):
+        with self.assertRaises(CommandError):
+            call_command(
+                "audit_query_plans", fail_on_flags=True, accepted="", stdout=StringIO()
+            )
+
+
+class SparseFieldsetsTest(BaseTestCase):
+    """Sparse fieldsets unit tests."""
+
+    def test_wallet_retrieve_balance_only(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                f"{WALLET_BASE_API_URL}/{self.test_wallet.id}/?fields[Wallet]=balance"
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(dict(response.data), {"balance": 30})
+        self.assertFalse(any('"label"' in query["sql"] for query in queries))
+        self.assertFalse(
+            any("transaction_transaction" in query["sql"] for query in queries)
+        )
+
+    def test_transaction_list_amount_only(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                f"{TRANSACTION_BASE_API_URL}/?fields[Transaction]=amount"
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(set(response.data["results"][0]), {"id", "amount"})
+        self.assertFalse(any('"txid"' in query["sql"] for query in queries))
+
+
+class WalletEventsTest(APITestCase):
+    """Server-Sent Events unit tests."""
+
+    def setUp(self):
+        self.bus = EventBus(LocalBackend(history_size=10))
+        patcher = patch("transaction.events._bus", self.bus)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.wallet = Wallet.objects.create(label="events wallet")
+        self.other_wallet = Wallet.objects.create(label="other wallet")
+
+    def test_balance_events_published_on_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.wallet.deposit(10)
+            self.assertEqual(self.bus.backend.history(0), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            Transaction.objects.create(wallet=self.wallet, txid="event", amount=5)
+        events = self.bus.backend.history(0)
+        self.assertEqual(
+            [(event.type, event.data.get("balance")) for event in events],
+            [("balance", 10), ("balance", 15), ("transaction", None)],
+        )
+
+    async def test_stream_resumes_after_last_event_id(self):
+        self.bus.publish("balance", self.wallet.id, {"balance": 1})
+        self.bus.publish("balance", self.other_wallet.id, {"balance": 1})
+        self.bus.publish("balance", self.wallet.id, {"balance": 2})
+        response = await self.async_client.get(
+            f"{WALLET_BASE_API_URL}/{self.wallet.id}/events/",
+            headers={"Last-Event-ID": "1"},
+        )
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        chunks = response.streaming_content
+        self.assertTrue((await anext(chunks)).startswith(b"retry:"))
+        event = await anext(chunks)
+        self.assertTrue(event.startswith(b"id: 3\nevent: balance\n"))
+        self.bus.publish("balance", self.wallet.id, {"balance": 3})
+        self.assertTrue((await anext(chunks)).startswith(b"id: 4\n"))
+        await chunks.aclose()
+
+    async def test_stream_resets_on_id_from_another_backend(self):
+        # A client coming from a restarted worker, or another worker, has an
+        # id this backend never assigned: it is reset, live events still flow.
+        self.bus.publish("balance", self.wallet.id, {"balance": 1})
+        self.assertIsNone(self.bus.backend.history(50))
+        response = await self.async_client.get(
+            f"{WALLET_BASE_API_URL}/{self.wallet.id}/events/",
+            headers={"Last-Event-ID": "50"},
+        )
+        chunks = response.streaming_content
+        await anext(chunks)
+        self.assertEqual(await anext(chunks), b"event: reset\ndata: {}\n\n")
+        self.bus.publish("balance", self.wallet.id, {"balance": 2})
+        self.assertTrue((await anext(chunks)).startswith(b"id: 2\n"))
+        await chunks.aclose()
+
+    async def test_stream_overflow_closes_subscription(self):
+        with self.settings(WALLET_EVENTS={"QUEUE_SIZE": 1}):
+            response = await self.async_client.get(
+                f"{WALLET_BASE_API_URL}/events/?wallets={self.wallet.id},"
+                f"{self.other_wallet.id}"
+            )
+            chunks = response.streaming_content
+            await anext(chunks)
+            for balance in range(3):
+                self.bus.publish("balance", self.other_wallet.id, {"balance": balance})
+            await asyncio.sleep(0)
+            self.assertEqual(await anext(chunks), b"event: overflow\ndata: {}\n\n")
+
+    def test_stream_unknown_wallet(self):
+        response = self.client.get(f"{WALLET_BASE_API_URL}/100000/events/")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+def collect_batches(batch):
+    OutboxTest.batches.append([event.id for event in batch])
+
+
+class OutboxTest(APITestCase):
+    """Transactional outbox and drain_outbox command unit tests."""
+
+    batches = []
+
+    def setUp(self):
+        self.wallet = Wallet.objects.create(label="outbox wallet")
+        OutboxTest.batches = []
+
+    def _events(self):
+        return list(OutboxEvent.objects.order_by("id").values_list("topic", "payload"))
+
+    def test_changes_are_written_to_outbox(self):
+        tx = Transaction.objects.create(wallet=self.wallet, txid="outbox", amount=10)
+        tx_id = tx.id
+        tx.delete()
+        self.assertEqual(
+            self._events(),
+            [
+                ("balance", {"balance": 10, "version": 1, "amount": 10}),
+                (
+                    "transaction",
+                    {"action": "created", "id": tx_id, "txid": "outbox", "amount": 10},
+                ),
+                ("balance", {"balance": 0, "version": 2, "amount": -10}),
+                (
+                    "transaction",
+                    {"action": "deleted", "id": tx_id, "txid": "outbox", "amount": 10},
+                ),
+            ],
+        )
+
+    def test_rolled_back_change_is_not_written(self):
+        with self.assertRaises(InsufficientFundsError):
+            Transaction.objects.create(wallet=self.wallet, txid="outbox", amount=-10)
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_bulk_reverse_writes_outbox(self):
+        Transaction.objects.create(wallet=self.wallet, txid="a", amount=10)
+        Transaction.objects.create(wallet=self.wallet, txid="b", amount=5)
+        OutboxEvent.objects.all().delete()
+        Transaction.objects.filter(wallet=self.wallet).bulk_reverse()
+        self.assertEqual(
+            sorted(
+                (topic, payload.get("action"), payload["amount"])
+                for topic, payload in self._events()
+            ),
+            [
+                ("balance", None, -15),
+                ("transaction", "deleted", 5),
+                ("transaction", "deleted", 10),
+            ],
+        )
+
+    def test_drain_writes_ndjson_and_deletes(self):
+        Transaction.objects.create(wallet=self.wallet, txid="drain", amount=3)
+        stdout = StringIO()
+        call_command("drain_outbox", stdout=stdout, stderr=StringIO())
+        lines = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual([line["topic"] for line in lines], ["balance", "transaction"])
+        self.assertEqual(lines[1]["txid"], "drain")
+        self.assertEqual(lines[1]["wallet"], self.wallet.id)
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_drain_batches_to_sink(self):
+        for index in range(3):
+            Transaction.objects.create(wallet=self.wallet, txid=str(index), amount=1)
+        ids = list(OutboxEvent.objects.order_by("id").values_list("id", flat=True))
+        call_command(
+            "drain_outbox",
+            batch_size=4,
+            sink="transaction.tests.collect_batches",
+            stderr=StringIO(),
+        )
+        self.assertEqual(self.batches, [ids[:4], ids[4:]])
+
+    def test_failed_delivery_keeps_events(self):
+        Transaction.objects.create(wallet=self.wallet, txid="fail", amount=1)
+        with patch(
+            "transaction.tests.collect_batches", side_effect=ConnectionError
+        ), self.assertRaises(ConnectionError):
+            call_command(
+                "drain_outbox",
+                sink="transaction.tests.collect_batches",
+                stderr=StringIO(),
+            )
+        self.assertEqual(OutboxEvent.objects.count(), 2)
+
+
+class AuditLedgerCommandTest(APITestCase):
+    """audit_ledger management command unit tests."""
+
+    def _audit(self, **options):
+        stdout = StringIO()
+        call_command("audit_ledger", stdout=stdout, **options)
+        return stdout.getvalue().splitlines()
+
+    def test_consistent_ledger(self):
+        for label in ("a", "b"):
+            wallet = Wallet.objects.create(label=label)
+            for index in range(3):
+                Transaction.objects.create(
+                    wallet=wallet, txid=f"{label}{index}", amount=index + 1
+                )
+        Wallet.objects.create(label="empty")
+        lines = self._audit(chunk_size=2)
+        self.assertEqual(len(lines), 1)
+        self.assertIn("Audited 6 transactions of 3 wallets", lines[0])
+        self.assertTrue(lines[0].endswith("0 mismatches, 0 negative balances."))
+
+    def test_mismatch_and_negative_balance(self):
+        wallet = Wallet.objects.create(label="negative", balance=5)
+        other = Wallet.objects.create(label="mismatch", balance=7)
+        Transaction.objects.bulk_create(
+            [
+                Transaction(wallet=wallet, txid="1", amount=3),
+                Transaction(wallet=other, txid="2", amount=4),
+                Transaction(wallet=wallet, txid="3", amount=-8),
+            ]
+        )
+        Transaction.objects.bulk_create(
+            [
+                Transaction(wallet=wallet, txid="4", amount=-1),
+                Transaction(wallet=wallet, txid="5", amount=11),
+            ]
+        )
+        negative_tx = Transaction.objects.get(txid="3")
+        lines = self._audit(chunk_size=2)
+        self.assertEqual(
+            lines[:2],
+            [
+                f"Wallet {other.id}: balance 7 != transactions sum 4.",
+                f"Wallet {wallet.id}: balance went negative (-5) "
+                f"at transaction {negative_tx.id}.",
+            ],
+        )
+        self.assertTrue(lines[2].endswith("1 mismatches, 1 negative balances."))
+        with self.assertRaises(CommandError):
+            self._audit(fail_on_errors=True)
+
+    def test_stale_snapshot_is_rechecked(self):
+        wallet = Wallet.objects.create(label="racy")
+        Transaction.objects.create(wallet=wallet, txid="racy", amount=5)
+        # A balance snapshot taken before the transaction was committed.
+        with patch(
+            "transaction.management.commands.audit_ledger.Command._snapshot",
+            return_value=(np.array([wallet.id]), np.array([0])),
+        ):
+            lines = self._audit()
+        self.assertTrue(lines[0].endswith("0 mismatches, 0 negative balances."))
+
+
+class AdmissionControlTest(APITestCase):
+    """Per-wallet admission control unit tests."""
+
+    def setUp(self):
+        self.wallet = Wallet.objects.create(label="hot wallet")
+        self.controller = get_controller()
+
+    def _create(self, txid):
+        data = {
+            "data": {
+                "type": "Transaction",
+                "attributes": {"wallet": self.wallet.id, "txid": txid, "amount": 5},
+            }
+        }
+        return self.client.post(f"{TRANSACTION_BASE_API_URL}/", data=data)
+
+    @override_settings(WALLET_ADMISSION={"MAX_IN_FLIGHT": 2})
+    def test_rejects_above_queue_depth(self):
+        with self.controller.admit([self.wallet.id]):
+            with self.controller.admit([self.wallet.id]):
+                with self.assertRaises(WalletBusy):
+                    with self.controller.admit([self.wallet.id, 100000]):
+                        pass
+                self.assertEqual(
+                    self.controller.local.counts(),
+                    {f"wallet-admission:{self.wallet.id}": 2},
+                )
+        self.assertEqual(self.controller.local.counts(), {})
+        with self.controller.admit([self.wallet.id, 100000]):
+            pass
+
+    @override_settings(WALLET_ADMISSION={"MAX_IN_FLIGHT": 1, "RETRY_AFTER": 3})
+    def test_api_returns_429_with_retry_after(self):
+        with self.controller.admit([self.wallet.id]):
+            response = self._create("busy")
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response["Retry-After"], "3")
+        self.assertEqual(response.json()["errors"][0]["code"], "wallet_busy")
+        self.assertFalse(Transaction.objects.filter(txid="busy").exists())
+        self.assertEqual(self._create("admitted").status_code, status.HTTP_201_CREATED)
+
+    @override_settings(WALLET_ADMISSION={"MAX_IN_FLIGHT": 0})
+    def test_metrics(self):
+        self._create("rejected")
+        response = self.client.get("/api/metrics/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        body = response.content.decode()
+        self.assertIn("# TYPE wallet_admission_rejected_total counter", body)
+        self.assertRegex(body, r"wallet_admission_rejected_total [1-9]")
+        self.assertIn("wallet_admission_in_flight 0", body)
+
+    def test_cache_counter(self):
+        counter = CacheCounter()
+        self.assertEqual(counter.incr("admission-test"), 1)
+        self.assertEqual(counter.incr("admission-test"), 2)
+        counter.decr("admission-test")
+        self.assertEqual(counter.incr("admission-test"), 2)
+
+    def test_cache_counter_alias(self):
+        locmem = "django.core.cache.backends.locmem.LocMemCache"
+        with self.settings(
+            CACHES={
+                "default": {"BACKEND": locmem},
+                "admission": {"BACKEND": locmem, "LOCATION": "admission"},
+            },
+            WALLET_ADMISSION={"CACHE": "admission"},
+        ):
+            CacheCounter().incr("admission-alias")
+            self.assertEqual(caches["admission"].get("admission-alias"), 1)
+            self.assertIsNone(caches["default"].get("admission-alias"))
+
+    def test_metric_values_are_exact(self):
+        self.assertEqual(metrics.format_value(1234567.0), "1234567")
+        self.assertEqual(metrics.format_value(2**60), str(2**60))
+        self.assertEqual(metrics.format_value(0.25), "0.25")
+
+
+class LockHolderError(Exception):
+    # Stands in for the driver error of a lock held by another transaction.
+    pass
+
+
+class WalletLockPolicyTest(APITestCase):
+    """Wallet row lock policies unit tests."""
+
+    def setUp(self):
+        self.wallet = Wallet.objects.create(label="locked wallet", balance=10)
+        self.statements = []
+        # SQLite has no row locks, FOR UPDATE is rendered as on MySQL and
+        # the wrapper below fails it like a wallet locked by another writer.
+        for feature in ("has_select_for_update", "has_select_for_update_nowait"):
+            patcher = patch.object(connection.features, feature, True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _lock_holder(self, code):
+        def execute(execute, sql, params, many, context):
+            self.statements.append(sql % tuple(params or ()))
+            if sql.startswith("SET "):
+                return None
+            if "FOR UPDATE" in sql:
+                raise OperationalError() from LockHolderError(code, "Lock wait")
+            return execute(sql, params, many, context)
+
+        return connection.execute_wrapper(execute)
+
+    def _withdraw(self):
+        data = {
+            "data": {
+                "type": "Transaction",
+                "attributes": {"wallet": self.wallet.id, "txid": "lock", "amount": -1},
+            }
+        }
+        return self.client.post(f"{TRANSACTION_BASE_API_URL}/", data=data)
+
+    @override_settings(WALLET_CONCURRENCY={"LOCK_POLICY": "nowait"})
+    def test_nowait_returns_409(self):
+        with self._lock_holder(3572):
+            response = self._withdraw()
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response["Retry-After"], "1")
+        self.assertEqual(response.json()["errors"][0]["code"], "wallet_locked")
+        self.assertTrue(any("FOR UPDATE NOWAIT" in sql for sql in self.statements))
+        self.assertEqual(Wallet.objects.get(id=self.wallet.id).balance, 10)
+        self.assertFalse(Transaction.objects.filter(txid="lock").exists())
+
+    @override_settings(WALLET_CONCURRENCY={"LOCK_POLICY": "block"})
+    def test_block_maps_lock_wait_timeout_to_503(self):
+        with self._lock_holder(1205):
+            response = self._withdraw()
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response.json()["errors"][0]["code"], "wallet_lock_timeout")
+
+    @override_settings(
+        WALLET_CONCURRENCY={"LOCK_POLICY": "timeout", "LOCK_TIMEOUT": 1.5}
+    )
+    def test_timeout_sets_session_lock_timeout(self):
+        with patch.object(connection, "vendor", "mysql"), self._lock_holder(1205):
+            with self.assertRaises(WalletLockTimeoutError):
+                self.wallet.deposit(1)
+        self.assertEqual(
+            [sql for sql in self.statements if sql.startswith("SET ")],
+            [
+                "SET SESSION innodb_lock_wait_timeout = 2",
+                "SET SESSION innodb_lock_wait_timeout = DEFAULT",
+            ],
+        )
+
+    def test_other_errors_are_not_mapped(self):
+        with self._lock_holder(1064), self.assertRaises(OperationalError):
+            self.wallet.deposit(1)
+
+
+class WalletCountersTest(APITestCase):
+    """Wallet transactions count and last activity unit tests."""
+
+    def setUp(self):
+        self.wallet = Wallet.objects.create(label="counted wallet")
+        self.other_wallet = Wallet.objects.create(label="other wallet")
+
+    def _counters(self, wallet):
+        return Wallet.objects.values_list("transactions_count", "last_activity_at").get(
+            id=wallet.id
+        )
+
+    def test_counters_follow_transaction_writes(self):
+        self.assertEqual(self._counters(self.wallet), (0, None))
+        tx = Transaction.objects.create(wallet=self.wallet, txid="a", amount=10)
+        Transaction.objects.create(wallet=self.wallet, txid="b", amount=2)
+        count, first_activity = self._counters(self.wallet)
+        self.assertEqual(count, 2)
+        self.assertIsNotNone(first_activity)
+
+        data = {
+            "data": {
+                "type": "Transaction",
+                "id": tx.id,
+                "attributes": {"wallet": self.other_wallet.id, "amount": 3},
+            }
+        }
+        response = self.client.patch(f"{TRANSACTION_BASE_API_URL}/{tx.id}/", data=data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self._counters(self.wallet)[0], 1)
+        self.assertEqual(self._counters(self.other_wallet)[0], 1)
+        self.assertGreaterEqual(self._counters(self.wallet)[1], first_activity)
+
+        Transaction.objects.get(id=tx.id).delete()
+        self.assertEqual(self._counters(self.other_wallet)[0], 0)
+        Transaction.objects.filter(wallet=self.wallet).bulk_reverse()
+        self.assertEqual(self._counters(self.wallet)[0], 0)
+
+    def test_optimistic_mode_counts(self):
+        Wallet.objects.filter(id=self.wallet.id).update(concurrency_mode=OPTIMISTIC)
+        self.wallet.refresh_from_db()
+        Transaction.objects.create(wallet=self.wallet, txid="cas", amount=1)
+        self.assertEqual(self._counters(self.wallet)[0], 1)
+
+    def test_filter_and_sort(self):
+        for index in range(3):
+            Transaction.objects.create(wallet=self.wallet, txid=str(index), amount=1)
+        response = self.client.get(
+            f"{WALLET_BASE_API_URL}/?transactions_count__gte=2&sort=-transactions_count"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()["data"]
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]["attributes"]["transactions_count"], 3)
+        self.assertIsNotNone(data[0]["attributes"]["last_activity_at"])
+        response = self.client.get(
+            f"{WALLET_BASE_API_URL}/?sort=-transactions_count,-last_activity_at"
+        )
+        self.assertEqual(response.json()["data"][0]["id"], str(self.wallet.id))
+
+    def test_rebuild_command(self):
+        Transaction.objects.create(wallet=self.wallet, txid="a", amount=1)
+        Transaction.objects.create(wallet=self.other_wallet, txid="b", amount=1)
+        Wallet.objects.filter(id=self.wallet.id).update(transactions_count=7)
+        Wallet.objects.filter(id=self.other_wallet.id).update(transactions_count=0)
+        stdout = StringIO()
+        call_command("rebuild_wallet_counters", chunk_size=1, stdout=stdout)
+        self.assertEqual(self._counters(self.wallet)[0], 1)
+        self.assertEqual(self._counters(self.other_wallet)[0], 1)
+        self.assertIn("Rebuilt counters of 2 wallets, 2 fixed.", stdout.getvalue())
+
+
+class EstimatedCountPaginationTest(BaseTestCase):
+    """Estimated count pagination and admin unit tests."""
+
+    def _pagination(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.json()["meta"]["pagination"]
+
+    def test_small_table_is_counted_exactly(self):
+        pagination = self._pagination(f"{TRANSACTION_BASE_API_URL}/")
+        self.assertEqual(pagination["count"], Transaction.objects.count())
+        self.assertTrue(pagination["exact"])
+
+    @patch("transaction.pagination.estimate_count", return_value=50000)
+    def test_unfiltered_list_uses_estimate(self, estimate_count):
+        pagination = self._pagination(f"{TRANSACTION_BASE_API_URL}/")
+        self.assertEqual(
+            pagination, {"page": 1, "pages": 5000, "count": 50000, "exact": False}
+        )
+        pagination = self._pagination(
+            f"{TRANSACTION_BASE_API_URL}/?wallet={self.test_wallet.id}"
+        )
+        self.assertEqual(pagination["count"], 6)
+        self.assertTrue(pagination["exact"])
+        self.assertEqual(estimate_count.call_count, 1)
+
+    @patch("transaction.pagination.EstimatedCountPaginator.count_cap", 3)
+    def test_filtered_list_count_is_capped(self):
+        with CaptureQueriesContext(connection) as queries:
+            pagination = self._pagination(
+                f"{TRANSACTION_BASE_API_URL}/?wallet={self.test_wallet.id}"
+            )
+        self.assertEqual(pagination["count"], 3)
+        self.assertFalse(pagination["exact"])
+        self.assertTrue(any("LIMIT 4" in query["sql"] for query in queries))
+
+    @patch("transaction.pagination.EstimatedCountPaginator.count_cap", 3)
+    def test_pages_past_capped_count(self):
+        url = f"{TRANSACTION_BASE_API_URL}/?wallet={self.test_wallet.id}&page[size]=2"
+        # The 6 rows fill 3 pages although the capped count only covers 2.
+        for number, has_next in ((1, True), (2, True), (3, False)):
+            response = self.client.get(f"{url}&page[number]={number}")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            body = response.json()
+            self.assertEqual(len(body["data"]), 2)
+            self.assertEqual(body["links"]["next"] is not None, has_next)
+            self.assertIsNone(body["links"]["last"])
+            self.assertEqual(body["meta"]["pagination"]["count"], 3)
+        response = self.client.get(f"{url}&page[number]=4")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_admin_changelists(self):
+        user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.client.force_login(user)
+        for url in ("/admin/transaction/wallet/", "/admin/transaction/transaction/"):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(
+            f"/admin/transaction/transaction/{self.transactions[0].id}/change/"
+        )
+        self.assertContains(response, "vForeignKeyRawIdAdminField", count=0)
+        response = self.client.get("/admin/transaction/transaction/add/")
+        self.assertContains(response, "vForeignKeyRawIdAdminField")
+
+    def test_admin_bulk_delete_reverses_transactions(self):
+        # The admin takes form posts, not the JSON:API test format.
+        self.client = Client()
+        user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.client.force_login(user)
+        selected = [tx.id for tx in self.transactions[:11] if tx.amount > 6]
+        balance = Wallet.objects.get(id=self.test_wallet.id).balance
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                "/admin/transaction/transaction/",
+                {
+                    "action": "delete_selected",
+                    "_selected_action": selected,
+                    "post": "yes",
+                },
+            )
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertFalse(Transaction.objects.filter(id__in=selected).exists())
+        wallet = Wallet.objects.get(id=self.test_wallet.id)
+        self.assertEqual(wallet.balance, balance - 18)
+        self.assertEqual(wallet.transactions_count, 4)
+        self.assertEqual(
+            OutboxEvent.objects.filter(
+                topic="transaction", payload__action="deleted"
+            ).count(),
+            len(selected),
+        )
+
+    def test_admin_wallet_delete_is_soft(self):
+        # The admin takes form posts, not the JSON:API test format.
+        self.client = Client()
+        user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.client.force_login(user)
+        response = self.client.post(
+            f"/admin/transaction/wallet/{self.test_wallet.id}/delete/",
+            {"post": "yes"},
+        )
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertFalse(Wallet.objects.filter(id=self.test_wallet.id).exists())
+        self.assertTrue(Wallet.all_objects.filter(id=self.test_wallet.id).exists())
+        self.assertEqual(
+            Transaction.objects.filter(wallet_id=self.test_wallet.id).count(), 6
+        )
+        response = self.client.post(
+            "/admin/transaction/wallet/",
+            {
+                "action": "delete_selected",
+                "_selected_action": [self.test_wallet_2.id],
+                "post": "yes",
+            },
+        )
+        self.assertTrue(Wallet.all_objects.filter(id=self.test_wallet_2.id).exists())
+        self.assertFalse(Wallet.objects.filter(id=self.test_wallet_2.id).exists())
+
+
+@override_settings(WALLET_SHARDS=["default", "shard1"])
+class ShardingTest(APITestCase):
+    """Hash-sharded wallets and cross-shard transfers unit tests."""
+
+    databases = {"default", "shard1"}
+
+    def setUp(self):
+        allocator.reset()
+        self.wallets = [Wallet.objects.create(label=f"shard {i}") for i in range(4)]
+        for wallet in self.wallets:
+            wallet.deposit(100)
+        # Two wallets on "default" followed by two on "shard1".
+        self.wallets.sort(key=lambda wallet: (shard_for(wallet.id), wallet.id))
+
+    def _on_shard(self, wallet):
+        return Wallet.objects.using(shard_for(wallet.id)).get(id=wallet.id)
+
+    def _transfer(self, source, target, amount, txid):
+        return self.client.post(
+            f"{WALLET_BASE_API_URL}/{source.id}/transfer/",
+            {
+                "data": {
+                    "type": "Transfer",
+                    "attributes": {"to": target.id, "amount": amount, "txid": txid},
+                }
+            },
+            format="vnd.api+json",
+        )
+
+    def test_rows_are_stored_on_the_wallet_shard(self):
+        self.assertEqual(Wallet.objects.using("default").count(), 2)
+        self.assertEqual(Wallet.objects.using("shard1").count(), 2)
+        tx = Transaction.objects.create(wallet=self.wallets[3], txid="a", amount=5)
+        self.assertEqual(shard_for(tx.id), "shard1")
+        self.assertEqual(self._on_shard(self.wallets[3]).balance, 105)
+        self.assertFalse(Transaction.objects.filter(id=tx.id).exists())
+
+        response = self.client.get(f"{TRANSACTION_BASE_API_URL}/{tx.id}/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.delete(f"{TRANSACTION_BASE_API_URL}/{tx.id}/")
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self._on_shard(self.wallets[3]).balance, 100)
+
+    def test_list_fans_out_with_cursor(self):
+        ids = []
+        self.wallets[1].deposit(50)
+        url = f"{WALLET_BASE_API_URL}/?sort=-balance&page[size]=2"
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids += [int(item["id"]) for item in response.json()["data"]]
+            url = response.json()["links"]["next"]
+        # Equal balances are merged in id order.
+        others = sorted(wallet.id for wallet in self.wallets[::2] + self.wallets[3:])
+        self.assertEqual(ids, [self.wallets[1].id] + others)
+
+    def test_same_shard_transfer(self):
+        source, target = self.wallets[0], self.wallets[1]
+        response = self._transfer(source, target, 30, "same")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self._on_shard(source).balance, 70)
+        self.assertEqual(self._on_shard(target).balance, 130)
+        self.assertFalse(TransferIntent.objects.exists())
+
+    def test_cross_shard_transfer(self):
+        source, target = self.wallets[0], self.wallets[2]
+        response = self._transfer(source, target, 30, "cross")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self._on_shard(source).balance, 70)
+        self.assertEqual(self._on_shard(target).balance, 130)
+        self.assertTrue(
+            Transaction.objects.using("shard1").filter(txid="cross:credit").exists()
+        )
+        self.assertEqual(TransferIntent.objects.get().state, TransferIntent.DONE)
+        for alias in ("default", "shard1"):
+            self.assertFalse(PreparedTransfer.objects.using(alias).exists())
+
+    def test_failed_transfer_is_rolled_back(self):
+        source, target = self.wallets[0], self.wallets[2]
+        response = self._transfer(source, target, 500, "too much")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self._on_shard(source).balance, 100)
+        self.assertEqual(TransferIntent.objects.get().state, TransferIntent.ROLLED_BACK)
+
+        Wallet.objects.using("shard1").filter(id=target.id).delete()
+        with self.assertRaises(Wallet.DoesNotExist):
+            transfer(source.id, target.id, 10, "gone")
+        self.assertEqual(self._on_shard(source).balance, 100)
+        self.assertFalse(Transaction.objects.filter(txid="gone:debit").exists())
+
+    def test_recover_finishes_decided_transfers(self):
+        source, target = self.wallets[0], self.wallets[2]
+        with patch("transaction.transfers.finish"):
+            transfer(source.id, target.id, 40, "crashed")
+        intent = TransferIntent.objects.get()
+        self.assertEqual(intent.state, TransferIntent.COMMITTED)
+        self.assertEqual(self._on_shard(target).balance, 100)
+
+        out = StringIO()
+        call_command("recover_transfers", stdout=out)
+        self.assertIn("Finished 1 transfers.", out.getvalue())
+        intent.refresh_from_db()
+        self.assertEqual(intent.state, TransferIntent.DONE)
+        self.assertEqual(self._on_shard(source).balance, 60)
+        self.assertEqual(self._on_shard(target).balance, 140)
+        call_command("recover_transfers", stdout=StringIO())
+        self.assertEqual(self._on_shard(target).balance, 140)
+
+    def test_moving_transaction_across_shards_is_rejected(self):
+        tx = Transaction.objects.create(wallet=self.wallets[0], txid="move", amount=5)
+        response = self.client.patch(
+            f"{TRANSACTION_BASE_API_URL}/{tx.id}/",
+            {
+                "data": {
+                    "type": "Transaction",
+                    "id": tx.id,
+                    "relationships": {
+                        "wallet": {"data": {"type": "Wallet", "id": self.wallets[2].id}}
+                    },
+                }
+            },
+            format="vnd.api+json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self._on_shard(self.wallets[0]).balance, 105)
+
+    def test_txids_are_unique_across_shards(self):
+        Transaction.objects.create(wallet=self.wallets[0], txid="twice", amount=5)
+        with self.assertRaises(ValidationError):
+            Transaction.objects.create(wallet=self.wallets[2], txid="twice", amount=5)
+        self.assertEqual(self._on_shard(self.wallets[2]).balance, 100)
+        # A claim whose write rolled back is taken over on the same shard.
+        with self.assertRaises(InsufficientFundsError):
+            Transaction.objects.create(
+                wallet=self.wallets[3], txid="retry", amount=-500
+            )
+        Transaction.objects.create(wallet=self.wallets[3], txid="retry", amount=-50)
+        self.assertEqual(self._on_shard(self.wallets[3]).balance, 50)
+
+    def test_transfer_txid_is_not_reused(self):
+        Transaction.objects.create(wallet=self.wallets[2], txid="x:credit", amount=1)
+        for target, txid in ((self.wallets[1], "x"), (self.wallets[2], "cross")):
+            self._transfer(self.wallets[0], self.wallets[2], 10, "cross")
+            response = self._transfer(self.wallets[0], target, 10, txid)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self._on_shard(self.wallets[0]).balance, 90)
+        # Raced past the serializer, the intent's unique txid is caught.
+        with self.assertRaises(ValidationError):
+            transfer(self.wallets[0].id, self.wallets[2].id, 10, "cross")
+        self.assertEqual(self._on_shard(self.wallets[0]).balance, 90)
+
+    def test_changed_txid_is_claimed(self):
+        Transaction.objects.create(wallet=self.wallets[0], txid="taken", amount=1)
+        tx = Transaction.objects.create(wallet=self.wallets[2], txid="mine", amount=1)
+        response = self.client.patch(
+            f"{TRANSACTION_BASE_API_URL}/{tx.id}/",
+            {
+                "data": {
+                    "type": "Transaction",
+                    "id": tx.id,
+                    "attributes": {"txid": "taken", "amount": 1},
+                }
+            },
+            format="vnd.api+json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        tx.txid = "renamed"
+        tx.save()
+        with self.assertRaises(ValidationError):
+            Transaction.objects.create(wallet=self.wallets[0], txid="renamed", amount=1)
+        # The released txid is free again after the claim timeout.
+        Transaction.objects.create(wallet=self.wallets[3], txid="mine", amount=1)
+
+    def test_hold_txid_is_checked_on_every_shard(self):
+        Transaction.objects.create(wallet=self.wallets[2], txid="card", amount=1)
+        response = self.client.post(
+            "/api/holds/",
+            {
+                "data": {
+                    "type": "Hold",
+                    "attributes": {
+                        "wallet": self.wallets[0].id,
+                        "amount": 10,
+                        "txid": "card",
+                    },
+                }
+            },
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        hold = authorize(self._on_shard(self.wallets[0]), 10, "late")
+        Transaction.objects.create(wallet=self.wallets[2], txid="late", amount=1)
+        with self.assertRaises(ValidationError):
+            capture(hold)
+        self.assertEqual(self._on_shard(self.wallets[0]).held, 10)
+
+    def test_bulk_commands_cover_every_shard(self):
+        for wallet in (self.wallets[0], self.wallets[3]):
+            Transaction.objects.create(
+                wallet=wallet, txid=f"purge {wallet.id}", amount=1
+            )
+            wallet.soft_delete()
+            Wallet.all_objects.using(shard_for(wallet.id)).filter(id=wallet.id).update(
+                transactions_count=7
+            )
+        out = StringIO()
+        call_command("rebuild_wallet_counters", stdout=out)
+        self.assertIn("Rebuilt counters of 4 wallets, 2 fixed.", out.getvalue())
+        out = StringIO()
+        call_command("purge_wallets", database="shard1", stdout=out)
+        self.assertEqual(out.getvalue(), "Purged 1 wallets.\n")
+        call_command("purge_wallets", stdout=out)
+        self.assertFalse(
+            Wallet.all_objects.using("default").filter(id=self.wallets[0].id).exists()
+        )
+        with self.assertRaises(CommandError):
+            call_command("import_ledger", "ledger.csv", stdout=StringIO())
+
+
+class IntegerAmountsTest(APITestCase):
+    """Integer minor-unit amounts unit tests."""
+
+    def test_minor_units_field(self):
+        field = MinorUnitsField()
+        for value in (25, "25", "25.00", Decimal("25"), 25.0):
+            self.assertEqual(field.run_validation(value), 25)
+        for value in ("2.5", Decimal("0.01"), "NaN", "abc", True, 2**63):
+            with self.assertRaises(ValidationError):
+                field.run_validation(value)
+
+    def test_legacy_decimal_payloads(self):
+        wallet = Wallet.objects.create(label="minor units")
+        for txid, amount, expected in (("a", "25.00", 201), ("b", "2.5", 400)):
+            response = self.client.post(
+                f"{TRANSACTION_BASE_API_URL}/",
+                {
+                    "data": {
+                        "type": "Transaction",
+                        "attributes": {
+                            "wallet": wallet.id,
+                            "txid": txid,
+                            "amount": amount,
+                        },
+                    }
+                },
+                format="vnd.api+json",
+            )
+            self.assertEqual(response.status_code, expected)
+        wallet.refresh_from_db()
+        self.assertEqual(wallet.balance, 25)
+        self.assertIsInstance(wallet.balance, int)
+
+        response = self.client.get(f"{WALLET_BASE_API_URL}/{wallet.id}/")
+        self.assertEqual(response.json()["data"]["attributes"]["balance"], 25)
+        self.assertEqual(
+            response.json()["data"]["attributes"]["transactions"][0]["amount"], 25
+        )
+
+    def test_decimal_columns_are_dual_written(self):
+        # The previous release reads the decimal columns until the contract.
+        wallet = Wallet.objects.create(label="dual write")
+        Transaction(wallet=wallet, txid="dual-1", amount=30).save()
+        Transaction.objects.bulk_create(
+            [Transaction(wallet=wallet, txid="dual-2", amount=5)]
+        )
+        Transaction.objects.filter(txid="dual-2").bulk_reverse()
+        for row in Transaction.objects.values_list("amount", "legacy_amount"):
+            self.assertEqual(row[0], row[1])
+        wallet.refresh_from_db()
+        self.assertEqual((wallet.balance, wallet.legacy_balance), (25, 25))
+
+        wallet.withdraw(10)
+        Wallet.objects.filter(id=wallet.id).update(balance=F("balance") + 1)
+        wallet.refresh_from_db()
+        self.assertEqual((wallet.balance, wallet.legacy_balance), (16, 16))
+
+
+class ProfilingTest(APITestCase):
+    """On-demand request profiling unit tests."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.settings_override = override_settings(
+            WALLET_PROFILING={
+                "ENABLED": True,
+                "TOKEN": "secret",
+                "DIRECTORY": self.directory,
+                "MAX_ENTRIES": 2,
+            }
+        )
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        self.client = self.client_class()
+        self.wallet = Wallet.objects.create(label="profiled")
+
+    def _get(self, **headers):
+        return self.client.get(
+            f"{TRANSACTION_BASE_API_URL}/?wallet={self.wallet.id}", headers=headers
+        )
+
+    def test_disabled_middleware_is_not_used(self):
+        with override_settings(WALLET_PROFILING={}):
+            with self.assertRaises(MiddlewareNotUsed):
+                ProfilingMiddleware(lambda request: None)
+
+    def test_profiles_requests_with_token(self):
+        self.assertNotIn("X-Profile-Id", self._get())
+        self.assertNotIn("X-Profile-Id", self._get(**{"X-Profile": "wrong"}))
+        response = self._get(**{"X-Profile": "secret"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        name = response["X-Profile-Id"]
+        profile = get_store().load(name)
+        self.assertEqual(profile["path"], f"{TRANSACTION_BASE_API_URL}/")
+        self.assertEqual(profile["status"], 200)
+        self.assertTrue(
+            any(
+                "transaction_transaction" in query["sql"]
+                for query in profile["queries"]
+            )
+        )
+        self.assertIn("function calls", profile["top"])
+        self.assertTrue(os.path.exists(os.path.join(self.directory, f"{name}.prof")))
+
+    def test_ring_buffer_keeps_newest_entries(self):
+        names = [self._get(**{"X-Profile": "secret"})["X-Profile-Id"] for _ in range(3)]
+        self.assertEqual(get_store().names(), names[:0:-1])
+        self.assertEqual(len(os.listdir(self.directory)), 4)
+
+    def test_admin_views_are_staff_only(self):
+        name = self._get(**{"X-Profile": "secret"})["X-Profile-Id"]
+        response = self.client.get("/admin/profiles/")
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+
+        user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.client.force_login(user)
+        response = self.client.get("/admin/profiles/")
+        self.assertContains(response, name)
+        response = self.client.get(f"/admin/profiles/{name}/")
+        self.assertContains(response, "transaction_transaction")
+        response = self.client.get(f"/admin/profiles/{name}/?download=prof")
+        self.assertEqual(response["Content-Disposition"].split(";")[0], "attachment")
+        response = self.client.get("/admin/profiles/missing/")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+PERF_BUDGETS_PATH = os.path.join(os.path.dirname(__file__), "perf_budgets.json")
+# Not counted against budgets, their number depends on the backend.
+TRANSACTION_CONTROL = ("BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE SAVEPOINT")
+
+
+class PerformanceBudgetTest(APITestCase):
+    """Query count and latency budgets of perf_budgets.json on a seeded dataset."""
+
+    @classmethod
+    def setUpTestData(cls):
+        with open(PERF_BUDGETS_PATH) as stream:
+            cls.budgets = json.load(stream)
+        cls.wallets = [Wallet.objects.create(label=f"budget {i}") for i in range(4)]
+        for wallet in cls.wallets:
+            for number in range(25):
+                Transaction.objects.create(
+                    wallet=wallet, txid=f"budget {wallet.id} {number}", amount=10
+                )
+        cls.tx = Transaction.objects.filter(wallet=cls.wallets[0]).first()
+        cls.holds = [
+            authorize(cls.wallets[2], 10, f"budget hold {number}")
+            for number in range(3)
+        ]
+
+    @contextmanager
+    def assertWithinBudget(self, name):
+        budget = self.budgets[name]
+        with CaptureQueriesContext(connection) as context:
+            started = time.perf_counter()
+            yield
+            elapsed = (time.perf_counter() - started) * 1000
+        queries = [
+            query["sql"]
+            for query in context.captured_queries
+            if not query["sql"].startswith(TRANSACTION_CONTROL)
+        ]
+        if len(queries) > budget["queries"] or elapsed > budget["ms"]:
+            self.fail(
+                f"{name} is over its budget of {budget['queries']} queries and "
+                f"{budget['ms']}ms: {len(queries)} queries in {elapsed:.0f}ms.\n"
+                + "\n".join(f"{i}. {sql}" for i, sql in enumerate(queries, 1))
+            )
+
+    def _data(self, resource_type, pk=None, **attributes):
+        data = {"type": resource_type, "attributes": attributes}
+        if pk is not None:
+            data["id"] = pk
+        return {"data": data}
+
+    def test_every_budget_is_exercised(self):
+        tests = {name for name in dir(self) if name.startswith("test_")}
+        for name in self.budgets:
+            self.assertIn(f"test_{name.replace('.', '_')}", tests)
+
+    def test_every_endpoint_has_a_budget(self):
+        # Every action the router serves, including @action routes, so a new
+        # endpoint cannot ship without a budget.
+        endpoints = {
+            f"{basename}.{name}"
+            for _, viewset, basename in router.registry
+            for route in router.get_routes(viewset)
+            for name in route.mapping.values()
+            if hasattr(viewset, name)
+        }
+        self.assertIn("holds.capture", endpoints)
+        self.assertEqual(endpoints - set(self.budgets), set())
+
+    def test_budget_overrun_lists_queries(self):
+        self.budgets = {"wallets.list": {"queries": 0, "ms": 1000}}
+        with self.assertRaisesRegex(AssertionError, "1. SELECT"):
+            with self.assertWithinBudget("wallets.list"):
+                self.client.get(f"{WALLET_BASE_API_URL}/")
+
+    def test_transactions_list(self):
+        # Budgets hold for any page size, so N+1 queries cannot hide.
+        for size in (10, 100):
+            with self.assertWithinBudget("transactions.list"):
+                response = self.client.get(
+                    f"{TRANSACTION_BASE_API_URL}/?page[size]={size}&sort=-amount"
+                )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_transactions_retrieve(self):
+        with self.assertWithinBudget("transactions.retrieve"):
+            response = self.client.get(f"{TRANSACTION_BASE_API_URL}/{self.tx.id}/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_transactions_create(self):
+        with self.assertWithinBudget("transactions.create"):
+            response = self.client.post(
+                f"{TRANSACTION_BASE_API_URL}/",
+                self._data(
+                    "Transaction", wallet=self.wallets[0].id, txid="new", amount=5
+                ),
+            )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_transactions_update(self):
+        with self.assertWithinBudget("transactions.update"):
+            response = self.client.put(
+                f"{TRANSACTION_BASE_API_URL}/{self.tx.id}/",
+                self._data(
+                    "Transaction",
+                    self.tx.id,
+                    wallet=self.wallets[0].id,
+                    txid=self.tx.txid,
+                    amount=7,
+                ),
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_transactions_partial_update(self):
+        with self.assertWithinBudget("transactions.partial_update"):
+            response = self.client.patch(
+                f"{TRANSACTION_BASE_API_URL}/{self.tx.id}/",
+                self._data("Transaction", self.tx.id, amount=7),
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_transactions_destroy(self):
+        with self.assertWithinBudget("transactions.destroy"):
+            response = self.client.delete(f"{TRANSACTION_BASE_API_URL}/{self.tx.id}/")
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_transactions_bulk_reverse(self):
+        with self.assertWithinBudget("transactions.bulk_reverse"):
+            response = self.client.post(
+                f"{TRANSACTION_BASE_API_URL}/reverse/?wallet={self.wallets[1].id}"
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_wallets_list(self):
+        for size in (2, 100):
+            with self.assertWithinBudget("wallets.list"):
+                response = self.client.get(
+                    f"{WALLET_BASE_API_URL}/?page[size]={size}&sort=-balance"
+                )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_wallets_retrieve(self):
+        with self.assertWithinBudget("wallets.retrieve"):
+            response = self.client.get(f"{WALLET_BASE_API_URL}/{self.wallets[0].id}/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_wallets_create(self):
+        with self.assertWithinBudget("wallets.create"):
+            response = self.client.post(
+                f"{WALLET_BASE_API_URL}/", self._data("Wallet", label="new")
+            )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_wallets_update(self):
+        wallet = self.wallets[2]
+        with self.assertWithinBudget("wallets.update"):
+            response = self.client.put(
+                f"{WALLET_BASE_API_URL}/{wallet.id}/",
+                self._data(
+                    "Wallet", wallet.id, label="renamed", concurrency_mode="pessimistic"
+                ),
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_wallets_partial_update(self):
+        wallet = self.wallets[2]
+        with self.assertWithinBudget("wallets.partial_update"):
+            response = self.client.patch(
+                f"{WALLET_BASE_API_URL}/{wallet.id}/",
+                self._data("Wallet", wallet.id, label="renamed"),
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_wallets_destroy(self):
+        with self.assertWithinBudget("wallets.destroy"):
+            response = self.client.delete(
+                f"{WALLET_BASE_API_URL}/{self.wallets[3].id}/"
+            )
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_wallets_transfer(self):
+        with self.assertWithinBudget("wallets.transfer"):
+            response = self.client.post(
+                f"{WALLET_BASE_API_URL}/{self.wallets[0].id}/transfer/",
+                self._data("Transfer", to=self.wallets[1].id, amount=5, txid="budget"),
+            )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_holds_list(self):
+        for size in (2, 100):
+            with self.assertWithinBudget("holds.list"):
+                response = self.client.get(f"/api/holds/?page[size]={size}")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_holds_retrieve(self):
+        with self.assertWithinBudget("holds.retrieve"):
+            response = self.client.get(f"/api/holds/{self.holds[0].id}/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_holds_create(self):
+        with self.assertWithinBudget("holds.create"):
+            response = self.client.post(
+                "/api/holds/",
+                self._data(
+                    "Hold", wallet=self.wallets[1].id, amount=5, txid="budget hold"
+                ),
+            )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_holds_capture(self):
+        with self.assertWithinBudget("holds.capture"):
+            response = self.client.post(
+                f"/api/holds/{self.holds[1].id}/capture/",
+                self._data("Hold", amount=5),
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_holds_void(self):
+        with self.assertWithinBudget("holds.void"):
+            response = self.client.post(f"/api/holds/{self.holds[2].id}/void/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class HoldTest(APITestCase):
+    """Authorize/capture/void holds unit tests."""
+
+    def setUp(self):
+        self.wallet = Wallet.objects.create(label="holds")
+        self.wallet.deposit(100)
+
+    def _authorize(self, amount, txid, **attributes):
+        return self.client.post(
+            "/api/holds/",
+            {
+                "data": {
+                    "type": "Hold",
+                    "attributes": {
+                        "wallet": self.wallet.id,
+                        "amount": amount,
+                        "txid": txid,
+                        **attributes,
+                    },
+                }
+            },
+        )
+
+    def _balances(self):
+        return Wallet.objects.values_list("balance", "held").get(id=self.wallet.id)
+
+    def test_authorize_reserves_funds_with_one_update(self):
+        with CaptureQueriesContext(connection) as queries:
+            hold = authorize(self.wallet, 60, "card-1")
+        self.assertFalse(any("FOR UPDATE" in query["sql"] for query in queries))
+        self.assertEqual(self._balances(), (100, 60))
+        self.assertEqual(hold.state, Hold.AUTHORIZED)
+
+        with self.assertRaises(InsufficientFundsError):
+            authorize(self.wallet, 50, "card-2")
+        with self.assertRaises(InsufficientFundsError):
+            self.wallet.withdraw(50)
+        self.wallet.withdraw(40)
+        self.assertEqual(self._balances(), (60, 60))
+
+    def test_capture_and_void(self):
+        response = self._authorize(70, "card-1")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        hold_id = response.json()["data"]["id"]
+        response = self.client.post(
+            f"/api/holds/{hold_id}/capture/",
+            {"data": {"type": "Hold", "attributes": {"amount": 50}}},
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()["data"]["attributes"]["state"], "captured")
+        self.assertEqual(self._balances(), (50, 0))
+        self.assertEqual(Transaction.objects.get(txid="card-1").amount, -50)
+
+        response = self.client.post(f"/api/holds/{hold_id}/void/")
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+        hold_id = self._authorize(30, "card-2").json()["data"]["id"]
+        response = self.client.post(f"/api/holds/{hold_id}/void/")
+        self.assertEqual(response.json()["data"]["attributes"]["state"], "voided")
+        self.assertEqual(self._balances(), (50, 0))
+
+    def test_invalid_authorizations(self):
+        self.assertEqual(
+            self._authorize(500, "too much").status_code, status.HTTP_400_BAD_REQUEST
+        )
+        self.assertEqual(
+            self._authorize(10, "long", ttl=10**9).status_code,
+            status.HTTP_400_BAD_REQUEST,
+        )
+        hold_id = self._authorize(10, "small").json()["data"]["id"]
+        response = self.client.post(
+            f"/api/holds/{hold_id}/capture/",
+            {"data": {"type": "Hold", "attributes": {"amount": 20}}},
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self._balances(), (100, 10))
+
+    def test_capture_of_a_taken_txid(self):
+        hold_id = self._authorize(10, "card-1").json()["data"]["id"]
+        Transaction.objects.create(wallet=self.wallet, txid="card-1", amount=1)
+        response = self.client.post(f"/api/holds/{hold_id}/capture/")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Hold.objects.get(id=hold_id).state, Hold.AUTHORIZED)
+        self.assertEqual(self._balances(), (101, 10))
+
+    def test_expired_holds_are_released(self):
+        holds = [authorize(self.wallet, 10, f"card-{i}", ttl=60) for i in range(5)]
+        Hold.objects.filter(id__in=[hold.id for hold in holds[:3]]).update(
+            expires_at=timezone.now() - timedelta(seconds=1)
+        )
+        with self.assertRaises(HoldNotActiveError):
+            capture(holds[0])
+
+        out = StringIO()
+        call_command("expire_holds", "--batch-size", "2", stdout=out)
+        self.assertIn("Expired 3 holds.", out.getvalue())
+        self.assertEqual(self._balances(), (100, 20))
+        self.assertEqual(Hold.objects.filter(state=Hold.EXPIRED).count(), 3)
+        self.assertEqual(
+            OutboxEvent.objects.filter(topic="hold", payload__action="expired").count(),
+            3,
+        )
+
+
+class NettingTest(APITestCase):
+    """Multilateral netting settlement unit tests."""
+
+    def setUp(self):
+        self.wallets = [Wallet.objects.create(label=f"netting {i}") for i in range(3)]
+        self.wallets[0].deposit(10)
+
+    def _balances(self):
+        return list(
+            Wallet.objects.filter(id__in=[wallet.id for wallet in self.wallets])
+            .order_by("id")
+            .values_list("balance", "transactions_count")
+        )
+
+    def _batch(self, *legs):
+        return Batch(
+            [self.wallets[source].id for source, _, _ in legs],
+            [self.wallets[target].id for _, target, _ in legs],
+            [amount for _, _, amount in legs],
+            [f"leg {number}" for number in range(len(legs))],
+        )
+
+    def test_net_positions(self):
+        wallet_ids, net, legs = self._batch(
+            (0, 1, 100), (1, 0, 95), (1, 2, 7)
+        ).net_positions()
+        self.assertEqual(wallet_ids.tolist(), [wallet.id for wallet in self.wallets])
+        self.assertEqual(net.tolist(), [-5, -2, 7])
+        self.assertEqual(legs.tolist(), [2, 3, 1])
+
+    def test_settles_on_net_amounts(self):
+        # Wallet 0 cannot pay 100 gross, but only owes 5 net.
+        summary = settle(self._batch((0, 1, 100), (1, 0, 95), (1, 2, 3), (2, 1, 3)))
+        self.assertEqual(summary, {"legs": 4, "wallets": 3, "gross": 201, "net": 5})
+        self.assertEqual(self._balances(), [(5, 2), (5, 4), (0, 2)])
+        self.assertEqual(Transaction.objects.get(txid="leg 0:debit").amount, -100)
+        self.assertEqual(Transaction.objects.filter(txid__startswith="leg ").count(), 8)
+        self.assertEqual(OutboxEvent.objects.filter(topic="transaction").count(), 8)
+
+    def test_replay_never_goes_negative(self):
+        # Funded by a transaction, so the audit replays every balance change.
+        Transaction.objects.create(wallet=self.wallets[1], txid="funds", amount=5)
+        settle(self._batch((1, 0, 100), (0, 1, 95), (2, 1, 3), (1, 2, 3)))
+        out = StringIO()
+        call_command("audit_ledger", stdout=out)
+        self.assertNotIn(f"Wallet {self.wallets[1].id}:", out.getvalue())
+        self.assertIn(" 0 negative balances.", out.getvalue())
+
+    def test_fractional_amounts_are_rejected(self):
+        records = [{"source": 1, "target": 2, "amount": 1.5, "txid": "a"}]
+        with self.assertRaisesRegex(ValidationError, "whole number"):
+            Batch.from_records(records)
+        records[0]["amount"] = "2.00"
+        self.assertEqual(Batch.from_records(records).amounts.tolist(), [2])
+
+    def test_settlement_publishes_events_on_commit(self):
+        bus = EventBus(LocalBackend(history_size=10))
+        patcher = patch("transaction.events._bus", bus)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        with self.captureOnCommitCallbacks(execute=True):
+            settle(self._batch((0, 2, 4)))
+        self.assertEqual(
+            [(event.type, event.wallet_id) for event in bus.backend.history(0)],
+            [
+                ("balance", self.wallets[0].id),
+                ("balance", self.wallets[2].id),
+                ("transaction", self.wallets[2].id),
+                ("transaction", self.wallets[0].id),
+            ],
+        )
+
+    def test_insolvent_batch_is_rolled_back(self):
+        with self.assertRaises(InsufficientFundsError):
+            settle(self._batch((0, 1, 100), (1, 0, 80)))
+        self.assertEqual(self._balances(), [(10, 0), (0, 0), (0, 0)])
+        self.assertFalse(Transaction.objects.exists())
+        with self.assertRaises(ValidationError):
+            settle(self._batch((0, 0, 1)))
+
+    def test_settle_batch_command(self):
+        path = os.path.join(tempfile.mkdtemp(), "batch.csv")
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        with open(path, "w") as stream:
+            stream.write("source,target,amount,txid\n")
+            stream.write(f"{self.wallets[0].id},{self.wallets[2].id},4,a\n")
+        out = StringIO()
+        call_command("settle_batch", path, stdout=out)
+        self.assertIn("Settled 1 legs between 2 wallets", out.getvalue())
+        self.assertEqual(self._balances(), [(6, 1), (0, 0), (4, 1)])
+        with self.assertRaisesRegex(CommandError, "exists"):
+            call_command("settle_batch", path, stdout=StringIO())
+
+
+class ResponseCacheTest(APITestCase):
+    """Versioned response cache of wallet and transaction lists unit tests."""
+
+    def setUp(self):
+        self.settings_override = override_settings(
+            WALLET_RESPONSE_CACHE={"ENABLED": True, "MAX_ENTRIES": 3}
+        )
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        response_cache.reset()
+        self.addCleanup(response_cache.reset)
+        self.wallets = [Wallet.objects.create(label=f"cached {i}") for i in range(2)]
+        for wallet in self.wallets:
+            Transaction.objects.create(
+                wallet=wallet, txid=f"cached {wallet.id}", amount=5
+            )
+
+    def _transactions(self, wallet):
+        return self.client.get(f"{TRANSACTION_BASE_API_URL}/?wallet={wallet.id}")
+
+    def _create(self, wallet, txid):
+        # Runs the commit callbacks, like the end of a real request would.
+        with self.captureOnCommitCallbacks(execute=True):
+            Transaction.objects.create(wallet=wallet, txid=txid, amount=1)
+
+    def test_repeated_list_is_served_from_cache(self):
+        first = self._transactions(self.wallets[0])
+        self.assertEqual(first["X-Response-Cache"], "miss")
+        with self.assertNumQueries(0):
+            second = self._transactions(self.wallets[0])
+        self.assertEqual(second["X-Response-Cache"], "hit")
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second["Content-Type"], first["Content-Type"])
+
+    def test_query_string_is_normalized(self):
+        self.client.get(f"{WALLET_BASE_API_URL}/?balance__gte=0&label__icontains=c")
+        response = self.client.get(
+            f"{WALLET_BASE_API_URL}/?label__icontains=c&balance__gte=0"
+        )
+        self.assertEqual(response["X-Response-Cache"], "hit")
+
+    def test_commit_invalidates_wallet_pages(self):
+        self._transactions(self.wallets[0])
+        self.client.get(f"{WALLET_BASE_API_URL}/")
+        self._create(self.wallets[0], "new")
+        response = self._transactions(self.wallets[0])
+        self.assertEqual(response["X-Response-Cache"], "miss")
+        self.assertEqual(response.json()["meta"]["pagination"]["count"], 2)
+        response = self.client.get(f"{WALLET_BASE_API_URL}/")
+        self.assertEqual(response["X-Response-Cache"], "miss")
+
+    def test_other_wallet_writes_keep_filtered_page(self):
+        self._transactions(self.wallets[0])
+        self.client.get(f"{TRANSACTION_BASE_API_URL}/")
+        self._create(self.wallets[1], "other")
+        self.assertEqual(self._transactions(self.wallets[0])["X-Response-Cache"], "hit")
+        response = self.client.get(f"{TRANSACTION_BASE_API_URL}/")
+        self.assertEqual(response["X-Response-Cache"], "miss")
+
+    def test_uncommitted_write_keeps_cache(self):
+        self._transactions(self.wallets[0])
+        Transaction.objects.create(wallet=self.wallets[0], txid="pending", amount=1)
+        self.assertEqual(self._transactions(self.wallets[0])["X-Response-Cache"], "hit")
+
+    def test_wallet_delete_invalidates_lists(self):
+        self.client.get(f"{WALLET_BASE_API_URL}/")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f"{WALLET_BASE_API_URL}/{self.wallets[1].id}/")
+        response = self.client.get(f"{WALLET_BASE_API_URL}/")
+        self.assertEqual(response["X-Response-Cache"], "miss")
+        self.assertEqual(len(response.json()["data"]), 1)
+
+    def test_cached_etag_answers_not_modified(self):
+        etag = self.client.get(f"{WALLET_BASE_API_URL}/")["ETag"]
+        with self.assertNumQueries(0):
+            response = self.client.get(
+                f"{WALLET_BASE_API_URL}/", headers={"If-None-Match": etag}
+            )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_generation_etags_differ_per_representation(self):
+        url = f"{WALLET_BASE_API_URL}/"
+        packed = self.client.get(url, headers={"Accept": MESSAGEPACK_MEDIA_TYPE})
+        self.assertNotEqual(packed["ETag"], self.client.get(url)["ETag"])
+
+    def test_least_recently_used_pages_are_evicted(self):
+        urls = [f"{WALLET_BASE_API_URL}/?page[size]={size}" for size in (1, 2, 3)]
+        for url in urls:
+            self.client.get(url)
+        self.client.get(urls[0])
+        self.client.get(f"{WALLET_BASE_API_URL}/?page[size]=4")
+        self.assertEqual(len(response_cache.get_store()), 3)
+        self.assertEqual(self.client.get(urls[0])["X-Response-Cache"], "hit")
+        self.assertEqual(self.client.get(urls[1])["X-Response-Cache"], "miss")
+
+    def test_store_is_bounded_by_size(self):
+        store = response_cache.LRUStore(max_entries=10, max_bytes=10)
+        for key in "abc":
+            store.set(key, response_cache.CachedResponse(b"1234", "text/plain", None))
+        self.assertIsNone(store.get("a"))
+        self.assertEqual(store.size, 8)
+        store.set("d", response_cache.CachedResponse(b"x" * 11, "text/plain", None))
+        self.assertIsNone(store.get("d"))
+
+    def test_disabled_cache_is_bypassed(self):
+        with override_settings(WALLET_RESPONSE_CACHE={"ENABLED": False}):
+            response = self._transactions(self.wallets[0])
+        self.assertNotIn("X-Response-Cache", response)
+
+    def test_check_refuses_counters_private_to_a_process(self):
+        local = "transaction.response_cache.LocalGenerations"
+        memcached = "django.core.cache.backends.memcached.PyMemcacheCache"
+        for overrides, errors in (
+            ({"WALLET_RESPONSE_CACHE": {"ENABLED": True}}, ["transaction.E001"]),
+            (
+                {"WALLET_RESPONSE_CACHE": {"ENABLED": True, "GENERATIONS": local}},
+                ["transaction.E001"],
+            ),
+            ({"WALLET_RESPONSE_CACHE": {"ENABLED": False}}, []),
+            (
+                {
+                    "WALLET_RESPONSE_CACHE": {"ENABLED": True},
+                    "CACHES": {"default": {"BACKEND": memcached}},
+                },
+                [],
+            ),
+        ):
+            with override_settings(**overrides):
+                self.assertEqual(
+                    [error.id for error in response_cache.check_generations(None)],
+                    errors,
+                )
+
+
+class MessagePackTest(APITestCase):
+    """MessagePack rendering and parsing of JSON:API documents unit tests."""
+
+    def setUp(self):
+        self.wallet = Wallet.objects.create(label="msgpack")
+        Transaction.objects.create(wallet=self.wallet, txid="packed", amount=7)
+
+    def _post(self, document):
+        return self.client.post(
+            f"{TRANSACTION_BASE_API_URL}/",
+            msgpack.packb(document),
+            content_type=MESSAGEPACK_MEDIA_TYPE,
+            headers={"Accept": MESSAGEPACK_MEDIA_TYPE},
+        )
+
+    def test_list_keeps_document_structure(self):
+        url = f"{TRANSACTION_BASE_API_URL}/?wallet={self.wallet.id}"
+        packed = self.client.get(url, headers={"Accept": MESSAGEPACK_MEDIA_TYPE})
+        self.assertEqual(packed["Content-Type"], MESSAGEPACK_MEDIA_TYPE)
+        document = msgpack.unpackb(packed.content)
+        self.assertEqual(document, self.client.get(url).json())
+        self.assertEqual(document["data"][0]["attributes"]["amount"], 7)
+
+    def test_etags_differ_per_representation(self):
+        transaction = Transaction.objects.get(txid="packed")
+        for url in (
+            f"{WALLET_BASE_API_URL}/{self.wallet.id}/",
+            f"{TRANSACTION_BASE_API_URL}/{transaction.id}/",
+            f"{WALLET_BASE_API_URL}/",
+        ):
+            json_etag = self.client.get(url)["ETag"]
+            packed = self.client.get(url, headers={"Accept": MESSAGEPACK_MEDIA_TYPE})
+            self.assertNotEqual(packed["ETag"], json_etag)
+            self.assertIn("Accept", packed["Vary"])
+            response = self.client.get(
+                url,
+                headers={"Accept": MESSAGEPACK_MEDIA_TYPE, "If-None-Match": json_etag},
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.get(
+                url,
+                headers={
+                    "Accept": MESSAGEPACK_MEDIA_TYPE,
+                    "If-None-Match": packed["ETag"],
+                },
+            )
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_create_from_msgpack_body(self):
+        response = self._post(
+            {
+                "data": {
+                    "type": "Transaction",
+                    "attributes": {
+                        "wallet": self.wallet.id,
+                        "txid": "packed 2",
+                        "amount": 3,
+                    },
+                }
+            }
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        document = msgpack.unpackb(response.content)
+        self.assertEqual(document["data"]["attributes"]["txid"], "packed 2")
+        self.wallet.refresh_from_db()
+        self.assertEqual(self.wallet.balance, 10)
+
+    def test_errors_are_packed(self):
+        response = self._post({"data": {"type": "Transaction", "attributes": {}}})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("errors", msgpack.unpackb(response.content))
+        response = self.client.post(
+            f"{TRANSACTION_BASE_API_URL}/",
+            b"\xc1",
+            content_type=MESSAGEPACK_MEDIA_TYPE,
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_bench_msgpack_command(self):
+        out = StringIO()
+        call_command("bench_msgpack", page_size=5, repeat=2, stdout=out)
+        self.assertIn("msgpack", out.getvalue())
+        self.assertFalse(Wallet.all_objects.filter(label="bench msgpack").exists())
+
+
+class TrafficCaptureTest(LiveServerTestCase):
+    """Request capture middleware and replay_traffic command unit tests."""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "traffic.ndjson")
+        self.settings_override = override_settings(
+            WALLET_CAPTURE={"ENABLED": True, "SAMPLE_RATE": 1.0, "FILE": self.path}
+        )
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        self.client = APIClient()
+        self.wallet = Wallet.objects.create(label="captured")
+
+    def _capture(self):
+        self.client.post(
+            f"{TRANSACTION_BASE_API_URL}/",
+            {
+                "data": {
+                    "type": "Transaction",
+                    "attributes": {
+                        "wallet": self.wallet.id,
+                        "txid": "captured",
+                        "amount": 5,
+                    },
+                }
+            },
+            format="vnd.api+json",
+        )
+        self.client.get(f"{TRANSACTION_BASE_API_URL}/?wallet={self.wallet.id}")
+        self.client.get(f"{WALLET_BASE_API_URL}/{self.wallet.id}/")
+        self.client.get(f"{WALLET_BASE_API_URL}/0/")
+        self.client.get("/swagger/")
+        get_log().flush()
+        return read_entries(self.path)
+
+    def _replay(self, **options):
+        out = StringIO()
+        call_command(
+            "replay_traffic",
+            self.path,
+            base_url=self.live_server_url,
+            speed=0,
+            workers=2,
+            stdout=out,
+            **options,
+        )
+        return out.getvalue()
+
+    def test_disabled_middleware_is_not_used(self):
+        with override_settings(WALLET_CAPTURE={}):
+            with self.assertRaises(MiddlewareNotUsed):
+                CaptureMiddleware(lambda request: None)
+
+    def test_captures_sampled_api_requests(self):
+        entries = self._capture()
+        self.assertEqual(
+            [(entry["m"], entry["s"]) for entry in entries],
+            [("POST", 201), ("GET", 200), ("GET", 200), ("GET", 404)],
+        )
+        self.assertIn(b'"txid":"captured"', entries[0]["body"])
+        self.assertEqual(entries[0]["c"], "application/vnd.api+json")
+        self.assertEqual(entries[1]["q"], f"wallet={self.wallet.id}")
+        self.assertEqual(endpoint(entries[2]), "GET /api/wallets/{id}/")
+
+    def test_replay_reports_percentiles_and_differences(self):
+        self._capture()
+        report = self._replay(txid_suffix="-replay")
+        self.assertIn("Replayed 4 requests", report)
+        self.assertIn("GET /api/wallets/{id}/", report)
+        self.assertIn("No status differences.", report)
+        self.assertTrue(Transaction.objects.filter(txid="captured-replay").exists())
+
+        # The same txid again is rejected as a duplicate.
+        report = self._replay(txid_suffix="-replay")
+        self.assertIn("POST /api/transactions/: 201 -> 400 (1 requests)", report)
+
+
+class LedgerSnapshotTest(APITestCase):
+    """Columnar ledger snapshot export and reader unit tests."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.wallets = [Wallet.objects.create(label=f"snapshot {i}") for i in range(2)]
+        for number in range(3):
+            Transaction.objects.create(
+                wallet=self.wallets[number % 2], txid=f"snapshot {number}", amount=5
+            )
+
+    def _snapshot(self, *args):
+        out = StringIO()
+        call_command("snapshot_ledger", self.directory, *args, stdout=out)
+        return out.getvalue()
+
+    def test_snapshot_is_memory_mapped(self):
+        self.assertIn("Exported 3 new transactions and 2 wallets", self._snapshot())
+        snapshot = Snapshot(self.directory)
+        transactions = snapshot.transactions
+        self.assertIsInstance(transactions["amount"], np.memmap)
+        self.assertEqual(
+            transactions["id"].tolist(),
+            list(Transaction.objects.order_by("id").values_list("id", flat=True)),
+        )
+        self.assertEqual(int(transactions["amount"].sum()), 15)
+        wallets = snapshot.wallets
+        self.assertEqual(wallets["balance"].tolist(), [10, 5])
+        self.assertFalse(np.isnat(wallets["last_activity_at"]).any())
+
+    def test_repeat_snapshot_appends_delta(self):
+        self._snapshot()
+        Transaction.objects.create(wallet=self.wallets[1], txid="snapshot 3", amount=7)
+        self.assertIn("Exported 1 new transactions", self._snapshot())
+        snapshot = Snapshot(self.directory)
+        self.assertEqual(snapshot.rows("transactions"), 4)
+        self.assertEqual(snapshot.transactions["amount"].tolist(), [5, 5, 5, 7])
+        self.assertEqual(snapshot.wallets["balance"].tolist(), [10, 12])
+        self.assertEqual(
+            os.path.getsize(os.path.join(self.directory, "transactions", "id.bin")),
+            4 * 8,
+        )
+
+    def test_full_snapshot_picks_up_deletions(self):
+        self._snapshot()
+        Transaction.objects.get(txid="snapshot 0").delete()
+        self._snapshot()
+        self.assertEqual(Snapshot(self.directory).rows("transactions"), 3)
+        self.assertIn("Exported 2 new transactions", self._snapshot("--full"))
+        self.assertEqual(Snapshot(self.directory).transactions["amount"].sum(), 10)
+
+
+class StatementBudgetTest(BaseTestCase):
+    """Statement time budgets of read endpoints unit tests."""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        Transaction.objects.bulk_create(
+            Transaction(wallet=cls.test_wallet, txid=f"budget {number}", amount=1)
+            for number in range(500)
+        )
+
+    def _budgets(self, **endpoints):
+        return override_settings(
+            WALLET_STATEMENT_BUDGETS={"DEFAULT": None, "ENDPOINTS": endpoints}
+        )
+
+    def test_statement_over_budget_is_cut_off(self):
+        before = STATEMENT_TIMEOUTS.value(endpoint="transactions.list")
+        with self._budgets(**{"transactions.list": 0}):
+            response = self.client.get(
+                f"{TRANSACTION_BASE_API_URL}/?txid__icontains=budget"
+            )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        error = response.json()["errors"][0]
+        self.assertEqual(error["code"], "statement_timeout")
+        self.assertIn("Narrow it down", error["detail"])
+        self.assertEqual(
+            STATEMENT_TIMEOUTS.value(endpoint="transactions.list"), before + 1
+        )
+        # The connection keeps working once the budget is lifted.
+        response = self.client.get(
+            f"{TRANSACTION_BASE_API_URL}/?txid__icontains=budget"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_budgets_are_per_endpoint(self):
+        with self._budgets(**{"transactions.list": 0, "wallets.list": 10}):
+            response = self.client.get(f"{WALLET_BASE_API_URL}/")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.post(
+                f"{TRANSACTION_BASE_API_URL}/",
+                {
+                    "data": {
+                        "type": "Transaction",
+                        "attributes": {
+                            "wallet": self.test_wallet.id,
+                            "txid": "unbudgeted write",
+                            "amount": 1,
+                        },
+                    }
+                },
+            )
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_mysql_select_gets_execution_time_hint(self):
+        self.assertEqual(
+            with_max_execution_time("SELECT id FROM transaction_wallet", 1500),
+            "SELECT /*+ MAX_EXECUTION_TIME(1500) */ id FROM transaction_wallet",
+        )
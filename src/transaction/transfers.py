@@ -0,0 +1,150 @@
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import QuerySet
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from .concurrency import lock_rows
+from .exceptions import TransferAbortedError
+from .models import PreparedTransfer, Transaction, TransferIntent, Wallet
+from .sharding import coordinator, shard_for
+
+# Transfers move `amount` from one wallet to another as a pair of
+# transactions, "<txid>:debit" and "<txid>:credit". Within one shard both are
+# written in a single database transaction. Across shards a two-phase
+# protocol is coordinated through a TransferIntent:
+#
+# 1. prepare: the debit is applied on the source shard (reserving the funds)
+#    and the target wallet is locked and checked on the target shard, each
+#    shard recording a PreparedTransfer row in the same transaction;
+# 2. the decision (committed or aborted) is written on the coordinator;
+# 3. finish: the credit is applied on the target shard, or the debit is
+#    reversed on the source shard, and the PreparedTransfer rows are deleted.
+#
+# Every finishing step is guarded by its PreparedTransfer row, so the
+# recover_transfers command can repeat them after a crash.
+
+
+def transfer(source_wallet_id, target_wallet_id, amount, txid):
+    try:
+        return _transfer(source_wallet_id, target_wallet_id, amount, txid)
+    except IntegrityError:
+        # The txid was taken since TransferSerializer checked it.
+        raise ValidationError({"txid": f"Transfer {txid} exists."})
+
+
+def _transfer(source_wallet_id, target_wallet_id, amount, txid):
+    source, target = shard_for(source_wallet_id), shard_for(target_wallet_id)
+    if source == target:
+        with transaction.atomic(using=source):
+            _create(source, source_wallet_id, -amount, f"{txid}:debit")
+            _create(target, target_wallet_id, amount, f"{txid}:credit")
+        return None
+
+    with transaction.atomic(using=coordinator()):
+        intent = TransferIntent.objects.create(
+            source_wallet_id=source_wallet_id,
+            target_wallet_id=target_wallet_id,
+            amount=amount,
+            txid=txid,
+        )
+    try:
+        with transaction.atomic(using=source):
+            _create(source, source_wallet_id, -amount, f"{txid}:debit")
+            _prepare(source, intent, source_wallet_id, PreparedTransfer.DEBIT)
+        with transaction.atomic(using=target):
+            lock_rows(
+                Wallet.objects.using(target).filter(id=target_wallet_id),
+                QuerySet.get,
+            )
+            _prepare(target, intent, target_wallet_id, PreparedTransfer.CREDIT)
+    except Exception:
+        _decide(intent, TransferIntent.ABORTED)
+        finish(intent)
+        raise
+    if not _decide(intent, TransferIntent.COMMITTED):
+        # Aborted by recover_transfers while preparing took too long.
+        finish(intent)
+        raise TransferAbortedError()
+    finish(intent)
+    return intent
+
+
+def finish(intent):
+    # Second phase, idempotent: applies the decision recorded on the intent.
+    intent.refresh_from_db(fields=["state"])
+    source = shard_for(intent.source_wallet_id)
+    target = shard_for(intent.target_wallet_id)
+    if intent.state in (TransferIntent.COMMITTED, TransferIntent.DONE):
+        with transaction.atomic(using=target):
+            if _release(target, intent, PreparedTransfer.CREDIT):
+                _create(
+                    target,
+                    intent.target_wallet_id,
+                    intent.amount,
+                    f"{intent.txid}:credit",
+                )
+        with transaction.atomic(using=source):
+            _release(source, intent, PreparedTransfer.DEBIT)
+        _decide(intent, TransferIntent.DONE, current=TransferIntent.COMMITTED)
+    elif intent.state in (TransferIntent.ABORTED, TransferIntent.ROLLED_BACK):
+        with transaction.atomic(using=source):
+            if _release(source, intent, PreparedTransfer.DEBIT):
+                Transaction.objects.using(source).get(
+                    txid=f"{intent.txid}:debit"
+                ).delete()
+        with transaction.atomic(using=target):
+            _release(target, intent, PreparedTransfer.CREDIT)
+        _decide(intent, TransferIntent.ROLLED_BACK, current=TransferIntent.ABORTED)
+
+
+def recover(older_than):
+    # Aborts transfers stuck in the prepare phase for `older_than` seconds and
+    # finishes every decided one. Returns the number of intents handled.
+    stale = TransferIntent.objects.filter(
+        state=TransferIntent.PREPARING,
+        created_at__lt=timezone.now() - timedelta(seconds=older_than),
+    )
+    for intent in stale:
+        _decide(intent, TransferIntent.ABORTED)
+    decided = TransferIntent.objects.filter(
+        state__in=(TransferIntent.COMMITTED, TransferIntent.ABORTED)
+    )
+    count = 0
+    for intent in decided.order_by("id"):
+        finish(intent)
+        count += 1
+    return count
+
+
+def _create(using, wallet_id, amount, txid):
+    wallet = Wallet.objects.using(using).get(id=wallet_id)
+    Transaction(wallet=wallet, txid=txid, amount=amount).save(using=using)
+
+
+def _prepare(using, intent, wallet_id, role):
+    PreparedTransfer.objects.using(using).create(
+        intent_id=intent.id, wallet_id=wallet_id, role=role
+    )
+
+
+def _release(using, intent, role):
+    # Deletes the participant row, True when it was still there.
+    deleted, _ = (
+        PreparedTransfer.objects.using(using)
+        .filter(intent_id=intent.id, role=role)
+        .delete()
+    )
+    return bool(deleted)
+
+
+def _decide(intent, state, current=TransferIntent.PREPARING):
+    # Compare-and-set on the coordinator, so a transfer and a concurrent
+    # recovery cannot record different decisions.
+    updated = TransferIntent.objects.filter(id=intent.id, state=current).update(
+        state=state
+    )
+    if updated:
+        intent.state = state
+    return bool(updated)
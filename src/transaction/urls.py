@@ -1,13 +1,19 @@
 from django.urls import include, path
 from rest_framework.routers import DefaultRouter
 
-from .views import TransactionViewSet, WalletViewSet
+from .metrics import metrics_view
+from .views import HoldViewSet, TransactionViewSet, WalletViewSet, wallet_events
 
 
 router = DefaultRouter()
 router.register(r'transactions', TransactionViewSet, basename='transactions')
 router.register(r'wallets', WalletViewSet, basename='wallets')
+router.register(r'holds', HoldViewSet, basename='holds')
 
 urlpatterns = [
+    # Registered before the router, which would read "events" as a wallet pk.
+    path('wallets/events/', wallet_events, name='wallets-events'),
+    path('wallets/<int:pk>/events/', wallet_events, name='wallet-events'),
+    path('metrics/', metrics_view, name='metrics'),
     path('', include(router.urls)),
 ]
@@ -1,13 +1,75 @@
+import csv
+import json
+
+from django.db.models import F
+
+
 # Utils to avoid repeating code.
-def make_transaction(wallet, amount):
+# `transactions` is the change of the wallet's transactions count.
+def make_transaction(wallet, amount, transactions=0):
     if amount > 0:
-        wallet.deposit(amount)
+        wallet.deposit(amount, transactions=transactions)
     else:
-        wallet.withdraw(amount)
+        wallet.withdraw(amount, transactions=transactions)
 
 
 def reverse_transaction(wallet, amount):
     if amount < 0:
-        wallet.deposit(amount)
+        wallet.deposit(-amount, transactions=-1)
     else:
-        wallet.withdraw(amount)
+        wallet.withdraw(amount, transactions=-1)
+
+
+def read_records(path, file_format=None):
+    # Streams dicts from a CSV or NDJSON file one row at a time,
+    # so memory stays flat regardless of the input size.
+    if file_format is None:
+        file_format = "ndjson" if str(path).endswith((".ndjson", ".jsonl")) else "csv"
+    with open(path, newline="", encoding="utf-8") as stream:
+        if file_format == "csv":
+            yield from csv.DictReader(stream)
+        else:
+            for line in stream:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_keyset_chunks(queryset, fields, size):
+    # Yields lists of (pk, *fields) tuples in primary key order. Every chunk is
+    # a "WHERE pk > last ORDER BY pk LIMIT size" query, so unlike OFFSET
+    # pagination it starts from the index instead of re-reading skipped rows.
+    last_pk = None
+    while True:
+        page = queryset.order_by("pk")
+        if last_pk is not None:
+            page = page.filter(pk__gt=last_pk)
+        rows = list(page.values_list("pk", *fields)[:size])
+        if not rows:
+            return
+        last_pk = rows[-1][0]
+        yield rows
+
+
+def copy_column(queryset, source, target, size):
+    # Copies `source` into `target` in primary key ranges of `size` rows,
+    # skipping rows already in sync. Each range is its own short UPDATE, so
+    # run outside a transaction it never locks the whole table.
+    copied = 0
+    for chunk in iter_keyset_chunks(queryset, [], size):
+        copied += (
+            queryset.filter(pk__gte=chunk[0][0], pk__lte=chunk[-1][0])
+            .exclude(**{target: F(source)})
+            .update(**{target: F(source)})
+        )
+    return copied
@@ -1,17 +1,46 @@
+from django.db.models import F
+from django.http import Http404, HttpResponseBadRequest, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
-from drf_yasg.utils import swagger_auto_schema
-from rest_framework import status, viewsets
+from drf_yasg.utils import no_body, swagger_auto_schema
+from rest_framework import mixins, status, viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from rest_framework_json_api import filters
 from rest_framework_json_api import django_filters
 from rest_framework.filters import SearchFilter
 
-from .models import Transaction, Wallet
+from .admission import admit
+from .conditional import (
+    is_not_modified,
+    lookup_versions,
+    not_modified,
+    page_etag,
+    set_etag,
+    transaction_etag,
+    wallet_etag,
+)
+from .events import get_bus
+from .holds import authorize, capture, void
+from .sharding import is_sharded, shard_for, shard_querysets
+from .transfers import transfer
+from .mixins import (
+    ResponseCacheMixin,
+    ShardedViewSetMixin,
+    SparseFieldsetsQuerysetMixin,
+    StatementBudgetMixin,
+)
+from .models import Hold, Transaction, Wallet
+from .response_cache import list_etag
 from .serializers import (
+    HoldCaptureSerializer,
+    HoldCreateSerializer,
+    HoldSerializer,
     TransactionSerializer,
     TransactionCreateSerializer,
     TransactionSwaggerCreateSerializer,
     TransactionSwaggerUpdateSerializer,
+    TransferSerializer,
     WalletCreateSerializer,
     WalletListSerializer,
     WalletRetrieveSerializer,
@@ -21,8 +50,19 @@ from .serializers import (
 )
 
 
-class TransactionViewSet(viewsets.ModelViewSet):
-    queryset = Transaction.objects.all()
+class TransactionViewSet(
+    StatementBudgetMixin,
+    ResponseCacheMixin,
+    ShardedViewSetMixin,
+    SparseFieldsetsQuerysetMixin,
+    viewsets.ModelViewSet,
+):
+    # Transactions of soft-deleted wallets stay hidden until they are purged.
+    # An anti-join on the few deleted wallets keeps the transaction indexes
+    # usable for ordering, unlike a join on every live wallet.
+    queryset = Transaction.objects.exclude(
+        wallet__in=Wallet.all_objects.filter(deleted_at__isnull=False)
+    )
     filter_backends = (
         filters.OrderingFilter,
         django_filters.DjangoFilterBackend,
@@ -39,6 +79,7 @@ class TransactionViewSet(viewsets.ModelViewSet):
         "wallet": ("exact",),
         "txid": ("icontains",),
     }
+    cache_wallet_filter = "wallet"
 
     def get_serializer_class(self):
         if self.action == "list" or self.action == "retrieve":
@@ -50,14 +91,28 @@ class TransactionViewSet(viewsets.ModelViewSet):
         responses={200: TransactionSerializer()},
     )
     def list(self, request, *args, **kwargs):
-        return super(TransactionViewSet, self).list(request, *args, **kwargs)
+        cached = self.get_cached_list(request)
+        if cached is not None:
+            return cached
+        response = super(TransactionViewSet, self).list(request, *args, **kwargs)
+        return self.cache_list(response)
 
     @swagger_auto_schema(
         operation_summary="Get Transaction",
-        responses={204: "No content", 404: "Not Found"},
+        responses={204: "No content", 304: "Not Modified", 404: "Not Found"},
     )
     def retrieve(self, request, *args, **kwargs):
-        return super(TransactionViewSet, self).retrieve(request, *args, **kwargs)
+        versions = lookup_versions(
+            self.get_queryset(), kwargs.get("pk"), "wallet_id", "wallet__version"
+        )
+        if versions is None:
+            return super(TransactionViewSet, self).retrieve(request, *args, **kwargs)
+        etag = transaction_etag(request, kwargs.get("pk"), *versions)
+        if is_not_modified(request, etag):
+            return not_modified(etag)
+        response = super(TransactionViewSet, self).retrieve(request, *args, **kwargs)
+        set_etag(response, etag)
+        return response
 
     @swagger_auto_schema(
         operation_summary="Delete Transaction",
@@ -68,10 +123,45 @@ class TransactionViewSet(viewsets.ModelViewSet):
         },
     )
     def destroy(self, request, *args, **kwargs):
-        instance = get_object_or_404(Transaction, pk=self.kwargs.get("pk"))
-        self.perform_destroy(instance)
+        instance = get_object_or_404(self.get_queryset(), pk=self.kwargs.get("pk"))
+        with admit([instance.wallet_id]):
+            self.perform_destroy(instance)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @swagger_auto_schema(
+        operation_summary="Reverse filtered Transactions",
+        operation_description=(
+            "Deletes every transaction matching the list filters "
+            "(e.g. `?wallet=1&amount__gt=5`) and reverses their net amount on "
+            "each wallet with a single balance update."
+        ),
+        request_body=no_body,
+        responses={
+            200: "Reversed transactions count, and the net amount and count "
+            "reversed per wallet.",
+            400: "Your wallet's balance is less than transaction's amount.",
+        },
+    )
+    @action(detail=False, methods=["post"], url_path="reverse")
+    def bulk_reverse(self, request, *args, **kwargs):
+        base_queryset = self.get_queryset()
+        queryset = self.filter_queryset(base_queryset)
+        if queryset.query.where == base_queryset.query.where:
+            raise ValidationError("At least one filter is required.")
+        # Each shard reverses its own transactions atomically.
+        totals = {}
+        for shard_queryset in shard_querysets(queryset):
+            totals.update(shard_queryset.bulk_reverse())
+        return Response(
+            {
+                "reversed": sum(count for _, count in totals.values()),
+                "wallets": [
+                    {"wallet": wallet_id, "amount": -total, "reversed": count}
+                    for wallet_id, (total, count) in totals.items()
+                ],
+            }
+        )
+
     @swagger_auto_schema(
         operation_summary="Create Transaction",
         request_body=TransactionSwaggerCreateSerializer,
@@ -83,7 +173,8 @@ class TransactionViewSet(viewsets.ModelViewSet):
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        serializer.save()
+        with admit([serializer.validated_data["wallet"].id]):
+            serializer.save()
         headers = self.get_success_headers(serializer.data)
         return Response(
             serializer.data, status=status.HTTP_201_CREATED, headers=headers
@@ -103,7 +194,9 @@ class TransactionViewSet(viewsets.ModelViewSet):
         instance: Transaction = self.get_object()
         serializer = self.get_serializer(instance, data=request.data, partial=partial)
         serializer.is_valid(raise_exception=True)
-        instance = serializer.save()
+        wallet = serializer.validated_data.get("wallet", instance.wallet)
+        with admit({instance.wallet_id, wallet.id}):
+            instance = serializer.save()
         response = TransactionSerializer(
             instance, context=self.get_serializer_context()
         ).data
@@ -122,8 +215,109 @@ class TransactionViewSet(viewsets.ModelViewSet):
         return super(TransactionViewSet, self).partial_update(request, *args, **kwargs)
 
 
-class WalletViewSet(viewsets.ModelViewSet):
+class HoldViewSet(
+    StatementBudgetMixin,
+    ShardedViewSetMixin,
+    mixins.ListModelMixin,
+    mixins.RetrieveModelMixin,
+    viewsets.GenericViewSet,
+):
+    queryset = Hold.objects.order_by("id")
+    filter_backends = (
+        filters.OrderingFilter,
+        django_filters.DjangoFilterBackend,
+    )
+    filterset_fields = {
+        "wallet": ("exact",),
+        "state": ("exact",),
+    }
+
+    def get_serializer_class(self):
+        if self.action == "create":
+            return HoldCreateSerializer
+        if self.action == "capture":
+            return HoldCaptureSerializer
+        return HoldSerializer
+
+    @swagger_auto_schema(
+        operation_summary="Authorize Hold",
+        operation_description=(
+            "Reserves `amount` of the wallet balance until the hold is "
+            "captured, voided or expires after `ttl` seconds."
+        ),
+        responses={
+            201: HoldSerializer(),
+            400: "Your wallet's balance is less than transaction's amount.",
+        },
+    )
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        with admit([data["wallet"].id]):
+            hold = authorize(
+                data["wallet"], data["amount"], data["txid"], data.get("ttl")
+            )
+        return Response(
+            HoldSerializer(hold, context=self.get_serializer_context()).data,
+            status=status.HTTP_201_CREATED,
+        )
+
+    @swagger_auto_schema(
+        operation_summary="Capture Hold",
+        operation_description=(
+            "Creates a transaction of `amount` (the whole hold by default) "
+            "with the hold's txid and releases the rest."
+        ),
+        responses={
+            200: HoldSerializer(),
+            404: "Not Found",
+            409: "The hold was already captured, voided or has expired.",
+        },
+    )
+    @action(detail=True, methods=["post"])
+    def capture(self, request, *args, **kwargs):
+        hold = self.get_object()
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        amount = serializer.validated_data.get("amount", hold.amount)
+        if amount > hold.amount:
+            raise ValidationError({"amount": "Cannot capture more than the hold."})
+        with admit([hold.wallet_id]):
+            capture(hold, amount)
+        return Response(
+            HoldSerializer(hold, context=self.get_serializer_context()).data
+        )
+
+    @swagger_auto_schema(
+        operation_summary="Void Hold",
+        request_body=no_body,
+        responses={
+            200: HoldSerializer(),
+            404: "Not Found",
+            409: "The hold was already captured, voided or has expired.",
+        },
+    )
+    @action(detail=True, methods=["post"])
+    def void(self, request, *args, **kwargs):
+        hold = self.get_object()
+        with admit([hold.wallet_id]):
+            void(hold)
+        return Response(
+            HoldSerializer(hold, context=self.get_serializer_context()).data
+        )
+
+
+class WalletViewSet(
+    StatementBudgetMixin,
+    ResponseCacheMixin,
+    ShardedViewSetMixin,
+    SparseFieldsetsQuerysetMixin,
+    viewsets.ModelViewSet,
+):
     queryset = Wallet.objects.all()
+    # Read by the list ETags, see _page_etag.
+    loaded_fields = ("version",)
     filter_backends = (
         filters.OrderingFilter,
         django_filters.DjangoFilterBackend,
@@ -141,6 +335,19 @@ class WalletViewSet(viewsets.ModelViewSet):
             "icontains",
             "iexact",
         ),
+        "transactions_count": (
+            "exact",
+            "lt",
+            "gt",
+            "gte",
+            "lte",
+        ),
+        "last_activity_at": (
+            "lt",
+            "gt",
+            "gte",
+            "lte",
+        ),
     }
 
     def get_serializer_class(self):
@@ -148,30 +355,78 @@ class WalletViewSet(viewsets.ModelViewSet):
             return WalletListSerializer
         if self.action == "retrieve":
             return WalletRetrieveSerializer
+        if self.action == "transfer":
+            return TransferSerializer
         return WalletCreateSerializer
 
     @swagger_auto_schema(
-        operation_summary="Get list of Wallets", responses={200: WalletListSerializer()}
+        operation_summary="Get list of Wallets",
+        responses={200: WalletListSerializer(), 304: "Not Modified"},
     )
     def list(self, request, *args, **kwargs):
-        return super(WalletViewSet, self).list(request, *args, **kwargs)
+        cached = self.get_cached_list(request)
+        if cached is not None:
+            return cached
+        etag = list_etag(request)
+        if etag is None and request.headers.get("If-None-Match"):
+            # Without the generations, the page is read as id/version pairs
+            # only and nothing is serialized before the 304 is decided.
+            queryset = self.filter_queryset(self.get_queryset())
+            rows = self.paginate_queryset(queryset.only("id", "version"))
+            if is_not_modified(request, self._page_etag(request, rows)):
+                return not_modified(self._page_etag(request, rows))
+        elif etag is not None and is_not_modified(request, etag):
+            return not_modified(etag)
+        response = super(WalletViewSet, self).list(request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            set_etag(response, etag or self._page_etag(request, self._page_rows))
+        return self.cache_list(response)
+
+    def paginate_queryset(self, queryset):
+        self._page_rows = super().paginate_queryset(queryset)
+        return self._page_rows
+
+    def _page_etag(self, request, rows):
+        if is_sharded():
+            return page_etag(request, rows, self._next_cursor)
+        page = self.paginator.page
+        return page_etag(
+            request, rows, page.paginator.count, page.paginator.exact, page.has_next()
+        )
 
     @swagger_auto_schema(
         operation_summary="Get list of Wallets",
-        responses={200: WalletListSerializer(), 404: "Not Found"},
+        responses={
+            200: WalletListSerializer(),
+            304: "Not Modified",
+            404: "Not Found",
+        },
     )
     def retrieve(self, request, *args, **kwargs):
-        return super(WalletViewSet, self).retrieve(request, *args, **kwargs)
+        versions = lookup_versions(self.get_queryset(), kwargs.get("pk"), "version")
+        if versions is None:
+            return super(WalletViewSet, self).retrieve(request, *args, **kwargs)
+        etag = wallet_etag(request, kwargs.get("pk"), *versions)
+        if is_not_modified(request, etag):
+            return not_modified(etag)
+        response = super(WalletViewSet, self).retrieve(request, *args, **kwargs)
+        set_etag(response, etag)
+        return response
 
     @swagger_auto_schema(
         operation_summary="Delete Wallet",
         responses={204: "No content", 404: "Not Found"},
     )
     def destroy(self, request, *args, **kwargs):
-        instance = get_object_or_404(Wallet, pk=self.kwargs.get("pk"))
+        instance = get_object_or_404(self.get_queryset(), pk=self.kwargs.get("pk"))
         self.perform_destroy(instance)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    def perform_destroy(self, instance):
+        # Soft delete only, the wallet and its transactions are removed in
+        # bounded batches by the purge_wallets command.
+        instance.soft_delete()
+
     @swagger_auto_schema(
         operation_summary="Create Wallet",
         request_body=WalletSwaggerCreateSerializer,
@@ -201,3 +456,75 @@ class WalletViewSet(viewsets.ModelViewSet):
     )
     def partial_update(self, request, *args, **kwargs):
         return super(WalletViewSet, self).partial_update(request, *args, **kwargs)
+
+    def perform_update(self, serializer):
+        # Label edits change the representation, so they bump the ETag version.
+        serializer.save(version=F("version") + 1)
+
+    @swagger_auto_schema(
+        operation_summary="Transfer from Wallet",
+        operation_description=(
+            "Moves `amount` to the `to` wallet as a `<txid>:debit` and a "
+            "`<txid>:credit` transaction. Wallets on different shards are "
+            "transferred with a two-phase protocol."
+        ),
+        request_body=TransferSerializer,
+        responses={
+            201: "Transfer done.",
+            400: "Your wallet's balance is less than transaction's amount.",
+            404: "Not Found",
+        },
+    )
+    @action(detail=True, methods=["post"])
+    def transfer(self, request, *args, **kwargs):
+        wallet = self.get_object()
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        target, amount, txid = (
+            serializer.validated_data[name] for name in ("to", "amount", "txid")
+        )
+        if target == wallet.id or not (
+            Wallet.objects.using(shard_for(target)).filter(id=target).exists()
+        ):
+            raise ValidationError({"to": "Expected another existing wallet."})
+        with admit([wallet.id, target]):
+            intent = transfer(wallet.id, target, amount, txid)
+        return Response(
+            {
+                "from": wallet.id,
+                "to": target,
+                "amount": amount,
+                "txid": txid,
+                "intent": intent and intent.id,
+            },
+            status=status.HTTP_201_CREATED,
+        )
+
+
+async def wallet_events(request, pk=None):
+    # Server-Sent Events stream of balance and transaction changes of one wallet
+    # or of several (`?wallets=1,2`). Needs an ASGI server to stream.
+    # A reconnecting client resumes after its Last-Event-ID header.
+    try:
+        if pk is not None:
+            wallet_ids = {int(pk)}
+        else:
+            wallet_ids = {int(id) for id in request.GET["wallets"].split(",")}
+        last_event_id = request.headers.get("Last-Event-ID")
+        last_event_id = int(last_event_id) if last_event_id else None
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest(
+            "Expected `wallets` ids and an integer Last-Event-ID."
+        )
+    found = 0
+    for queryset in shard_querysets(Wallet.objects.filter(id__in=wallet_ids)):
+        found += await queryset.acount()
+    if found != len(wallet_ids):
+        raise Http404("Wallet not found.")
+    subscription = get_bus().subscribe(wallet_ids, last_event_id)
+    response = StreamingHttpResponse(
+        subscription.stream(), content_type="text/event-stream"
+    )
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response